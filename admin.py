@@ -0,0 +1,93 @@
+"""
+Description:
+    Sends a command to the admin socket of a running server and prints the
+    answer.
+
+Usage:
+    python3 admin.py <args> <command>
+
+Commands:
+    metrics         Print the server's metrics in the Prometheus text format.
+
+    clients         List connections, slowest first: id, player name,
+                    smoothed round trip time of clients that negotiated
+                    timing and bytes waiting to be sent to them.
+
+    traces [count]  Print the last count traces kept by a server started
+                    with --tracesample, all of them by default, as JSON
+                    lines.
+
+    profile cprofile|sample [seconds]
+                    Profile the server for seconds, its --profileseconds
+                    by default, and write the results to its --profiledir.
+
+    profile stop    Stop profiling early and write the results.
+
+    memory [count]  List memory by subsystem and the top count growers
+                    since memory profiling started, 20 by default.
+
+    memory start [seconds]
+                    Trace allocations, writing a snapshot every seconds,
+                    the server's --memoryinterval by default, to its
+                    --profiledir.
+
+    memory stop     Write a last snapshot and stop tracing allocations.
+
+Command line arguments:
+    -h, --help      Print this help.
+
+    -a, --adminsocket   Admin socket the server was started with.
+"""
+
+import sys
+import socket
+import getopt
+
+def command(path, args):
+    """Send command args to the admin socket at path, returns the answer."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(' '.join(args).encode('ascii') + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks).decode('utf-8')
+
+def usage():
+    print(__doc__)
+
+def parse_cmd_args(argv):
+    path = None
+
+    try:
+        opts, args = getopt.getopt(argv, 'ha:', ['help', 'adminsocket='])
+
+        for opt, arg in opts:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif opt in ('-a', '--adminsocket'):
+                path = arg
+            else:
+                raise getopt.GetoptError(msg='Invalid command line option')
+        if not path:
+            raise getopt.GetoptError(msg='No admin socket given')
+        if not args:
+            raise getopt.GetoptError(msg='No command given')
+
+    except getopt.GetoptError as ex:
+        print(ex.msg)
+        usage()
+        sys.exit()
+    else:
+        return path, args
+
+def main(argv):
+    path, args = parse_cmd_args(argv)
+    sys.stdout.write(command(path, args))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,243 @@
+"""
+Description:
+    Reproducible end-to-end load benchmark. Starts server.py on loopback,
+    drives it with a seeded swarm of automated clients and reports:
+
+        games_per_sec       games finished per second
+        msgs_per_sec        messages sent and received by the clients a second
+        play_latency_p50    seconds from a client sending cplay to it receiving
+        play_latency_p95    the next table update (stabl, ssnap or sdelt)
+        play_latency_p99
+        cpu_per_1k_msgs     server CPU seconds per thousand messages
+        peak_rss_kb         server peak resident set size
+
+    Results are written as JSON and compared against a baseline, exiting
+    with status 1 if any result is worse than the baseline by more than the
+    tolerance.
+
+Usage:
+    python3 bench.py <args>
+
+Command line arguments:
+    -h, --help      Print this help.
+
+    -n, --bots      Number of bots (default 14).
+
+    -u, --duration  Seconds to run the load for (default 10).
+
+    -t, --think     Bot think time distribution, see swarm.py
+                    (default const:0.01).
+
+    -e, --seed      Random seed for the server's deals and the bots
+                    (default 0).
+
+    -b, --binary    Bots ask the server for binary framing.
+
+    -d, --delta     Bots ask the server for table deltas.
+
+    -l, --lobbydelta    Bots ask the server for lobby deltas.
+
+    -o, --output    File to write results to (default bench_results.json).
+
+    -B, --baseline  Baseline file to compare against
+                    (default bench_baseline.json).
+
+    -x, --tolerance Fraction a result may be worse than the baseline before
+                    it counts as a regression (default 0.2).
+
+    -S, --save      Save the results as the new baseline instead of
+                    comparing against it.
+"""
+
+import sys
+import os
+import json
+import time
+import socket
+import getopt
+import asyncio
+import logging
+import resource
+import subprocess
+import swarm
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+SERVER_START_TIMEOUT = 5
+TURNTIMEOUT = 2
+
+# result name -> True if higher is better
+RESULTS = {
+    'games_per_sec': True,
+    'msgs_per_sec': True,
+    'play_latency_p50': False,
+    'play_latency_p95': False,
+    'play_latency_p99': False,
+    'cpu_per_1k_msgs': False,
+    'peak_rss_kb': False,
+    }
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted values, None if there are none."""
+    if not values:
+        return None
+    rank = max(int(round(p / 100 * len(values))), 1)
+    return values[rank-1]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def wait_for_server(port, proc):
+    """Wait until the server accepts connections."""
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(proc.returncode))
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+def run(opts):
+    """Run the benchmark described by opts, returns dict of results."""
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, SERVER, '-s', 'localhost',
+        '-p', str(port), '-e', str(opts['seed']), '-l', '0',
+        '-t', str(TURNTIMEOUT), '-q'])
+    try:
+        wait_for_server(port, proc)
+        swarm_opts = dict(swarm.parse_cmd_args([]), host='localhost',
+            port=port, bots=opts['bots'], duration=opts['duration'],
+            think=opts['think'], seed=opts['seed'], binary=opts['binary'],
+            delta=opts['delta'], lobby_delta=opts['lobby_delta'])
+        latencies = []
+        start = time.perf_counter()
+        stats = asyncio.run(swarm.run_swarm(swarm_opts,
+            range(opts['bots']), latencies))
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    # the server is the only child process, so these are its numbers
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    msgs = stats['msgs_sent'] + stats['msgs_received']
+    latencies.sort()
+    return {
+        'games_per_sec': stats['games'] / elapsed,
+        'msgs_per_sec': msgs / elapsed,
+        'play_latency_p50': percentile(latencies, 50),
+        'play_latency_p95': percentile(latencies, 95),
+        'play_latency_p99': percentile(latencies, 99),
+        'cpu_per_1k_msgs': (usage.ru_utime + usage.ru_stime) * 1000 / msgs
+            if msgs else None,
+        'peak_rss_kb': usage.ru_maxrss,
+        'games': stats['games'],
+        'msgs': msgs,
+        'plays': len(latencies),
+        'elapsed': elapsed,
+        'opts': opts,
+        }
+
+def compare(results, baseline, tolerance):
+    """Return list of descriptions of results that regressed from baseline."""
+    regressions = []
+    for name, higher_is_better in RESULTS.items():
+        new, old = results.get(name), baseline.get(name)
+        if new is None or old is None:
+            continue
+        if higher_is_better:
+            regressed = new < old * (1 - tolerance)
+        else:
+            regressed = new > old * (1 + tolerance)
+        if regressed:
+            regressions.append('{}: {:.6g} (baseline {:.6g})'.format(name,
+                new, old))
+    return regressions
+
+def usage():
+    print(__doc__)
+
+def parse_cmd_args(argv):
+    opts = {    # defaults
+        'bots': 14,
+        'duration': 10,
+        'think': 'const:0.01',
+        'seed': 0,
+        'binary': False,
+        'delta': False,
+        'lobby_delta': False,
+        }
+    output, baseline, tolerance, save = ('bench_results.json',
+        'bench_baseline.json', 0.2, False)
+
+    try:
+        opt_list, args = getopt.getopt(argv, 'hn:u:t:e:bdlo:B:x:S', ['help', 'bots=', 'duration=', 'think=', 'seed=', 'binary', 'delta', 'lobbydelta', 'output=', 'baseline=', 'tolerance=', 'save'])
+
+        for opt, arg in opt_list:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif opt in ('-n', '--bots'):
+                opts['bots'] = max(int(arg), 1)
+            elif opt in ('-u', '--duration'):
+                opts['duration'] = max(float(arg), 1)
+            elif opt in ('-t', '--think'):
+                swarm.parse_think(arg)
+                opts['think'] = arg
+            elif opt in ('-e', '--seed'):
+                opts['seed'] = int(arg)
+            elif opt in ('-b', '--binary'):
+                opts['binary'] = True
+            elif opt in ('-d', '--delta'):
+                opts['delta'] = True
+            elif opt in ('-l', '--lobbydelta'):
+                opts['lobby_delta'] = True
+            elif opt in ('-o', '--output'):
+                output = arg
+            elif opt in ('-B', '--baseline'):
+                baseline = arg
+            elif opt in ('-x', '--tolerance'):
+                tolerance = max(float(arg), 0)
+            elif opt in ('-S', '--save'):
+                save = True
+            else:
+                raise getopt.GetoptError(msg='Invalid command line option')
+
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex.msg if isinstance(ex, getopt.GetoptError) else ex)
+        usage()
+        sys.exit()
+    else:
+        return opts, output, baseline, tolerance, save
+
+def main(argv):
+    """Run the benchmark, returns the exit status."""
+    opts, output, baseline, tolerance, save = parse_cmd_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    swarm.raise_fd_limit()
+    results = run(opts)
+    for name in RESULTS:
+        print('{:>18}: {}'.format(name, results[name]))
+
+    with open(baseline if save else output, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    if save:
+        print('Saved baseline to', baseline)
+        return 0
+    try:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+    except FileNotFoundError:
+        print('No baseline at {}, run with --save to create one'.format(
+            baseline))
+        return 0
+    for regression in regressions:
+        print('Regression', regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,264 @@
+"""Compact binary framing negotiated at cjoin time as an alternative to the
+ASCII protocol in message.py.
+
+A binary connection still carries ASCII messages, so both kinds of frames can
+share one stream. ASCII frames always start with '[', binary frames start with
+a type byte >= 0x80 followed by a 2 byte payload length:
+
+    +------+--------+-----------+
+    | type | length |  payload  |
+    |  1B  |   2B   | length B  |
+    +------+--------+-----------+
+
+Cards travel as single bytes (plays, swaps) or as 52-bit masks (hands), and
+seats are packed structs instead of fixed width text.
+"""
+
+import struct
+import message
+import common
+
+# Capability name sent in cjoin/sjoin to negotiate binary framing
+CAPABILITY = 'binary'
+
+# Frame types
+BIN_ASCII = 0x80    # ASCII message without a compact encoding
+BIN_SHAND = 0x81    # hand as 52-bit mask
+BIN_STABL = 0x82    # full table status
+BIN_CPLAY = 0x83    # played cards as bytes
+BIN_CSWAP = 0x84    # swapped card as a byte
+BIN_SSNAP = 0x85    # sequence numbered table status snapshot
+BIN_SDELT = 0x86    # sequence numbered table status changes
+
+# Table delta item tags, seat changes are tagged with the seat index
+DELT_PLAY = 0x10
+DELT_ROUND = 0x11
+
+HEADER = struct.Struct('!BH')
+MASK = struct.Struct('!Q')
+# status, strikes, number of cards, name
+SEAT = struct.Struct('!cBB8s')
+EMPTY_SEAT = SEAT.pack(b'e', 0, 0, b'')
+SEQ = struct.Struct('!I')
+MAX_PAYLOAD = 0xffff
+
+class FrameError(Exception):
+    pass
+
+def pack_frame(typ, payload):
+    """Return frame bytes for frame type and payload."""
+    assert(typ >= 0x80)
+    assert(len(payload) <= MAX_PAYLOAD)
+    return HEADER.pack(typ, len(payload)) + payload
+
+def retrieve_frame_from_buff(buff):
+    """Returns tuple: (first frame in buffer, rest of buffer).
+
+    The frame is either an ASCII message string or a (type, payload) tuple.
+    """
+    if not buff:
+        return None, buff
+    if buff[0] == ord('['):
+        end = buff.find(b']')
+        if end == -1:
+            return None, buff
+        return buff[:end+1].decode('ascii'), buff[end+1:]
+    elif buff[0] >= 0x80:
+        if len(buff) < HEADER.size:
+            return None, buff
+        typ, length = HEADER.unpack_from(buff)
+        end = HEADER.size + length
+        if len(buff) < end:
+            return None, buff
+        return (typ, bytes(buff[HEADER.size:end])), buff[end:]
+    else:
+        # garbage, skip to the next thing that looks like a frame
+        for i, b in enumerate(buff):
+            if b == ord('[') or b >= 0x80:
+                return retrieve_frame_from_buff(buff[i:])
+        return None, b''
+
+def cards_to_mask(cards):
+    """Convert list of cards to a 52-bit mask."""
+    mask = 0
+    for card in cards:
+        mask |= 1 << card
+    return mask
+
+def mask_to_cards(mask):
+    """Convert 52-bit mask to a sorted list of cards."""
+    return [card for card in range(common.Deck.DECK_SIZE) if mask >> card & 1]
+
+def cards_to_bytes(cards):
+    """Convert list of cards to one byte per card."""
+    return bytes(cards)
+
+def bytes_to_cards(payload):
+    """Convert card bytes to a list of cards, rejecting invalid cards."""
+    cards = list(payload)
+    for card in cards:
+        if card >= common.Deck.DECK_SIZE:
+            raise FrameError('invalid card: {}'.format(card))
+    return cards
+
+def msg_to_frame(msg):
+    """Wrap an ASCII message in a binary frame."""
+    return pack_frame(BIN_ASCII, msg.encode('ascii'))
+
+def hand_to_frame(hand):
+    """Convert list of cards in hand to a shand frame."""
+    return pack_frame(BIN_SHAND, MASK.pack(cards_to_mask(hand)))
+
+def play_to_frame(cards):
+    """Convert list of played cards to a cplay frame."""
+    return pack_frame(BIN_CPLAY, cards_to_bytes(cards))
+
+def swap_to_frame(card):
+    """Convert card sent to the scumbag to a cswap frame."""
+    return pack_frame(BIN_CSWAP, cards_to_bytes([card]))
+
+def pack_seat(player):
+    """Pack player into a seat struct."""
+    return SEAT.pack(player.status.encode('ascii'), player.strikes,
+        len(player.hand), player.name.encode('ascii'))
+
+def table_payload(table):
+    """Pack table object for table status frames.
+
+    Only occupied seats are sent, the receiver pads the rest with empty seats.
+    """
+    last_play = table.last_play() or []
+    payload = bytes([int(table.starting_round), len(last_play)])
+    payload += cards_to_bytes(last_play)
+    payload += bytes([len(table.players)])
+    payload += b''.join([pack_seat(player) for player in table.players])
+    return payload
+
+def table_to_frame(table):
+    """Convert table object to a table status frame."""
+    return pack_frame(BIN_STABL, table_payload(table))
+
+def table_to_snapshot_frame(table, seq):
+    """Convert table object to a sequence numbered snapshot frame."""
+    return pack_frame(BIN_SSNAP, SEQ.pack(seq) + table_payload(table))
+
+def changes_to_delta_frame(table, changes, seq):
+    """Convert list of table state changes (see message.diff_table_state) to
+    a table delta frame, packing changed seats straight from the table.
+    """
+    payload = SEQ.pack(seq)
+    for change in changes:
+        if change[0] == 's':
+            i = change[1]
+            payload += bytes([i])
+            if i < len(table.players):
+                payload += pack_seat(table.players[i])
+            else:
+                payload += EMPTY_SEAT
+        elif change[0] == 'p':
+            last_play = table.last_play() or []
+            payload += bytes([DELT_PLAY, len(last_play)])
+            payload += cards_to_bytes(last_play)
+        else:
+            payload += bytes([DELT_ROUND, int(change[1])])
+    return pack_frame(BIN_SDELT, payload)
+
+def unpack_seat(payload, offset):
+    """Unpack seat struct at offset into a PlayerStatus object."""
+    status, strikes, num_cards, name = SEAT.unpack_from(payload, offset)
+    player_stat = message.PlayerStatus()
+    player_stat.status = status.decode('ascii')
+    player_stat.strikes = strikes
+    player_stat.name = name.decode('ascii').rstrip('\x00').strip()
+    player_stat.num_cards = num_cards
+    return player_stat
+
+def delta_frame_to_msg(payload):
+    """Convert table delta frame payload to a table delta message."""
+    if len(payload) < SEQ.size:
+        raise FrameError('bad sdelt frame length')
+    changes = []
+    offset = SEQ.size
+    while offset < len(payload):
+        tag = payload[offset]
+        if tag < common.TABLESIZE:
+            if len(payload) < offset + 1 + SEAT.size:
+                raise FrameError('bad sdelt frame length')
+            player_stat = unpack_seat(payload, offset + 1)
+            changes.append(('s', tag, message.player_stat_to_str(player_stat)))
+            offset += 1 + SEAT.size
+        elif tag == DELT_PLAY:
+            num_cards = payload[offset+1]
+            cards = bytes_to_cards(payload[offset+2:offset+2+num_cards])
+            changes.append(('p', message.cards_to_str(cards, 4)))
+            offset += 2 + num_cards
+        elif tag == DELT_ROUND:
+            changes.append(('r', str(payload[offset+1])))
+            offset += 2
+        else:
+            raise FrameError('unknown sdelt item: {}'.format(tag))
+    return message.changes_to_sdelt(changes, SEQ.unpack_from(payload)[0])
+
+def frame_to_table(payload):
+    """Convert table status frame payload to tuple:
+    (list of PlayerStatus objects, last play, starting round).
+    """
+    if len(payload) < 3 or len(payload) < 3 + payload[1]:
+        raise FrameError('bad stabl frame length')
+    starting_round = bool(payload[0])
+    num_cards = payload[1]
+    last_play = bytes_to_cards(payload[2:2+num_cards])
+    offset = 2 + num_cards
+    num_seats = payload[offset]
+    offset += 1
+    if len(payload) != offset + num_seats * SEAT.size:
+        raise FrameError('bad stabl frame length')
+    player_stat_list = []
+    for i in range(num_seats):
+        player_stat_list.append(unpack_seat(payload, offset + i * SEAT.size))
+    for i in range(common.TABLESIZE - num_seats):
+        player_stat_list.append(message.empty_player_stat())
+    return player_stat_list, last_play, starting_round
+
+def frame_to_msg(frame):
+    """Convert a decoded frame to the equivalent ASCII message."""
+    if isinstance(frame, str):
+        return frame
+    typ, payload = frame
+    if typ == BIN_ASCII:
+        return payload.decode('ascii')
+    elif typ == BIN_SHAND:
+        if len(payload) != MASK.size:
+            raise FrameError('bad shand frame length')
+        return message.hand_to_msg(mask_to_cards(MASK.unpack(payload)[0]))
+    elif typ == BIN_STABL:
+        return message.player_stat_list_to_stabl(*frame_to_table(payload))
+    elif typ == BIN_SSNAP:
+        if len(payload) < SEQ.size:
+            raise FrameError('bad ssnap frame length')
+        stabl = message.player_stat_list_to_stabl(
+            *frame_to_table(payload[SEQ.size:]))
+        return message.stabl_to_ssnap(stabl, SEQ.unpack_from(payload)[0])
+    elif typ == BIN_SDELT:
+        try:
+            return delta_frame_to_msg(payload)
+        except IndexError:
+            raise FrameError('truncated sdelt frame')
+    elif typ == BIN_CPLAY:
+        return '[cplay|{}]'.format(message.cards_to_str(
+            bytes_to_cards(payload), 4))
+    elif typ == BIN_CSWAP:
+        return '[cswap|{}]'.format(message.cards_to_str(
+            bytes_to_cards(payload), 1))
+    else:
+        raise FrameError('unknown frame type: {}'.format(typ))
+
+def encode_cmsg(msg):
+    """Convert an ASCII client message to the most compact frame for it."""
+    msg_type = message.msg_type(msg)
+    if msg_type == 'cplay':
+        return play_to_frame(message.str_to_cards(message.fields(msg)[0]))
+    elif msg_type == 'cswap':
+        return swap_to_frame(int(message.fields(msg)[0]))
+    else:
+        return msg_to_frame(msg)
@@ -0,0 +1,66 @@
+"""Compact binary capture of the traffic on every server connection, written
+by the server's recorder and read by replay.py.
+
+A capture is a header followed by records:
+
+    +---------+------------+--------+--------+--------+
+    | time    | connection |  kind  | length |  data  |
+    | 8B float|     4B     |   1B   |   4B   |        |
+    +---------+------------+--------+--------+--------+
+
+Time is monotonic seconds since the capture started. Inbound data is
+recorded as received, outbound data one message or frame at a time.
+"""
+
+import struct
+import clock
+
+MAGIC = b'WSCAP\x01'
+
+# Record kinds
+OPEN = 0    # connection accepted
+IN = 1      # data received from the client
+OUT = 2     # message or frame queued for the client
+CLOSE = 3   # connection closed
+
+RECORD = struct.Struct('!dIBI')
+
+class CaptureError(Exception):
+    pass
+
+class Recorder:
+    """Appends records to a capture file."""
+
+    def __init__(self, path, scheduler=None):
+        self.scheduler = scheduler or clock.Scheduler()
+        self.start = self.scheduler.time()
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+    def record(self, conn, kind, data=b''):
+        self.file.write(RECORD.pack(self.scheduler.time() - self.start, conn,
+            kind, len(data)))
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read(path):
+    """Yield (time, connection, kind, data) for every record in a capture."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureError('not a capture file: {}'.format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise CaptureError('truncated record')
+            t, conn, kind, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                raise CaptureError('truncated record')
+            yield t, conn, kind, data
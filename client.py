@@ -14,7 +14,26 @@ Command line arguments:
     -p, --port  Port to connect to.
 
     -n, --name  Player name to use in game.
+
+    -b, --binary    Ask the server for compact binary framing instead of the
+                    ASCII protocol.
+
+    -d, --delta     Ask the server for sequence numbered table changes instead
+                    of full table status messages.
+
+    -l, --lobbydelta    Ask the server for names added to and removed from the
+                        lobby instead of the full lobby roster.
     
+    -t, --timing    Ask the server for pings and its processing times, to
+                    keep round trip and server time histograms. Automated
+                    clients log them, in manual mode 'L' shows them.
+
+    -k, --scrollback    Lines of messages, chat and plays the manual mode UI
+                        keeps to scroll back through.
+
+    -w, --watch     Watch the table as a spectator instead of waiting in
+                    the lobby to play.
+
     -m, --manual    Manual mode. Text based UI will be displayed in terminal
                     to play game in. Otherwise an automated client will be
                     spawned which will automatically play cards and no UI will
@@ -24,15 +43,19 @@ Command line arguments:
 import sys
 import common
 import message
+import binmessage
 import logging
 import clientgui
 import socket
 import getopt
 import time
-import threading
-import queue
+import asyncio
+import collections
+import metrics
 
 AUTOPLAY_PAUSE = 2  # seconds automated client waits before sending play to server
+PING_INTERVAL = 5   # seconds between pings when timing
+TIMING_WINDOW = 60  # seconds of timings kept, logged when they are replaced
 
 def current_turn_num(player_stat_list):
     """Calculates what turn number it is from player_stat_list."""
@@ -45,115 +68,316 @@ def current_turn_num(player_stat_list):
         logging.info('Server sent stabl with no one active.')
         return -1
 
-class Client():
+class TableDiff:
+    """What changed from one table status message to the next:
+    TableDiff.player_stat_list  -->  players at the table now
+    TableDiff.last_play         -->  cards to beat now
+    TableDiff.turn              -->  seat whose turn it is, -1 if no one's
+    TableDiff.prev_turn         -->  seat whose turn it was, None for the
+                                     first table
+    TableDiff.seats             -->  seats that changed, all of them for the
+                                     first table
+    TableDiff.play              -->  cards to beat if they changed, else None
+    TableDiff.skipped           -->  the new play has the ranks of the last
+    TableDiff.out               -->  PlayerStatus of who went out, or None
+    TableDiff.hand_over         -->  someone went out leaving at most one
+                                     player with cards
+    TableDiff.scumbag           -->  PlayerStatus of the player left with
+                                     cards when the hand is over, or None
+
+    A message identical to the previous one isn't parsed again.
+    """
+
+    SEATS = range(7, 111, 15)   # where each seat starts in a stabl
+    SEAT_LEN = 14
+
+    def __init__(self, msg, prev=None):
+        self.stabl = msg
+        self.prev_turn = prev.turn if prev else None
+        self.play = None
+        self.skipped = False
+        self.out = None
+        self.hand_over = False
+        self.scumbag = None
+        if prev and msg == prev.stabl:
+            self.player_stat_list = prev.player_stat_list
+            self.last_play = prev.last_play
+            self.turn = prev.turn
+            self.seats = []
+            return
+
+        psl = self.player_stat_list = message.stabl_to_player_stat_list(msg)
+        self.last_play = message.stabl_to_last_play(msg)
+        self.turn = current_turn_num(psl)
+        if not prev:
+            self.seats = list(range(len(psl)))
+            self.play = self.last_play
+            return
+
+        self.seats = [i for i, start in enumerate(self.SEATS)
+            if msg[start:start+self.SEAT_LEN] !=
+                prev.stabl[start:start+self.SEAT_LEN]]
+        if self.last_play != prev.last_play:
+            self.play = self.last_play
+            self.skipped = bool(self.play) and ([c // 4 for c in self.play] ==
+                [c // 4 for c in prev.last_play])
+        for i in self.seats:
+            if (psl[i].num_cards == 0 and
+                prev.player_stat_list[i].num_cards != 0):
+                self.out = psl[i]
+                break
+        if self.out:
+            left = [p for p in psl
+                if p.status in ('a', 'w', 'p') and p.num_cards > 0]
+            if len(left) <= 1:
+                self.hand_over = True
+                self.scumbag = left[0] if left else None
+
+    @property
+    def changed(self):
+        """False if nothing the client acts on changed."""
+        return (bool(self.seats) or self.play is not None or
+            self.turn != self.prev_turn)
+
+    def __str__(self):
+        text = 'turn {} -> {}, seats {}'.format(self.prev_turn, self.turn,
+            self.seats)
+        if self.play is not None:
+            text += ', play {}{}'.format(self.play,
+                ' (skip)' if self.skipped else '')
+        if self.out:
+            text += ', {} out'.format(self.out.name)
+        if self.hand_over:
+            text += ', hand over'
+        return text
+
+def default_think_time():
+    return AUTOPLAY_PAUSE
+
+class Client(asyncio.Protocol):
     """Main client class that controls communication with server. Spawns GUI for
     player to play in if manual mode is specified with command line arguments.
+
+    Runs on an asyncio event loop: received data is split into messages in an
+    inbox and processed straight away, and GUI input is handed to the loop
+    with call_soon_threadsafe, so the client sleeps between events.
     """
 
     # Set-up
-    def __init__(self, name, host, port, auto=True):
+    def __init__(self, name, auto=True, binary=False, delta=False,
+            lobby_delta=False, think=default_think_time,
+            strategy=common.lowest_card_strategy, scheduler=None,
+            scrollback=None, timing=False, spectate=False):
         self.automated = auto
+        self.think = think          # returns seconds to pause before playing
+        self.strategy = strategy    # (hand, last play) -> cards to play
+        self.msgs_received = 0
+        self.msgs_sent = 0
+        self.games_lost = 0     # games we finished last in, one client a game
+        self.play_sent_at = None    # perf_counter() when our cplay was sent
+        self.play_latencies = []    # seconds from cplay to next table update
+        self.want_binary = binary
+        self.want_delta = delta
+        self.want_lobby_delta = lobby_delta
+        self.want_timing = timing
+        self.want_spectate = spectate
+        self.timing = False     # set once the server agrees to timing
+        self.ping = None        # (token, perf_counter() sent) of our ping
+        self.ping_handle = None
+        self.timing_handle = None
+        self.new_timings()
+        self.lobby = []
+        self.binary = False     # set once the server agrees to binary framing
+        self.stabl = None       # table status rebuilt from ssnap/sdelt
+        self.table_seq = None
+        self.resyncing = False
         self.run = True
-        if self.automated:
-            self.gui = None
-        else:
-            self.gui = clientgui.ClientGui(self)
         self.name = name
-        self.sockobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sockobj.settimeout(1)
-        self.connect(host, port)
-        self.buff = ''
-        self.msgs = []
+        self.loop = None
+        self.scheduler = scheduler  # runs timers, the event loop if None
+        self.transport = None
+        self.closed = None      # future resolved when the connection closes
+        self.buff = b'' if binary else ''
+        self.msgs = collections.deque()
         self.waiting_for_play = False
         self.waiting_for_swap = False
         self.player = None
         self.in_game = False
-        self.prev_player_stat_list = None
+        self.table = None       # TableDiff of the latest table status
         self.player_num = None
-        self.wait_thread = None
+        self.play_handle = None     # pending automated play
+        self.pending_swap = None    # swapw received before our hand
+        if self.automated:
+            self.gui = None
+        else:
+            self.gui = clientgui.ClientGui(self,
+                scrollback or clientgui.SCROLLBACK)
         logging.info('Client %s created', name)
 
-    def connect(self, host, port):
-        """Connect to server socket"""
-        self.sockobj.connect((host, port))
+    async def connect(self, host, port):
+        """Connect to server socket and ask to join the game."""
+        self.loop = asyncio.get_running_loop()
+        self.closed = self.loop.create_future()
+        await self.loop.create_connection(lambda: self, host, port)
         logging.info('Client %s succesfully connected to host: %s, port: %s',
             self.name, host, port)
         if self.gui: self.gui.print_msg("Succesfully connected to server, waiting for join confirmation.")
+        self.send_msg(self.join_msg())
+
+    async def play(self, host, port):
+        """Connect, then process messages until the connection closes."""
+        await self.connect(host, port)
+        await self.closed
 
     # Socket communication
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost(self, exc):
+        logging.info('Client %s connection closed: %s', self.name, exc)
+        self.run = False
+        self.cancel_auto_play()
+        self.stop_timing()
+        if self.closed and not self.closed.done():
+            self.closed.set_result(None)
+
     def send_msg(self, msg):
-        """Send message through socket to server"""
+        """Send message through socket to server. Safe to call from other
+        threads, the message is handed to the event loop.
+        """
         assert(msg)
-        logging.info('Client %s sending msg: %s', self.name, msg)
-        msg = msg.encode('ascii')
-        try_num = 1
-        while try_num <= 3:
-            try:
-                sent = self.sockobj.send(msg)
-                if sent == 0:
-                    self.run = False
-            except IOError as e:
-                logging.info('Client %s: IOError when trying to send: , %s',
-                    self.name, e)
-                # server kicked us?
-                self.run = False
-                break
-            except socket.timeout as e:
-                # try again
-                logging.info('Timeout when trying to send')
-                try_num += 1
-                continue
-            else:
-                # succesful send
-                break
-
-    def recv_msgs(self):
-        """Receive data from server socket and put them in buffer"""
-        try:
-            buff = self.sockobj.recv(1024)
-            if not buff:
-                # looks like socket is closed
-                self.run = False
-                return
-        except ConnectionResetError as e:
-            logging.info('ConnectionResetError when trying to receive: %s', e)
-            self.run = False
+        if self.in_other_thread():
+            self.loop.call_soon_threadsafe(self.send_msg, msg)
             return
-        except socket.timeout as e:
+        if not self.transport or self.transport.is_closing():
+            logging.info('Client %s not connected, dropping msg: %s',
+                self.name, msg)
             return
-        buff = buff.decode('ascii')
-        self.buff += buff
+        logging.info('Client %s sending msg: %s', self.name, msg)
+        self.msgs_sent += 1
+        if self.binary:
+            self.transport.write(binmessage.encode_cmsg(msg))
+        else:
+            self.transport.write(msg.encode('ascii'))
 
-        msg, self.buff = message.retrieve_msg_from_buff(self.buff)
+    def data_received(self, buff):
+        """Receive data from server socket, put the messages in it in the
+        inbox and process them.
+        """
+        if self.want_binary:
+            # binary frames can be mixed with ASCII messages
+            self.buff += buff
+            retrieve = binmessage.retrieve_frame_from_buff
+        else:
+            self.buff += buff.decode('ascii')
+            retrieve = message.retrieve_msg_from_buff
+
+        msg, self.buff = retrieve(self.buff)
         while msg:
-            self.msgs.append(msg)
-            logging.info('Client %s received message: %s', self.name, msg)
-            msg, self.buff = message.retrieve_msg_from_buff(self.buff)
-
-    def get_msg(self):
-        """Get first message from list of messages waiting to be processed"""
-        if self.msgs:
-            ret = self.msgs[0]
-            self.msgs = self.msgs[1:]
-            return ret
+            try:
+                msg = binmessage.frame_to_msg(msg)
+            except (binmessage.FrameError, UnicodeDecodeError) as ex:
+                logging.info('Client %s received invalid frame: %s', self.name,
+                    ex)
+            else:
+                self.msgs.append(msg)
+                self.msgs_received += 1
+                logging.info('Client %s received message: %s', self.name, msg)
+            msg, self.buff = retrieve(self.buff)
+
+        while self.msgs:
+            self.process_msg(self.msgs.popleft())
+
+    def join_msg(self):
+        """Return cjoin message, listing any optional capabilities wanted."""
+        caps = []
+        if self.want_binary:
+            caps.append(binmessage.CAPABILITY)
+        if self.want_delta:
+            caps.append(message.DELTA_CAPABILITY)
+        if self.want_lobby_delta:
+            caps.append(message.LOBBY_DELTA_CAPABILITY)
+        if self.want_timing:
+            caps.append(message.TIMING_CAPABILITY)
+        if caps:
+            return '[cjoin|{}|{}]'.format(self.name.ljust(8), ','.join(caps))
+        return '[cjoin|{}]'.format(self.name.ljust(8))
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds."""
+        return (self.scheduler or self.loop).call_later(delay, callback, *args)
+
+    # Timing
+    def new_timings(self):
+        """Start a new window of round trip and server time histograms."""
+        self.rtts = metrics.Histogram('client_rtt_seconds',
+            'Round trip times of pings to the server.')
+        self.server_times = metrics.Histogram('client_server_seconds',
+            'Seconds the server kept our messages queued and processing.',
+            'stage')
+
+    def start_timing(self):
+        self.timing = True
+        self.ping_handle = self.call_later(PING_INTERVAL, self.send_ping)
+        self.timing_handle = self.call_later(TIMING_WINDOW, self.log_timings)
+
+    def stop_timing(self):
+        for handle in (self.ping_handle, self.timing_handle):
+            if handle:
+                handle.cancel()
+        self.ping_handle = self.timing_handle = None
+
+    def send_ping(self):
+        token = (self.ping[0] + 1) % message.SEQ_MOD if self.ping else 0
+        self.ping = (token, time.perf_counter())
+        self.send_msg('[cping|{:05d}]'.format(token))
+        self.ping_handle = self.call_later(PING_INTERVAL, self.send_ping)
+
+    def log_timings(self):
+        """Log the timings of this window and start the next one."""
+        logging.info('Client %s timings: %s', self.name, self.timings())
+        self.new_timings()
+        self.timing_handle = self.call_later(TIMING_WINDOW, self.log_timings)
+
+    def timings(self):
+        """Describe the timings of this window, in milliseconds."""
+        def describe(histogram, label=None):
+            count = histogram.count(label)
+            if not count:
+                return 'none'
+            return 'p50 {:.1f} p99 {:.1f} of {}'.format(
+                histogram.percentile(50, label) * 1000,
+                histogram.percentile(99, label) * 1000, count)
+        return 'rtt {}, server queued {}, processing {}'.format(
+            describe(self.rtts), describe(self.server_times, 'queued'),
+            describe(self.server_times, 'processing'))
+
+    def show_timings(self):
+        """Show the timings in the GUI. Safe to call from other threads."""
+        if self.in_other_thread():
+            self.loop.call_soon_threadsafe(self.show_timings)
+            return
+        if not self.timing:
+            self.gui.print_msg('Timing not enabled, start with --timing')
         else:
-            return None
-
-    # Main loop, message processing
-    def game_loop(self):
-        """Main loop. Receives messages, and processes them in order."""
-        while self.run:
-            # cleanup any zombie threads
-            self.cleanup_wait_thread()
-            # get msgs from socket
-            if not self.msgs:
-                self.recv_msgs()
-            msg = self.get_msg()
-            # process msgs
-            while msg:
-                self.process_msg(msg)
-                msg = self.get_msg()
+            self.gui.print_msg('Timings (ms): {}'.format(self.timings()))
+
+    def in_other_thread(self):
+        """True when called from a thread other than the event loop's, e.g.
+        the GUI thread. Without an event loop everything runs in the caller's
+        thread.
+        """
+        if self.loop is None:
+            return False
+        try:
+            return asyncio.get_running_loop() is not self.loop
+        except RuntimeError:
+            return True
 
+    # Message processing
     def process_msg(self, msg):
         """Process message based on type."""
         if not message.is_valid(msg):
@@ -165,12 +389,24 @@ class Client():
 
         # process based on msg_type
         if msg_type == 'sjoin':
-            # logging.warn('Client %s received unexpected sjoin message',
-                # self.name)
-            pass
+            name = fields[0].strip()
+            self.binary = binmessage.CAPABILITY in message.capabilities(msg)
+            if message.TIMING_CAPABILITY in message.capabilities(msg):
+                self.start_timing()
+            self.player = common.Player(name)
+            logging.info('Client {} successfully joined with name {}'.format(
+                self.name, name))
+            if self.want_spectate:
+                self.send_msg(message.spectate_msg(0, True))
+            if self.gui:
+                self.gui.print_msg("Succesfully joined server with name {}".format(
+                    self.player.name))
+        elif not self.player:
+            logging.info('Client %s received msg before joining: %s',
+                self.name, msg)
         elif msg_type == 'shand':
-            if (self.player_num and self.prev_player_stat_list and 
-                self.player_num == current_turn_num(self.prev_player_stat_list)):
+            if (self.player_num and self.table and
+                self.player_num == self.table.turn):
                 # this player just went
                 if self.automated:
                     logging.info("Automated player %s made an invalid play",
@@ -186,13 +422,28 @@ class Client():
                 self.gui.print_hand(hand)
                 self.gui.print_msg("Picked up hand")
             self.in_game = True
+            if self.pending_swap:
+                msg, self.pending_swap = self.pending_swap, None
+                self.process_msg(msg)
         elif msg_type == 'stabl':
             self.process_stabl(msg)
+        elif msg_type == 'ssnap':
+            self.resyncing = False
+            self.table_seq = message.sdelt_seq(msg)
+            self.stabl = message.ssnap_to_stabl(msg)
+            self.process_stabl(self.stabl)
+        elif msg_type == 'sdelt':
+            self.process_sdelt(msg)
         elif msg_type == 'slobb':
-            lobby = message.slobb_to_lobby(msg)
-            logging.info('Lobby update: {}'.format(repr(lobby)))
+            self.lobby = message.slobb_to_lobby(msg)
+            logging.info('Lobby update: {}'.format(repr(self.lobby)))
+            if self.gui:
+                self.gui.update_lobby(self.lobby)
+        elif msg_type == 'sldel':
+            self.lobby = message.apply_sldel(self.lobby, msg)
+            logging.info('Lobby update: {}'.format(repr(self.lobby)))
             if self.gui:
-                self.gui.update_lobby(message.slobb_to_lobby(msg))
+                self.gui.update_lobby(self.lobby)
         elif msg_type == 'schat':
             fields = message.fields(msg)
             who = fields[0]
@@ -211,14 +462,11 @@ class Client():
                     "Please play the card you would like to send to the scumbag")
                 self.waiting_for_swap = True
                 self.waiting_for_play = False
-                self.asynch_get_play()
             else:
                 if not self.player.hand:
                     logging.info("Warlord offered a swap before they knows there hand")
-                    # we need to wait for our hand, hopefully it is in the socket
-                    self.recv_msgs()
-                    # gonna have to come back to this msg later
-                    self.msgs.append(msg)
+                    # gonna have to come back to this msg when the hand arrives
+                    self.pending_swap = msg
                 else:
                     # automated, send lowest card
                     self.send_msg('[cswap|{0:02d}]'.format(
@@ -234,6 +482,19 @@ class Client():
                     "As the scumbag, you were forced to trade your {} for the presidents {}".format(
                     self.gui.print_card(card_lost),
                     self.gui.print_card(card_gained)))
+        elif msg_type == 'spong':
+            token = int(fields[0])
+            if (self.ping and self.ping[0] == token and
+                self.ping[1] is not None):
+                self.rtts.observe(time.perf_counter() - self.ping[1])
+                # answered, count it once
+                self.ping = (token, None)
+        elif msg_type == 'sping':
+            self.send_msg('[cpong|{}]'.format(fields[0]))
+        elif msg_type == 'stime':
+            timed_type, queued, processed = message.stime_to_timing(msg)
+            self.server_times.observe(queued, 'queued')
+            self.server_times.observe(processed, 'processing')
         elif msg_type == 'strik':
             fields = message.fields(msg)
             code = fields[0]
@@ -254,64 +515,63 @@ class Client():
         else:
             logging.info('Client received msg: ' + msg)
 
+    def process_sdelt(self, msg):
+        """Apply table changes, asking for a snapshot if we missed some."""
+        seq = message.sdelt_seq(msg)
+        if self.stabl is None or seq != (self.table_seq + 1) % message.SEQ_MOD:
+            if not self.resyncing:
+                logging.info('Client %s missed table update %s, resyncing',
+                    self.name, seq)
+                self.resyncing = True
+                self.send_msg('[cresy]')
+            return
+        self.table_seq = seq
+        self.stabl = message.apply_sdelt(self.stabl, msg)
+        self.process_stabl(self.stabl)
+
     def process_stabl(self, msg):
         """Process table status message, prompt user for play if necessary."""
-        logging.info('Client %s processing stabl: ' + msg, self.name)
-        psl = message.stabl_to_player_stat_list(msg)
-        last_play = message.stabl_to_last_play(msg)
-
-        winner = self.detect_winner(psl, self.prev_player_stat_list)
-        asshole = False
-
-        # update gui
-        if self.gui:
-            self.gui.update(psl, self.prev_player_stat_list,
-                last_play, winner, asshole)
-        if winner:
-            if winner.name.strip() == self.player.name.strip():
+        if self.play_sent_at is not None:
+            self.play_latencies.append(time.perf_counter() - self.play_sent_at)
+            self.play_sent_at = None
+        diff = self.table = TableDiff(msg, self.table)
+        if not diff.changed:
+            logging.debug('Client %s table unchanged', self.name)
+        else:
+            logging.info('Client %s table changed: %s', self.name, diff)
+            if self.gui:
+                self.gui.update(diff)
+            if (self.gui and diff.out and
+                diff.out.name.strip() == self.player.name.strip()):
                 # they went out
-                if self.gui:
-                    self.gui.print_msg("You went out!")
-            # see if the game is over
-            active_players = []
-            for player in psl:
-                if player.status in ('a', 'w', 'p') and player.num_cards > 0:
-                    active_players.append(player)
-            if len(active_players) <= 1:
+                self.gui.print_msg("You went out!")
+            if diff.hand_over:
                 # the game is over!
                 self.in_game = False
                 self.waiting_for_play = False
                 self.player.hand = []
                 self.player.status = 'l'
                 self.player_num = None
-                self.cleanup_wait_thread()
-                self.wait_thread = None
-                try:
-                    asshole = active_players[0]
-                except IndexError:
-                    asshole = None
-                self.prev_player_stat_list = None
-        if asshole:
-            return
+                self.cancel_auto_play()
+                if diff.scumbag and diff.scumbag.name == self.player.name:
+                    self.games_lost += 1
+                self.table = None
+                return
         if self.in_game:
             # see if they missed their turn
-            if self.waiting_for_play and \
-                current_turn_num(psl) != self.my_turn_num(psl):
-                # their turn timed out
-                self.waiting_for_play = False
-                if not self.wait_thread.is_alive():
-                    self.wait_thread = None
+            if diff.turn != self.my_turn_num(diff.player_stat_list):
+                if self.waiting_for_play:
+                    # their turn timed out
+                    self.waiting_for_play = False
+                self.cancel_auto_play()
             # see if it's their turn
-            if current_turn_num(psl) == self.my_turn_num(psl):
-                if self.automated:
-                    play = self.auto_play(last_play)
-                    self.player.remove_from_hand(play)
-                    self.send_msg('[cplay|{}]'.format(message.cards_to_str(play, 4)))
-                else:
-                    self.waiting_for_play = True
-                    self.gui.print_msg("It's your turn!")
-                    self.asynch_get_play()
-        self.prev_player_stat_list = psl
+            elif self.automated:
+                if not self.play_handle:
+                    self.play_handle = self.call_later(self.think(),
+                        self.send_auto_play, diff.last_play)
+            elif not self.waiting_for_play:
+                self.waiting_for_play = True
+                self.gui.print_msg("It's your turn!")
 
     # Utility functions
     def my_turn_num(self, player_stat_list):
@@ -331,100 +591,53 @@ class Client():
                     'stabl missing this player'))
         return self.player_num
     
-    def detect_winner(self, player_stat_list, prev_player_stat_list):
-        """See if anyone won between the two latest table status messages from
-        the server.
-        """
-        if not prev_player_stat_list:
-            return None
-        for i, ps in enumerate(player_stat_list):
-            if ps.num_cards == 0 and prev_player_stat_list[i].num_cards != 0:
-                # we have a winner!
-                return ps
-        else:
-            return None
-
-    def asynch_get_play(self):
-        """Asynchronously get user play from GUI."""
-        assert(self.gui)
-        if self.wait_thread:
-            self.wait_thread.join(0)
-            if self.wait_thread.is_alive():
-                logging.info("Client %s tried to start multiple threads waiting " +
-                    "for gui input")
-                return
-        self.wait_thread = threading.Thread(target=self.get_play)
-        self.wait_thread.start()
-    
-    def get_play(self):
-        """Get user play from GUI."""
-        assert(self.gui)
-        while self.waiting_for_play or self.waiting_for_swap:
-            try:
-                play = self.gui.pending_play.get(timeout=5)
-            except queue.Empty:
-                continue
-            else:
-                if self.waiting_for_play:
-                    # still waiting, play it
-                    self.waiting_for_play = False
-                    self.player.remove_from_hand(play)
-                    self.send_msg('[cplay|{}]'.format(
-                        message.cards_to_str(play, 4)))
-                    if self.gui:
-                        self.gui.print_msg("Sent play")
-                        self.gui.print_hand(self.player.hand)
-                    return
-                elif self.waiting_for_swap:
-                    # still waiting, swap it
-                    self.waiting_for_swap = False
-                    self.player.remove_from_hand(list(play[:1]))
-                    self.send_msg('[cswap|{}]'.format(
-                        message.cards_to_str(play[:1], 1)))
-                    if self.gui:
-                        self.gui.print_msg("Sent swap")
-                        self.gui.print_hand(self.player.hand)
-                    return
-                else:
-                    if self.gui:
-                        self.gui.print_msg("Wait for your turn to play")
-        return
-                    
-    def cleanup_wait_thread(self):
-        """Check for zombie threads and clean them up."""
-        if not self.wait_thread:
-            return
+    def submit_play(self, play):
+        """Called by the GUI thread with the cards the user chose."""
+        self.loop.call_soon_threadsafe(self.handle_gui_play, list(play))
+
+    def handle_gui_play(self, play):
+        """Send the play from the GUI if we are waiting for one."""
+        if self.waiting_for_play:
+            self.waiting_for_play = False
+            self.player.remove_from_hand(play)
+            self.send_msg('[cplay|{}]'.format(message.cards_to_str(play, 4)))
+            self.gui.print_msg("Sent play")
+            self.gui.print_hand(self.player.hand)
+        elif self.waiting_for_swap:
+            self.waiting_for_swap = False
+            self.player.remove_from_hand(list(play[:1]))
+            self.send_msg('[cswap|{}]'.format(
+                message.cards_to_str(play[:1], 1)))
+            self.gui.print_msg("Sent swap")
+            self.gui.print_hand(self.player.hand)
         else:
-            self.wait_thread.join(0)
-        if not self.wait_thread.is_alive():
-            self.wait_thread = None
+            self.gui.print_msg("Wait for your turn to play")
+
+    def send_auto_play(self, last_play):
+        """Send the automated play once the pause is over."""
+        self.play_handle = None
+        play = self.auto_play(last_play)
+        self.player.remove_from_hand(play)
+        self.send_msg('[cplay|{}]'.format(message.cards_to_str(play, 4)))
+        self.play_sent_at = time.perf_counter()
+
+    def cancel_auto_play(self):
+        if self.play_handle:
+            self.play_handle.cancel()
+            self.play_handle = None
 
     def auto_play(self, last_play):
         """When client is automated, figure out which cards to play."""
-        time.sleep(AUTOPLAY_PAUSE)
-        hand = self.player.hand
-        hand.sort()
-        if (len(last_play) == 0):
-            # play lowest card
-            return [hand[0]]
-        elif (len(last_play) == 1):
-            if last_play[0] // 4 == 12:
-                # it was a two, you get to go again
-                return [hand[0]]
-            # play lowest card that beats it
-            for card in hand:
-                if card >= last_play[0]:
-                    return [card]
-        else:
-            return []
+        return self.strategy(self.player.hand, last_play)
 
     def disconnect(self):
-        """Disconnect socket from server."""
-        try:
-            self.sockobj.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            pass
-        self.sockobj.close()
+        """Disconnect socket from server. Safe to call from other threads."""
+        if self.in_other_thread():
+            self.loop.call_soon_threadsafe(self.disconnect)
+            return
+        self.run = False
+        if self.transport:
+            self.transport.close()
         logging.info('Client %s succesfully closed', self.name)
         if self.gui: self.gui.print_msg("Disconnected from server")
 
@@ -432,10 +645,13 @@ def usage():
     print(__doc__)
 
 def parse_cmd_args(argv):
-    manual, name = False, 'chipjack'    # defaults
+    manual, name = False, 'chipjack'   # defaults
+    binary, delta, lobby_delta = False, False, False
+    scrollback = clientgui.SCROLLBACK
+    timing, spectate = False, False
 
     try:
-        opts, args = getopt.getopt(argv, 'hs:p:n:m', ['help', 'host', 'port', 'name', 'manual'])
+        opts, args = getopt.getopt(argv, 'hs:p:n:mbdlk:tw', ['help', 'host', 'port', 'name', 'manual', 'binary', 'delta', 'lobbydelta', 'scrollback', 'timing', 'watch'])
 
         for opt, arg in opts:
             if opt in ('-h', '--help'):
@@ -449,18 +665,34 @@ def parse_cmd_args(argv):
                 manual = True
             elif opt in ('-n', '--name'):
                 name = arg
+            elif opt in ('-b', '--binary'):
+                binary = True
+            elif opt in ('-d', '--delta'):
+                delta = True
+            elif opt in ('-l', '--lobbydelta'):
+                lobby_delta = True
+            elif opt in ('-k', '--scrollback'):
+                scrollback = int(arg)
+                if scrollback < 1:
+                    raise ValueError('scrollback must be at least 1')
+            elif opt in ('-t', '--timing'):
+                timing = True
+            elif opt in ('-w', '--watch'):
+                spectate = True
             else:
                 raise getopt.GetoptError(msg='Invalid command line option')
 
-    except getopt.GetoptError as ex:
-        print(ex.msg)
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex.msg if isinstance(ex, getopt.GetoptError) else ex)
         usage()
         sys.exit()
     else:
-        return manual, name
+        return (manual, name, binary, delta, lobby_delta, scrollback, timing,
+            spectate)
 
 def main(argv):
-    manual, name = parse_cmd_args(argv)
+    (manual, name, binary, delta, lobby_delta, scrollback, timing,
+        spectate) = parse_cmd_args(argv)
     auto = not manual
     client = None
 
@@ -472,33 +704,15 @@ def main(argv):
             logging.basicConfig(level=logging.DEBUG, format=FORMAT,
                 filename='client.log')
             logging.info('Logging started')
-        client = Client(name, common.HOST, common.PORT, auto=auto)
-
-        # join the server
-        client.send_msg('[cjoin|{}]'.format(name.ljust(8)))
-        while not client.msgs:
-            client.recv_msgs()
-
-        msg = client.get_msg()
-        assert msg, 'No msg, self.msgs = '.format(client.msgs)
-        while message.msg_type(msg) != 'sjoin':
-            # logging.warn('Client {} received an unexpected message: {}'.format(client.name, msg))
-            msg = client.get_msg()
-        
-        # validate msg
-        name = message.fields(msg)[0].strip()
-        client.player = common.Player(name)
-        logging.info('Client {} successfully joined with name {}'.format(client.name, name))
-        if client.gui:
-            client.gui.print_msg("Succesfully joined server with name {}".format(
-                client.player.name))
+        client = Client(name, auto=auto, binary=binary, delta=delta,
+            lobby_delta=lobby_delta, scrollback=scrollback, timing=timing,
+            spectate=spectate)
 
-        client.game_loop()
+        # join the server and play until disconnected
+        asyncio.run(client.play(common.HOST, common.PORT))
 
         if client.gui: client.gui.print_msg("Quitting, press any key to confirm")
 
-        client.disconnect()
-
         if client.gui:
             client.gui.curses_thread.join()
         logging.info("Client %s quitting", client.name)
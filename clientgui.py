@@ -1,14 +1,25 @@
-"""Text-based GUI displayed in terminal using Python curses module."""
+"""Text-based GUI displayed in terminal using Python curses module.
+
+Update methods only draw into curses' virtual screen and mark the windows
+they changed dirty. A render thread copies the dirty windows to the
+terminal at most FRAME_RATE times a second with a single doupdate, so a
+burst of updates costs one physical refresh. Lines are only redrawn when
+their text changed.
+
+Log messages, chat and play history are kept in ring buffers of the last
+SCROLLBACK lines, so a long running client uses constant memory. '[' and
+']' scroll them back and forward.
+"""
 
 import message
-import client
 import curses
 import curses.textpad
 import threading
-import queue
 import subprocess
 import sys
 import time
+import itertools
+import collections
 
 SCRN_WIDTH = 100
 MSGS_HEIGHT = 11
@@ -24,14 +35,28 @@ PLAY_INPUT_WIDTH = SCRN_WIDTH // 4
 BEAT_WIDTH = SCRN_WIDTH - SEND_CHAT_WIDTH - PLAY_INPUT_WIDTH
 PLAY_CHAT_HEIGHT = 10
 INPUT_HEIGHT = 5
+FRAME_RATE = 20     # most physical screen updates a second
+SCROLLBACK = 500    # lines of messages, chat and plays kept
 SCRN_HEIGHT = MSGS_HEIGHT + TABLE_HEIGHT + HAND_HEIGHT + \
     PLAY_CHAT_HEIGHT + INPUT_HEIGHT
 
 HELP_MSG = """
 HELP: When it is your turn, you can choose cards to play be typing their index.
 To play the     cards press enter. Press 'T' to chat and 'Q' to quit.
+Press '[' and ']' to scroll messages, chat and plays back and forward.
+Press 'L' for latencies.
 """.strip().replace('\n', ' ')
 
+SUITS = [
+    '\u2663',   # clubs
+    '\u2666',   # diamonds
+    '\u2665',   # hearts
+    '\u2660',   # spades
+    ]
+VALUES = ['3','4','5','6','7','8','9','10','J','Q','K','A','2']
+# card number -> text shown for it
+CARD_GLYPHS = [value + suit for value in VALUES for suit in SUITS]
+
 def main():
     gui = ClientGui()
 
@@ -43,17 +68,22 @@ class ClientGui():
     players = []        
 
     # Set-up
-    def __init__(self, client):
+    def __init__(self, client, scrollback=SCROLLBACK):
         self.client = client
-        self.prev_last_play = []
-        self.msgs = []
-        self.chat_msgs = []
-        self.play_history = []
+        self.msgs = collections.deque(maxlen=scrollback)
+        self.chat_msgs = collections.deque(maxlen=scrollback)
+        self.play_history = collections.deque(maxlen=scrollback)
+        self.scroll = 0         # lines scrolled back from the newest
         self.hand = []
+        self.hand_strs = None   # (hand, indexes line, cards line) drawn last
         self.play = []
-        self.pending_play = queue.Queue()
         self.chatting = False
         self.lock = threading.RLock()
+        self.dirty = set()      # windows changed since the last frame
+        self.lines = {}         # (window, line) -> text drawn there
+        self.changed = threading.Event()    # set when a window gets dirty
+        self.render_thread = threading.Thread(target=self.render_loop,
+            daemon=True)
         self.curses_thread = threading.Thread(target=self.curses_wrapper)
         self.curses_thread.start()
     
@@ -116,9 +146,75 @@ class ClientGui():
     def curses_wrapper(self):
         curses.wrapper(self.curses_loop)
 
+    # Rendering
+    def mark_dirty(self, win):
+        with self.lock:
+            self.dirty.add(win)
+        self.changed.set()
+
+    def put(self, win, y, text):
+        """Draw text on line y of win, if it isn't there already."""
+        with self.lock:
+            if self.lines.get((win, y)) != text:
+                self.lines[(win, y)] = text
+                win.addstr(y, 2, text)
+                self.mark_dirty(win)
+
+    def render(self):
+        """Copy the dirty windows to the terminal in one update."""
+        with self.lock:
+            self.changed.clear()
+            if not self.dirty:
+                return
+            for win in self.dirty:
+                win.noutrefresh()
+            self.dirty.clear()
+            curses.doupdate()
+
+    def draw_scrollback(self, win, lines, bottom, width):
+        """Draw the newest of lines, scrolled back self.scroll lines, from
+        line bottom of win up to line 2.
+        """
+        rows = bottom - 1
+        scroll = min(self.scroll, max(len(lines) - rows, 0))
+        i = bottom
+        for line in itertools.islice(reversed(lines), scroll, scroll + rows):
+            self.put(win, i, line[:width].ljust(width))
+            i -= 1
+
+    def draw_msgs(self):
+        self.draw_scrollback(self.msgs_win, self.msgs, MSGS_HEIGHT - 3,
+            SCRN_WIDTH - 4)
+
+    def draw_chat(self):
+        self.draw_scrollback(self.chat_win, self.chat_msgs,
+            PLAY_CHAT_HEIGHT - 2, CHAT_WIDTH - 4)
+
+    def draw_plays(self):
+        self.draw_scrollback(self.play_win, self.play_history,
+            PLAY_CHAT_HEIGHT - 2, PLAY_WIDTH - 3)
+
+    def scroll_by(self, lines):
+        """Scroll the scrollback windows lines back, forward if negative."""
+        with self.lock:
+            longest = max(len(self.msgs), len(self.chat_msgs),
+                len(self.play_history))
+            self.scroll = min(max(self.scroll + lines, 0), longest)
+            self.draw_msgs()
+            self.draw_chat()
+            self.draw_plays()
+
+    def render_loop(self):
+        while self.client.run:
+            if self.changed.wait(1):
+                self.render()
+                # let updates pile up until the next frame
+                time.sleep(1 / FRAME_RATE)
+
     # Main loop
     def curses_loop(self, stdscr):
         self.build_windows(stdscr)
+        self.render_thread.start()
         self.print_msg("If this GUI crashes, type 'reset' into your shell to get it back to normal")
         while self.client.run:
             c = self.play_win.getkey()
@@ -138,7 +234,7 @@ class ClientGui():
                 self.print_msg('Sent chat message: {}'.format(text))
             elif c.upper() == 'Q':
                 # Q for quit
-                self.client.run = False
+                self.client.disconnect()
                 break
             elif c.upper() == 'H':
                 # H for help
@@ -146,9 +242,16 @@ class ClientGui():
                     len(HELP_MSG), SCRN_WIDTH-5)]
                 for msg in help_msgs:
                     self.print_msg(msg)
+            elif c == 'L':
+                # L for latency
+                self.client.show_timings()
+            elif c == '[':
+                self.scroll_by(1)
+            elif c == ']':
+                self.scroll_by(-1)
             elif ord(c) == curses.ascii.NL:
                 # Enter key pressed
-                self.pending_play.put(self.play)
+                self.client.submit_play(self.play)
                 self.print_msg('Played {}'.format(
                     self.print_cards(self.play)))
                 self.play = []
@@ -182,71 +285,56 @@ class ClientGui():
             return key
 
     # Update functions
-    def update(self, player_stat_list, prev_player_stat_list, last_play,
-        winner=None, asshole=False):
-        self.lock.acquire()
+    def update(self, diff):
+        """Draw what changed at the table, diff is a client.TableDiff."""
+        with self.lock:
+            self.update_locked(diff)
+        return False
 
-        psl = player_stat_list
-        ppsl = prev_player_stat_list
+    def update_locked(self, diff):
+        psl = diff.player_stat_list
 
-        self.update_players(psl)
-        self.update_play_to_beat(last_play)
+        if diff.seats:
+            self.update_players(psl, diff.seats)
+        if diff.play is not None:
+            self.update_play_to_beat(diff.play)
 
-        whose_turn = client.current_turn_num(psl)
-        if ppsl:
-            if last_play == []:
+        if diff.prev_turn is not None:
+            if diff.play == []:
                 # they won the round
-                self.update_plays(psl[whose_turn].name, 'won the round')
-                #pass
-            elif last_play != self.prev_last_play:
+                self.update_plays(psl[diff.turn].name, 'won the round')
+            elif diff.play:
                 # someone played some cards, and someone may have been skipped
-                who_played = client.current_turn_num(ppsl)
-                if who_played == client.current_turn_num(psl):
+                who_played = diff.prev_turn
+                if who_played == diff.turn:
                     # they must have played a two
                     self.update_plays(psl[who_played].name, 'played a 2')
-                    # print('{} played a 2!'.format(psl[who_played].name))
-                self.update_plays(psl[who_played].name, 'played', last_play)
-                # print('{} played {}'.format(psl[who_played].name, 
-                #    self.print_cards(last_play)))
-                if ([c // 4 for c in last_play] == 
-                    [c // 4 for c in self.prev_last_play]):
-                    # someone got skipped
+                self.update_plays(psl[who_played].name, 'played', diff.play)
+                if diff.skipped:
                     self.update_plays('Someone', 'got skipped')
-                    # print('Someone got skipped!')
+            elif diff.turn == diff.prev_turn:
+                # same cards to beat and turn, they played bad cards
+                self.print_msg('{} is gonna try that turn again'.format(
+                    psl[diff.turn].name))
             else:
                 # same cards to beat as before, last player must have passed
-                # unless the last player played bad cards?
-                who_passed = client.current_turn_num(ppsl)
-                if client.current_turn_num(psl) == who_passed:
-                    # they played bad cards
-                    self.print_msg('{} is gonna try that turn again'.format(
-                        psl[who_passed].name))
-                    #print('{} is gonna try that turn again'.format(
-                    #    psl[who_passed].name))
-                else:
-                    self.update_plays(psl[who_passed].name, 'passed')
-                    # print('{} passed'.format(psl[who_passed].name))
+                self.update_plays(psl[diff.prev_turn].name, 'passed')
 
-        if winner:
-            self.update_plays(winner.name, 'has gone out')
-            # print("Player {} has gone out!".format(winner.name))
-        
-        if asshole:
-            self.update_plays(asshole.name, 'is the scumbag')
-            self.print_msg('Hand over. New hand starting')
-        
-            # print('Game over. {} is the asshole'.format(asshole.name))
-            # self.prev_last_play = []
+        if diff.out:
+            self.update_plays(diff.out.name, 'has gone out')
 
-        self.prev_last_play = last_play
-        self.lock.release()
-        return False
+        if diff.hand_over:
+            if diff.scumbag:
+                self.update_plays(diff.scumbag.name, 'is the scumbag')
+            self.print_msg('Hand over. New hand starting')
 
     def update_play(self):
-        self.lock.acquire()
-        self.play_input_win.addstr(3, 2, 
-                self.print_cards(self.play[:4]).ljust(PLAY_INPUT_WIDTH - 3))
-        self.play_input_win.refresh()
+        with self.lock:
+            self.update_play_locked()
+
+    def update_play_locked(self):
+        self.put(self.play_input_win, 3,
+            self.print_cards(self.play[:4]).ljust(PLAY_INPUT_WIDTH - 3))
 
         hand_indexes = [self.hand.index(c) for c in self.play]
         play_str = ''
@@ -263,125 +351,95 @@ class ClientGui():
                 else:
                     play_str += ('     ')
 
-        self.hand_win.addstr(6, 2, play_str.ljust(HAND_WIDTH-3))
-        self.hand_win.refresh()
-        self.lock.release()
+        self.put(self.hand_win, 6, play_str.ljust(HAND_WIDTH-3))
 
     def update_chat(self, who, msg):
-        self.lock.acquire()
+        with self.lock:
+            self.update_chat_locked(who, msg)
+
+    def update_chat_locked(self, who, msg):
         full_msg = "{}: {}".format(who.strip(), msg.strip())
         if (len(full_msg) > CHAT_WIDTH - 4):
             self.chat_msgs.append(full_msg[:CHAT_WIDTH-4])
             self.chat_msgs.append("    " + full_msg[CHAT_WIDTH-4:])
         else:
             self.chat_msgs.append("{}: {}".format(who.strip(), msg.strip()))
-        i = PLAY_CHAT_HEIGHT - 2
-        for msg in reversed(self.chat_msgs):
-            self.chat_win.addstr(i, 2, msg[:CHAT_WIDTH-4].ljust(CHAT_WIDTH-4))
-            i -= 1
-            if i == 1:
-                break
-        self.chat_win.refresh()
-        self.lock.release()
+        self.draw_chat()
 
     def print_msg(self, msg):
-        self.lock.acquire()
-        self.msgs.append(msg)
-        i = MSGS_HEIGHT - 3
-        for msg in reversed(self.msgs):
-            self.msgs_win.addstr(i, 2, msg[:SCRN_WIDTH-4].ljust(SCRN_WIDTH-4))
-            i -= 1
-            if i == 1:
-                break
-        self.msgs_win.refresh()
-        self.lock.release()
+        with self.lock:
+            self.msgs.append(msg)
+            self.draw_msgs()
 
     def print_card(self, card):
         assert(card >= 0 and card < 52)
-        suites = [
-            '\u2663',   # clubs
-            '\u2666',   # diamonds
-            '\u2665',   # hearts
-            '\u2660',   # spades
-        ]
-        values = ['3','4','5','6','7','8','9','10','J','Q','K','A','2']
-
-        suite = suites[card % 4]
-        value = values[card // 4]
-
-        return value + suite
+        return CARD_GLYPHS[card]
 
     def print_cards(self, cards):
         if not cards:
             return ''
-        return '   '.join([self.print_card(card) for card in cards])
+        return '   '.join([CARD_GLYPHS[card] for card in cards])
 
     def print_hand(self, hand):
-        self.lock.acquire()
+        with self.lock:
+            self.print_hand_locked(hand)
+
+    def print_hand_locked(self, hand):
         if not hand:
-            self.hand_win.addstr(3, 2, ' '.ljust(HAND_WIDTH - 3))
-            self.hand_win.addstr(5, 2, ' '.ljust(HAND_WIDTH - 3))
-            self.hand_win.refresh()
-            self.lock.release()
+            self.put(self.hand_win, 3, ' '.ljust(HAND_WIDTH - 3))
+            self.put(self.hand_win, 5, ' '.ljust(HAND_WIDTH - 3))
             return
         hand.sort()
         self.hand = hand
-        if not hand:
-            return
-        hand_indexes = ''
-        for i, card in enumerate(hand):
-            if card // 4 == 7:
-                # it's a 10, we need more space after it for extra digit
-                hand_indexes += self.CARD_INDEX[i]
-                hand_indexes += '     ' 
-            else:
-                hand_indexes += self.CARD_INDEX[i]
-                hand_indexes += '    '
-        self.hand_win.addstr(3, 2, hand_indexes.ljust(HAND_WIDTH-3))
-        self.hand_win.addstr(5, 2, self.print_cards(hand).ljust(HAND_WIDTH-3))
-        self.hand_win.refresh()
-        self.lock.release()
-
-    def update_players(self, player_stat_list):
-        self.lock.acquire()
-        psl = player_stat_list
-        for i, p in enumerate(psl):
-            self.table_win.addstr(i+3, 2, '{}{}{}{}'.format(p.name.ljust(12), 
-                str(p.num_cards).ljust(14), p.status.ljust(10), str(p.strikes)))
-        self.table_win.refresh()
-        self.lock.release()
+        key = tuple(hand)
+        if not self.hand_strs or self.hand_strs[0] != key:
+            hand_indexes = ''
+            for i, card in enumerate(hand):
+                if card // 4 == 7:
+                    # it's a 10, we need more space after it for extra digit
+                    hand_indexes += self.CARD_INDEX[i]
+                    hand_indexes += '     '
+                else:
+                    hand_indexes += self.CARD_INDEX[i]
+                    hand_indexes += '    '
+            self.hand_strs = (key, hand_indexes.ljust(HAND_WIDTH-3),
+                self.print_cards(hand).ljust(HAND_WIDTH-3))
+        self.put(self.hand_win, 3, self.hand_strs[1])
+        self.put(self.hand_win, 5, self.hand_strs[2])
+
+    def update_players(self, player_stat_list, seats=None):
+        """Draw the players in seats, all of them if seats is None."""
+        with self.lock:
+            psl = player_stat_list
+            if seats is None:
+                seats = range(len(psl))
+            for i in seats:
+                p = psl[i]
+                self.put(self.table_win, i+3, '{}{}{}{}'.format(
+                    p.name.ljust(12), str(p.num_cards).ljust(14),
+                    p.status.ljust(10), str(p.strikes)))
 
     def update_plays(self, name, play, cards=None):
-        if cards:
-            self.play_history.append('{} {} {}'.format(name, play,
-                self.print_cards(cards)).ljust(PLAY_WIDTH-3))
-        else:
-            self.play_history.append('{} {}'.format(name, play).ljust(
-                PLAY_WIDTH-3))
-        i = PLAY_CHAT_HEIGHT - 2
-        for play in reversed(self.play_history):
-            self.play_win.addstr(i, 2, play)
-            i -= 1
-            if i == 1:
-                break
-        self.play_win.refresh()
+        with self.lock:
+            if cards:
+                self.play_history.append('{} {} {}'.format(name, play,
+                    self.print_cards(cards)).ljust(PLAY_WIDTH-3))
+            else:
+                self.play_history.append('{} {}'.format(name, play).ljust(
+                    PLAY_WIDTH-3))
+            self.draw_plays()
 
     def update_play_to_beat(self, play):
-        self.lock.acquire()
-        self.beat_win.addstr(3, 2, self.print_cards(play).ljust(BEAT_WIDTH - 3))
-        self.beat_win.refresh()
-        self.lock.release()
+        self.put(self.beat_win, 3, self.print_cards(play).ljust(BEAT_WIDTH - 3))
 
     def update_lobby(self, lobby):
-        self.lock.acquire()
-        for i in range(2, LOBBY_HEIGHT-2):
-            self.lobby_win.addstr(i, 2, ' '*(LOBBY_WIDTH-3))
-        for i, name in enumerate(lobby[:LOBBY_HEIGHT-4]):
-            self.lobby_win.addstr(i+2, 2, name)
-        if len(lobby) > LOBBY_HEIGHT - 3:
-            self.lobby_win.addstr(LOBBY_HEIGHT-2, 2, '...')
-        self.lobby_win.refresh()
-        self.lock.release()
+        with self.lock:
+            # only lines whose name changed get drawn
+            for i in range(2, LOBBY_HEIGHT-2):
+                name = lobby[i-2] if i - 2 < len(lobby) else ''
+                self.put(self.lobby_win, i, name.ljust(LOBBY_WIDTH-3))
+            more = '...' if len(lobby) > LOBBY_HEIGHT - 3 else ''
+            self.put(self.lobby_win, LOBBY_HEIGHT-2, more.ljust(LOBBY_WIDTH-3))
 
 if __name__ == '__main__':
     main()
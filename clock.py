@@ -0,0 +1,95 @@
+"""Clocks and the timer scheduler used by the server and clients.
+
+Everything that waits for a timeout schedules a callback on a Scheduler
+instead of reading the time itself, so the same code runs against the real
+clock or against a SimClock that jumps straight to the next timer.
+"""
+
+import time
+import heapq
+
+class RealClock:
+    """Wall clock time, never goes backwards."""
+
+    def time(self):
+        return time.monotonic()
+
+class SimClock:
+    """Simulated time that only moves when it is advanced."""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, when):
+        self.now = max(self.now, when)
+
+class Timer:
+    """Callback scheduled with Scheduler.call_later."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+class Scheduler:
+    """Heap of timers run against a clock."""
+
+    def __init__(self, clock=None):
+        self.clock = clock or RealClock()
+        self.timers = []            # heap of pending Timers
+
+    def time(self):
+        return self.clock.time()
+
+    def call_at(self, deadline, callback, *args):
+        """Run callback(*args) once the clock reaches deadline."""
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds."""
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def next_deadline(self):
+        """Return deadline of the next pending timer, None if there is none."""
+        while self.timers and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+        return self.timers[0].deadline if self.timers else None
+
+    def timeout(self, timeout):
+        """Shorten timeout so polling wakes up for the next timer."""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return timeout
+        left = max(deadline - self.time(), 0)
+        return left if timeout is None else min(timeout, left)
+
+    def run_timers(self):
+        """Run the timers that are due."""
+        now = self.time()
+        while self.timers and self.timers[0].deadline <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+    def advance(self):
+        """Move a simulated clock to the next timer and run everything due
+        then. Returns False if no timers are left.
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return False
+        self.clock.advance_to(deadline)
+        self.run_timers()
+        return True
@@ -1,5 +1,5 @@
-"""Deck, Player, and Table classes used by client and server to play Warlords
-and Scumbags card game.
+"""Deck, Player, and Table classes and the automated strategy used by client
+and server to play Warlords and Scumbags card game.
 """
 
 from random import shuffle
@@ -11,40 +11,52 @@ PORT = 36716
 TABLESIZE = 7
 LOBBYSIZE = 35
 
-def setup_logging(to_file=False):
+def setup_logging(to_file=False, level=logging.DEBUG):
     FORMAT = '%(filename)s: %(message)s'
     # To log to file, use filename='log.log' argument
     if to_file:
-        logging.basicConfig(level=logging.DEBUG, format=FORMAT,
-            filename='log.log')
+        logging.basicConfig(level=level, format=FORMAT, filename='log.log')
     else:
-        logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+        logging.basicConfig(level=level, format=FORMAT)
     logging.info('Logging started')
 
 class Deck:
-    """A deck of cards, which can be shuffled and dealt.
+    """A deck of cards, which can be shuffled and dealt. Shuffling starts
+    from a fresh copy of the shared sorted CARDS, and dealing hands the
+    cards out, so a deck holds no cards between deals.
     """
     DECK_SIZE = 52
-    
+    CARDS = tuple(range(DECK_SIZE))
+
+    __slots__ = ('cards',)
+
     def __init__(self):
-        self.cards = [x for x in range(self.DECK_SIZE)]
-    
-    def shuffle(self):
-        shuffle(self.cards)
-    
-    def deal(self, numplayers):
-        self.shuffle()
+        self.cards = None
+
+    def shuffle(self, rng=None):
+        # start from a sorted deck so a seed alone decides the deal
+        self.cards = list(self.CARDS)
+        if rng:
+            rng.shuffle(self.cards)
+        else:
+            shuffle(self.cards)
+
+    def deal(self, numplayers, rng=None):
+        self.shuffle(rng)
         handsize = self.DECK_SIZE // numplayers
         hands = [self.cards[i*handsize:(i+1)*handsize] 
             for i in range(numplayers)]
         for i in range(self.DECK_SIZE - handsize * numplayers):
             hands[i].append(self.cards[-1-i])
+        self.cards = None
         return hands
 
 class Player:
     """A player who has a hand of cards.
     """
 
+    __slots__ = ('hand', 'name', 'status', 'strikes')
+
     def __init__(self, name):
         self.hand = []
         self.name = name
@@ -81,13 +93,18 @@ class Player:
 class Table:
     """A table that holds players and tracks gameplay.
     """
+
+    __slots__ = ('players', 'winners', 'played_cards', 'turn',
+        'starting_round')
+    # deals are done in one go, so all tables can share a deck
+    deck = Deck()
+
     def __init__(self):
         self.players = []
         self.winners = []
         self.played_cards = []
         self.turn = 0
         self.starting_round = True
-        self.deck = Deck()
 
     def add_player(self, player):
         assert(isinstance(player, Player))
@@ -110,8 +127,8 @@ class Table:
         else:
             return self.played_cards[-1]
 
-    def deal(self):
-        hands = self.deck.deal(len(self.players))
+    def deal(self, rng=None):
+        hands = self.deck.deal(len(self.players), rng)
         assert(len(self.players) == len(hands))
         for i, player in enumerate(self.players): 
             player.pickup_hand(hands[i])
@@ -199,7 +216,7 @@ class Table:
             raise PlayerError(player, "tried to play cards when not at table", '31')
         for card in cards:
             if card not in player.hand:
-                raise PlayerError(player, "tried to play cards they don't have: {}, {}".format(str(card), repr(player.hand)), '14')
+                raise PlayerError(player, "tried to play cards they don't have: %s, %r", '14', card, tuple(player.hand))
         if player.status != 'a':
             raise PlayerError(player, "tried to play when not his turn", '15')
 
@@ -227,6 +244,26 @@ class Table:
                 raise PlayerError(player, "played cards without too low of a quantity", '13')
         return
 
+def lowest_card_strategy(hand, last_play):
+    """Default automated strategy: play the lowest single card that beats the
+    last play, pass on multiple cards.
+    """
+    hand.sort()
+    if (len(last_play) == 0):
+        # play lowest card
+        return [hand[0]]
+    elif (len(last_play) == 1):
+        if last_play[0] // 4 == 12:
+            # it was a two, you get to go again
+            return [hand[0]]
+        # play lowest card that beats it
+        for card in hand:
+            if card >= last_play[0]:
+                return [card]
+        return []
+    else:
+        return []
+
 class GameError(Exception):
     pass
 
@@ -236,17 +273,20 @@ class PlayerError(GameError):
     
     Attributes:
         player -- player who caused exception
-        msg -- what the player did wrong
+        msg -- what the player did wrong, formatted with args only when
+            the error is shown
 
     e.g. "Player JohnD: invalid cards played"
     """
-    def __init__(self, player, msg, strike_code='00'):
+    def __init__(self, player, msg, strike_code='00', *args):
         self.player = player
         self.msg = msg
         self.strike_code = strike_code
+        self.msg_args = args
 
     def __str__(self):
-        return "Player {}: {}".format(self.player.name, self.msg)
+        msg = self.msg % self.msg_args if self.msg_args else self.msg
+        return "Player {}: {}".format(self.player.name, msg)
 
 if __name__ == '__main__':
     d = Deck()
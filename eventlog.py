@@ -0,0 +1,131 @@
+"""Write-ahead log of the events that change game state, plus snapshots of
+the state, so a restarted server can rebuild its games.
+
+A state directory holds:
+
+    snapshot.json   latest snapshot, including the sequence number of the
+                    last event it covers
+    events.log      events logged since, one JSON array per line:
+                    [sequence number, event type, args...]
+
+Recovery loads the snapshot and replays the events after it, so it takes as
+long as the events logged in one snapshot interval, however long the games
+have been going. Events are batched in memory and written by a background
+thread, logging one costs the game loop a list append.
+"""
+
+import os
+import json
+import queue
+import logging
+import threading
+
+SNAPSHOT = 'snapshot.json'
+EVENTS = 'events.log'
+BATCHINTERVAL = 0.05    # seconds events are batched for before writing
+
+class EventLog:
+    """Appends events and snapshots to a state directory."""
+
+    def __init__(self, path, scheduler, seq=0, fsync=True):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.scheduler = scheduler
+        self.seq = seq              # sequence number of the last event
+        self.fsync = fsync          # fsync every batch and snapshot
+        self.batch = []
+        self.flush_timer = None
+        self.file = open(os.path.join(path, EVENTS), 'a')
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def append(self, *event):
+        self.seq += 1
+        self.batch.append((self.seq,) + event)
+        if not self.flush_timer:
+            self.flush_timer = self.scheduler.call_later(BATCHINTERVAL,
+                self.flush)
+
+    def flush(self):
+        """Hand the batched events to the writer thread."""
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.batch:
+            self.queue.put((self.write_events, self.batch))
+            self.batch = []
+
+    def snapshot(self, state):
+        """Save state dict, which covers every event logged so far, then
+        drop those events from the log.
+        """
+        self.flush()
+        self.queue.put((self.write_snapshot, dict(state, seq=self.seq)))
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            write, data = item
+            try:
+                write(data)
+            except OSError as ex:
+                logging.error('Event log write failed: %s', ex)
+
+    def write_events(self, events):
+        self.file.write(''.join([json.dumps(event, separators=(',', ':')) +
+            '\n' for event in events]))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def write_snapshot(self, state):
+        path = os.path.join(self.path, SNAPSHOT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        if self.fsync:
+            fd = os.open(self.path, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        # the snapshot covers everything logged so far, recovery skips
+        # events it covers if we crash before this
+        self.file.truncate(0)
+
+def recover(path):
+    """Return (latest snapshot dict or None, list of events logged after
+    it) from a state directory.
+    """
+    state = None
+    try:
+        with open(os.path.join(path, SNAPSHOT)) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        pass
+    seq = state['seq'] if state else 0
+    events = []
+    try:
+        with open(os.path.join(path, EVENTS)) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # torn write at the end of the log
+                    logging.warning('Event log ends in a partial event')
+                    break
+                if event[0] > seq:
+                    events.append(event)
+    except FileNotFoundError:
+        pass
+    return state, events
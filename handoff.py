@@ -0,0 +1,74 @@
+"""Hands a running server's sockets and game state over to a new server
+process on the same host, so the server can be upgraded without clients
+reconnecting.
+
+The new process connects to the old one's Unix socket and is sent:
+
+    +---------------+-----------+--------------------+---------------+
+    | state length  | fd count  | fds, in chunks     | state as JSON |
+    |      4B       |    4B     | of 1 byte + fds    |               |
+    +---------------+-----------+--------------------+---------------+
+
+then answers with a single byte once it has everything. Until then the old
+process keeps its sockets, so a failed handoff leaves it serving.
+"""
+
+import json
+import struct
+import socket
+
+HEADER = struct.Struct('!II')
+MAXFDS = 250    # fds per message, Linux allows at most 253
+ACK = b'k'
+ACKTIMEOUT = 10 # seconds the old server waits for the new one to confirm
+
+class HandoffError(Exception):
+    pass
+
+def recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise HandoffError('connection closed during handoff')
+        data += chunk
+    return data
+
+def send(sock, state, fds):
+    """Send state dict and list of file descriptors, then wait for the
+    receiver to confirm it got them.
+    """
+    data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data), len(fds)))
+    for i in range(0, len(fds), MAXFDS):
+        socket.send_fds(sock, [b'f'], fds[i:i+MAXFDS])
+    sock.sendall(data)
+    sock.settimeout(ACKTIMEOUT)
+    try:
+        if recv_exactly(sock, len(ACK)) != ACK:
+            raise HandoffError('handoff not confirmed')
+    except socket.timeout:
+        raise HandoffError('handoff not confirmed in time')
+
+def recv(sock):
+    """Receive (state dict, list of file descriptors) and confirm."""
+    length, count = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    fds = []
+    while len(fds) < count:
+        msg, chunk, flags, addr = socket.recv_fds(sock, 1, MAXFDS)
+        if not msg:
+            raise HandoffError('connection closed during handoff')
+        fds += chunk
+    state = json.loads(recv_exactly(sock, length).decode('utf-8'))
+    sock.sendall(ACK)
+    return state, fds
+
+def connect(path):
+    """Connect to the Unix socket of the server to take over from."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
@@ -0,0 +1,99 @@
+"""Logging that stays off the hot path.
+
+Log calls pass their arguments unformatted, wrapped in Lazy when building
+them costs something, so nothing is formatted for a disabled level. Records
+that do get through are put on a queue and formatted and written by a
+background thread. High-volume categories can have their own level and be
+sampled, e.g. the server's message traces on the 'server.msgs' logger.
+"""
+
+import queue
+import logging
+import logging.handlers
+
+class Lazy:
+    """Log argument formatted as str(func(*args)), only if the record gets
+    formatted.
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+class SampleFilter(logging.Filter):
+    """Lets one in every rate records through."""
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.count = 0
+
+    def filter(self, record):
+        self.count += 1
+        if self.count >= self.rate:
+            self.count = 0
+            return True
+        return False
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, leaving formatting to the writer thread.
+    Arguments must not change after logging them, only tracebacks are
+    rendered straight away.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+def parse_levels(spec):
+    """Parse 'logger=level,...' into dict of logger name -> level. The root
+    logger is called root.
+    """
+    levels = {}
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        level = logging.getLevelName(level.strip().upper())
+        if not sep or not isinstance(level, int):
+            raise ValueError('Invalid log level: {}'.format(item))
+        levels[name.strip()] = level
+    return levels
+
+def set_levels(levels):
+    for name, level in levels.items():
+        logger = logging.getLogger(None if name == 'root' else name)
+        logger.setLevel(level)
+
+def sample(name, rate):
+    """Log only one in every rate records of logger name."""
+    if rate > 1:
+        logging.getLogger(name).addFilter(SampleFilter(rate))
+
+def start():
+    """Move the root logger's handlers to a background thread, returns the
+    QueueListener to stop, None if there are no handlers to move.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        return None
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *root.handlers,
+        respect_handler_level=True)
+    root.handlers = [DeferredQueueHandler(records)]
+    listener.start()
+    return listener
+
+def stop(listener):
+    """Write out queued records and give the handlers back to the root
+    logger.
+    """
+    if listener:
+        listener.stop()
+        logging.getLogger().handlers = list(listener.handlers)
@@ -0,0 +1,230 @@
+"""Memory profiling with tracemalloc, attributing what is allocated to the
+subsystems of the server.
+
+A MemoryProfiler traces allocations NFRAMES deep and is asked for a
+snapshot every so often. Each snapshot is diffed against the one before and
+appended to <directory>/memory-<time>-<pid>.jsonl as one JSON line:
+
+    {"time": 1700000000.0, "traced": 1234567,
+     "subsystems": {"tables": [bytes, change], ...},
+     "growers": [["server.py:223", "network buffers", change, count], ...]}
+
+An allocation belongs to the subsystem of the innermost frame of its
+traceback that matches a rule in SUBSYSTEMS, or to other:
+
+    network buffers   connection input and output buffers, sockets
+    tables            the table, its deck, hands and played cards
+    lobby             the lobby, joining it and its updates
+    registry maps     connections and the maps from clients to players
+    logging           loggers, handlers and the log pipe
+    metrics           series and histogram buckets
+
+The growers since the first snapshot are what leaks look like, the server's
+admin memory command lists them. Tracing slows every allocation down,
+so profile when looking for a leak rather than all the time.
+"""
+
+import os
+import ast
+import json
+import time
+import fnmatch
+import warnings
+import tracemalloc
+import collections
+
+NFRAMES = 10        # frames kept of every allocation's traceback
+TOPGROWERS = 20     # growers written for every snapshot
+OTHER = 'other'
+
+# (subsystem, file, function) patterns, the first one matching the innermost
+# frame it can wins. Functions are qualified with their class.
+SUBSYSTEMS = [
+    ('logging', '*/logging/*', '*'),
+    ('logging', '*/logpipe.py', '*'),
+    ('metrics', '*/metrics.py', '*'),
+    ('network buffers', '*/asyncore.py', '*'),
+    ('network buffers', '*/asynchat.py', '*'),
+    ('network buffers', '*/socket.py', '*'),
+    ('network buffers', '*/binmessage.py', '*'),
+    ('network buffers', '*/server.py', 'PlayerHandler.add_*to_buffer'),
+    ('network buffers', '*/server.py', 'PlayerHandler.receive'),
+    ('network buffers', '*/server.py', 'PlayerHandler.handle_read'),
+    ('network buffers', '*/server.py', 'PlayerHandler.initiate_send'),
+    ('registry maps', '*/server.py', 'GameServer.register_player'),
+    ('registry maps', '*/server.py', 'GameServer.handle_accepted'),
+    ('registry maps', '*/server.py', 'GameServer.*orphan'),
+    ('registry maps', '*/server.py', 'GameServer.*_bot'),
+    ('registry maps', '*/pubsub.py', '*'),
+    ('lobby', '*/server.py', '*lobb*'),
+    ('lobby', '*/server.py', 'PlayerHandler.handle_cjoin'),
+    ('tables', '*/common.py', 'Table.*'),
+    ('tables', '*/common.py', 'Deck.*'),
+    ('tables', '*/common.py', 'Player.*_hand'),
+    ('tables', '*/message.py', '*table*'),
+    ('tables', '*/server.py', '*table*'),
+    ('tables', '*/server.py', '*game*'),
+    ('tables', '*/server.py', '*hand*'),
+    ('tables', '*/server.py', '*swap*'),
+    ('tables', '*/server.py', '*play*'),
+    ]
+
+def functions(filename):
+    """Return (first line, last line, qualified name) of every function in
+    the Python source filename, innermost functions last.
+    """
+    try:
+        with open(filename) as f, warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            tree = ast.parse(f.read(), filename)
+    except (OSError, SyntaxError, ValueError):
+        return []
+    found = []
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                    ast.ClassDef)):
+                name = prefix + child.name
+                if not isinstance(child, ast.ClassDef):
+                    found.append((child.lineno, child.end_lineno, name))
+                visit(child, name + '.')
+            else:
+                visit(child, prefix)
+    visit(tree, '')
+    return found
+
+class Attribution:
+    """Finds the subsystem of allocation tracebacks, caching what it finds
+    for frames and source files.
+    """
+
+    def __init__(self, rules=SUBSYSTEMS):
+        self.rules = rules
+        self.functions = {}     # filename -> functions(filename)
+        self.frames = {}        # (filename, lineno) -> subsystem or None
+
+    def function(self, filename, lineno):
+        """Qualified name of the innermost function around lineno."""
+        if filename not in self.functions:
+            self.functions[filename] = functions(filename)
+        name = ''
+        for first, last, qualname in self.functions[filename]:
+            if first <= lineno <= last:
+                name = qualname
+        return name
+
+    def frame(self, filename, lineno):
+        """Subsystem of the first rule matching the frame, or None."""
+        key = (filename, lineno)
+        if key not in self.frames:
+            self.frames[key] = None
+            for subsystem, file_pattern, function_pattern in self.rules:
+                if not fnmatch.fnmatch(filename, file_pattern):
+                    continue
+                if function_pattern == '*' or fnmatch.fnmatch(
+                        self.function(filename, lineno), function_pattern):
+                    self.frames[key] = subsystem
+                    break
+        return self.frames[key]
+
+    def subsystem(self, traceback):
+        """Subsystem of the innermost frame of traceback a rule matches."""
+        for frame in reversed(traceback):
+            subsystem = self.frame(frame.filename, frame.lineno)
+            if subsystem:
+                return subsystem
+        return OTHER
+
+def where(traceback):
+    """Short file:line of the innermost frame of traceback."""
+    frame = traceback[-1]
+    return '{}:{}'.format(os.path.basename(frame.filename), frame.lineno)
+
+class MemoryProfiler:
+    """Takes tracemalloc snapshots and writes what changed between them."""
+
+    def __init__(self, directory, nframes=NFRAMES, top=TOPGROWERS):
+        self.path = os.path.join(directory, 'memory-{}-{}.jsonl'.format(
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        self.nframes = nframes
+        self.top = top
+        self.attribution = Attribution()
+        self.baseline = None    # first snapshot, growers are measured from
+        self.previous = None    # last snapshot
+        self.started = False    # whether tracemalloc was started by us
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.nframes)
+            self.started = True
+        self.baseline = self.previous = self.take()
+
+    def stop(self):
+        """Stop tracing, returns list of files written."""
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+        self.baseline = self.previous = None
+        return [self.path] if os.path.exists(self.path) else []
+
+    def take(self):
+        """Snapshot of allocations, leaving out tracemalloc's own and
+        everything the profiler allocated.
+        """
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__, all_frames=True),
+            ])
+
+    def compare(self, snapshot, old):
+        """Return bytes and change of every subsystem and the growers, as
+        (where, subsystem, change, count change), biggest first.
+        """
+        subsystems = collections.defaultdict(lambda: [0, 0])
+        growers = collections.defaultdict(lambda: [0, 0])
+        for stat in snapshot.compare_to(old, 'traceback'):
+            subsystem = self.attribution.subsystem(stat.traceback)
+            subsystems[subsystem][0] += stat.size
+            subsystems[subsystem][1] += stat.size_diff
+            if stat.size_diff:
+                grower = growers[where(stat.traceback), subsystem]
+                grower[0] += stat.size_diff
+                grower[1] += stat.count_diff
+        growers = sorted(((place, subsystem, change, count)
+            for (place, subsystem), (change, count) in growers.items()
+            if change > 0), key=lambda grower: grower[2], reverse=True)
+        return dict(subsystems), growers
+
+    def snapshot(self):
+        """Take a snapshot and append what changed since the last one to
+        the report. Returns the report line.
+        """
+        snapshot = self.take()
+        subsystems, growers = self.compare(snapshot, self.previous)
+        self.previous = snapshot
+        report = {'time': time.time(),
+            'traced': sum(size for size, change in subsystems.values()),
+            'subsystems': subsystems, 'growers': growers[:self.top]}
+        line = json.dumps(report, separators=(',', ':')) + '\n'
+        with open(self.path, 'a') as f:
+            f.write(line)
+        return line
+
+    def describe(self, count=TOPGROWERS):
+        """Text table of the subsystems and the top count growers since the
+        first snapshot.
+        """
+        subsystems, growers = self.compare(self.take(), self.baseline)
+        lines = ['{:<16} {:>10} {:>10}'.format('subsystem', 'bytes',
+            'growth')]
+        for subsystem, (size, change) in sorted(subsystems.items(),
+                key=lambda item: item[1][1], reverse=True):
+            lines.append('{:<16} {:>10} {:>+10}'.format(subsystem, size,
+                change))
+        lines.append('')
+        lines.append('{:<24} {:<16} {:>10} {:>8}'.format('where',
+            'subsystem', 'growth', 'blocks'))
+        for place, subsystem, change, blocks in growers[:count]:
+            lines.append('{:<24} {:<16} {:>+10} {:>+8}'.format(place,
+                subsystem, change, blocks))
+        return ''.join(line + '\n' for line in lines)
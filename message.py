@@ -5,20 +5,47 @@ import common
 import copy
 
 # Message types
-smsg_types = ['slobb', 'stabl', 'sjoin', 'shand', 'strik', 'schat', 'swapw', 'swaps']
-cmsg_types = ['cjoin','cchat','cplay','chand','cswap']
+smsg_types = ['slobb', 'stabl', 'sjoin', 'shand', 'strik', 'schat', 'swapw', 'swaps',
+    'ssnap', 'sdelt', 'sldel', 'spong', 'sping', 'stime']
+cmsg_types = ['cjoin','cchat','cplay','chand','cswap','cresy','cping','cpong',
+    'cspec']
+
+# Capability name sent in cjoin/sjoin to negotiate delta table updates
+DELTA_CAPABILITY = 'delta'
+# Capability name sent in cjoin/sjoin to negotiate lobby add/remove updates
+LOBBY_DELTA_CAPABILITY = 'lobbydelta'
+# Capability name sent in cjoin/sjoin to negotiate pings and server timings
+TIMING_CAPABILITY = 'timing'
+# Client messages the server reports its timings for with an stime
+TIMED_TYPES = ('cplay', 'cswap', 'chand')
+# Largest time in an stime, in microseconds
+MAX_MICROS = 999999
+# Table update sequence numbers wrap around at this value
+SEQ_MOD = 100000
 
 # Set-up regular expressions for validating messages
 gen_msg_regex = '\[({0})(\|.*)*\]'.format('|'.join(cmsg_types + smsg_types))
 msg_field_regex = '(?<=\|)[\w\ ]*(?=[\]\|])'
+name_list_regex = '([a-zA-Z_]\w{0,7}(,[a-zA-Z_]\w{0,7})*)?'
+seat_regex = '(?:[apwdl][0-3]:(?=.{8}:)[a-zA-Z_]\w{0,7} *:[01]\d|e0: {8}:00)'
 type_regexs = {
-    'cjoin': '^(?=.{16}$)\[cjoin\|[a-zA-Z_]\w{0,7} *\]$',
+    'cjoin': '^\[cjoin\|(?=[\w ]{8}[\]|])[a-zA-Z_]\w{0,7} *(\|[a-z]+(,[a-z]+)*)?\]$',
     'cchat': '^(?=.{71}$)\[cchat\|.{63}\]$',
     'cplay': '^(?=.{19}$)\[cplay\|([0-5]\d,){3}[0-5]\d\]$',
     'chand': '^\[chand\]$',
     'cswap': '^(?=.{10}$)\[cswap\|[0-5]\d\]$',
-    'slobb': '^((?=.{9,317}$)\[slobb\|((?=.{8}[\]|,])[a-zA-Z_]\w{0,7} *,)*(?=.{8}[\]|,])[a-zA-Z_]\w{1,7} *\]|\[slobb\|\])$',
-    'stabl': '^(?=.{126}$)\[stabl\|([\a\p\w\d\e][0-3]:(?=.{8}:)[a-zA-Z_]\w{1,7} *:[01]\d,){6}[\a\p\w\d\e][0-3]:(?=.{8}:)[a-zA-Z_]\w{1,7} *:[01]\d\|([0-5]\d,){3}[0-5]\d\|[01]\]$'
+    'slobb': '^(?=.{10,330}$)\[slobb\|\d\d\|(((?=[\w ]{8},)[a-zA-Z_]\w{0,7} *,)*(?=[\w ]{8}\])[a-zA-Z_]\w{0,7} *)?\]$',
+    'stabl': '^(?=.{{126}}$)\[stabl\|({0},){{6}}{0}\|([0-5]\d,){{3}}[0-5]\d\|[01]\]$'.format(seat_regex),
+    'ssnap': '^(?=.{{132}}$)\[ssnap\|\d{{5}}\|({0},){{6}}{0}\|([0-5]\d,){{3}}[0-5]\d\|[01]\]$'.format(seat_regex),
+    'sdelt': '^\[sdelt\|\d{{5}}(\|([0-6]{0}|p([0-5]\d,){{3}}[0-5]\d|r[01]))*\]$'.format(seat_regex),
+    'sldel': '^\[sldel\|{0}\|{0}\]$'.format(name_list_regex),
+    'cresy': '^\[cresy\]$',
+    'cping': '^\[cping\|\d{5}\]$',
+    'cpong': '^\[cpong\|\d{5}\]$',
+    'cspec': '^\[cspec\|\d\d\|[01]\]$',
+    'sping': '^\[sping\|\d{5}\]$',
+    'spong': '^\[spong\|\d{5}\]$',
+    'stime': '^\[stime\|c(play|swap|hand)\|\d{6}\|\d{6}\]$'
     }
 
 compiled_type_regexs = {}
@@ -42,12 +69,30 @@ class PlayerStatus:
     PlayerStatus.num_cards    -->     number of cards player has in hand
     """
 
+    __slots__ = ('status', 'strikes', 'name', 'num_cards')
+
     def __init__(self):
         self.status = ''
         self.strikes = -1
         self.name = ''
         self.num_cards = -1
 
+def empty_player_stat():
+    """Return PlayerStatus for an empty seat."""
+    player_stat = PlayerStatus()
+    player_stat.status = 'e'
+    player_stat.strikes = 0
+    player_stat.num_cards = 0
+    return player_stat
+
+def capabilities(msg):
+    """Return list of optional capabilities listed in a cjoin or sjoin."""
+    assert(msg_type(msg) in ('cjoin', 'sjoin'))
+    msg_fields = fields(msg)
+    if len(msg_fields) < 2 or not msg_fields[1]:
+        return []
+    return msg_fields[1].split(',')
+
 def split_buffer_into_msgs(buff):
     """Takes buffer, returns list of messages in it."""
     msgs = buff[1:-1].split('][')
@@ -127,6 +172,24 @@ def slobb_to_lobby(msg):
     lobby = [n.strip() for n in lobby]
     return lobby
 
+def lobby_changes_to_sldel(added, removed):
+    """Convert lists of names added to and removed from the lobby to a lobby
+    delta message.
+    """
+    return '[sldel|{}|{}]'.format(','.join(added), ','.join(removed))
+
+def apply_sldel(lobby, msg):
+    """Apply lobby delta message to list of names in lobby, returns the
+    updated list.
+    """
+    assert(msg_type(msg) == 'sldel')
+    added, removed = fields(msg)
+    removed = set(removed.split(','))
+    lobby = [name for name in lobby if name not in removed]
+    if added:
+        lobby += added.split(',')
+    return lobby
+
 def player_stat(player):
     """Given player object, return player status string used in table status
     messages.
@@ -142,21 +205,87 @@ def table_to_stabl(table):
     """Convert table object to a table status message."""
     # make a copy to ensure table doesn't change while we are doing this
     table_copy = copy.deepcopy(table)
-    msg = '[stabl|'
-    for player in table_copy.players:
-        msg += player_stat(player)
-        msg += ','
-    emptyseats = common.TABLESIZE - len(table_copy.players)
-    for i in range(emptyseats):
-        msg += player_stat(None)
-        msg += ','
-    msg = msg[:-1] + '|'  # replace trailing comma
-    msg += cards_to_str(table_copy.last_play(), 4)
-    if (table_copy.starting_round):
-        msg += '|1]'
-    else:
-        msg += '|0]'
-    return msg
+    return state_to_stabl(table_state(table_copy))
+
+def table_state(table):
+    """Return tuple describing what a table status message would show:
+    (tuple of player status strings, last play string, starting round flag).
+    """
+    seats = [player_stat(player) for player in table.players]
+    seats += [player_stat(None)] * (common.TABLESIZE - len(table.players))
+    return (tuple(seats), cards_to_str(table.last_play(), 4),
+        '1' if table.starting_round else '0')
+
+def state_to_stabl(state):
+    """Convert table state tuple to a table status message."""
+    seats, last_play, starting_round = state
+    return '[stabl|{}|{}|{}]'.format(','.join(seats), last_play, starting_round)
+
+def diff_table_state(old, new):
+    """Return list of changes between two table states. Changes are tuples:
+    ('s', seat index, player status string), ('p', last play string) or
+    ('r', starting round flag).
+    """
+    changes = []
+    for i, seat in enumerate(new[0]):
+        if seat != old[0][i]:
+            changes.append(('s', i, seat))
+    if new[1] != old[1]:
+        changes.append(('p', new[1]))
+    if new[2] != old[2]:
+        changes.append(('r', new[2]))
+    return changes
+
+def stabl_to_ssnap(stabl, seq):
+    """Convert table status message to a sequence numbered snapshot."""
+    return '[ssnap|{0:05d}|{1}'.format(seq, stabl[7:])
+
+def ssnap_to_stabl(msg):
+    """Convert table snapshot message to table status message."""
+    assert(msg_type(msg) == 'ssnap')
+    return '[stabl|' + msg[13:]
+
+def changes_to_sdelt(changes, seq):
+    """Convert list of table state changes to a table delta message."""
+    items = ['{0:05d}'.format(seq)]
+    for change in changes:
+        if change[0] == 's':
+            items.append('{}{}'.format(change[1], change[2]))
+        else:
+            items.append(change[0] + change[1])
+    return '[sdelt|{}]'.format('|'.join(items))
+
+def sdelt_seq(msg):
+    """Return sequence number of a table delta or snapshot message."""
+    return int(msg[7:12])
+
+def apply_sdelt(stabl, msg):
+    """Apply table delta message to a table status message, returns the
+    updated table status message.
+    """
+    assert(msg_type(msg) == 'sdelt')
+    for item in fields(msg)[1:]:
+        if item[0] == 'p':
+            stabl = stabl[:112] + item[1:] + stabl[123:]
+        elif item[0] == 'r':
+            stabl = stabl[:124] + item[1] + stabl[125:]
+        else:
+            start = 7 + 15 * int(item[0])
+            stabl = stabl[:start] + item[1:] + stabl[start+14:]
+    return stabl
+
+def player_stat_list_to_stabl(player_stat_list, last_play, starting_round):
+    """Convert list of PlayerStatus objects to a table status message."""
+    seats = [player_stat_to_str(ps) for ps in player_stat_list]
+    return '[stabl|{}|{}|{}]'.format(','.join(seats),
+        cards_to_str(last_play, 4), '1' if starting_round else '0')
+
+def player_stat_to_str(ps):
+    """Convert PlayerStatus object to player status string."""
+    if ps.status == 'e':
+        return player_stat(None)
+    return '{0}{1:01d}:{2:8}:{3:02d}'.format(ps.status, ps.strikes, ps.name,
+        ps.num_cards)
 
 def stabl_to_player_stat_list(msg):
     """Convert table status to list of PlayerStatus objects."""
@@ -179,3 +308,18 @@ def stabl_to_last_play(msg):
     cards = str_to_cards(cardstr)
     return cards
 
+def spectate_msg(table_id, watch):
+    """Return cspec asking to start or stop watching table table_id."""
+    return '[cspec|{:02d}|{}]'.format(table_id, int(watch))
+
+def timing_to_stime(msg_type, queued, processed):
+    """Convert seconds a message waited and was processed for to stime."""
+    return '[stime|{}|{:06d}|{:06d}]'.format(msg_type,
+        min(int(queued * 1e6), MAX_MICROS), min(int(processed * 1e6),
+        MAX_MICROS))
+
+def stime_to_timing(msg):
+    """Return (message type, seconds queued, seconds processing) of stime."""
+    assert(msg_type(msg) == 'stime')
+    msg_fields = fields(msg)
+    return msg_fields[0], int(msg_fields[1]) / 1e6, int(msg_fields[2]) / 1e6
@@ -0,0 +1,186 @@
+"""In-process metrics: counters, gauges and histograms kept in a registry
+and rendered in the Prometheus text format.
+
+Counting an event is a dict update, a couple of hundred nanoseconds, and
+a histogram observation adds a frexp, staying well under a microsecond.
+Gauges cost nothing until the metrics are read.
+
+Histograms are HDR style: every power of two is split into SUBBUCKETS
+linear buckets, so any value is counted within 1/SUBBUCKETS of its true
+value however wide the range of values is.
+"""
+
+import math
+import time
+import functools
+
+SUBBUCKETS = 8
+
+class Counter:
+    """Count of events, optionally split by the value of one label."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}    # label value -> count
+
+    def inc(self, value=None, n=1):
+        self.values[value] = self.values.get(value, 0) + n
+
+    def get(self, value=None):
+        return self.values.get(value, 0)
+
+    def samples(self):
+        """Yield (name, labels, value) for every sample."""
+        for value, count in sorted(self.values.items(), key=sort_key):
+            yield self.name, label_pairs(self.label, value), count
+
+class Gauge:
+    """Value computed by calling func when read. func may return a dict of
+    label value -> value instead of a single value.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {None: values}
+        for value, number in sorted(values.items(), key=sort_key):
+            yield self.name, label_pairs(self.label, value), number
+
+class Histogram:
+    """Distribution of values, optionally split by the value of one label."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = {}   # label value -> dict of bucket -> count
+        self.sums = {}      # label value -> sum of values
+
+    def observe(self, value, label=None):
+        if value > 0:
+            mantissa, exponent = math.frexp(value)
+            bucket = (exponent * SUBBUCKETS +
+                int((mantissa - 0.5) * 2 * SUBBUCKETS))
+        else:
+            bucket = None
+        try:
+            buckets = self.buckets[label]
+        except KeyError:
+            buckets = self.buckets[label] = {}
+            self.sums[label] = 0
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+        self.sums[label] += value
+
+    def count(self, label=None):
+        return sum(self.buckets.get(label, {}).values())
+
+    def cumulative(self, label=None):
+        """Return list of (upper bound, count of values up to it)."""
+        buckets = self.buckets.get(label, {})
+        total = buckets.get(None, 0)
+        result = [(0, total)] if total else []
+        for bucket in sorted(b for b in buckets if b is not None):
+            total += buckets[bucket]
+            result.append((upper_bound(bucket), total))
+        return result
+
+    def percentile(self, p, label=None):
+        """Upper bound of the bucket the p-th percentile falls in, None if
+        nothing was observed.
+        """
+        cumulative = self.cumulative(label)
+        if not cumulative:
+            return None
+        rank = max(p / 100 * cumulative[-1][1], 1)
+        for bound, total in cumulative:
+            if total >= rank:
+                return bound
+
+    def samples(self):
+        for value in sorted(self.buckets, key=sort_key_of_value):
+            labels = label_pairs(self.label, value)
+            cumulative = self.cumulative(value)
+            for bound, total in cumulative:
+                yield (self.name + '_bucket', labels + [('le', repr(bound))],
+                    total)
+            yield (self.name + '_bucket', labels + [('le', '+Inf')],
+                cumulative[-1][1])
+            yield self.name + '_sum', labels, self.sums[value]
+            yield self.name + '_count', labels, cumulative[-1][1]
+
+def upper_bound(bucket):
+    exponent, sub = divmod(bucket, SUBBUCKETS)
+    return math.ldexp(0.5 + (sub + 1) / (2 * SUBBUCKETS), exponent)
+
+def label_pairs(label, value):
+    return [] if value is None else [(label, str(value))]
+
+def sort_key_of_value(value):
+    return (value is not None, str(value))
+
+def sort_key(item):
+    return sort_key_of_value(item[0])
+
+def timed(histogram, label=None):
+    """Decorator observing the seconds every call takes in histogram."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+        return wrapper
+    return decorate
+
+class Registry:
+    """The metrics of a process."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self.add(Counter(name, help, label))
+
+    def gauge(self, name, help, func, label=None):
+        return self.add(Gauge(name, help, func, label))
+
+    def histogram(self, name, help, label=None):
+        return self.add(Histogram(name, help, label))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{' + ','.join('{}="{}"'.format(label,
+                        escape(text)) for label, text in labels) + '}'
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+REGISTRY = Registry()
@@ -0,0 +1,99 @@
+"""On-demand profiling of a running process, writing its results to local
+files.
+
+Two kinds of session:
+
+    cprofile    Deterministic cProfile of the thread that starts it. Writes
+                <path>.prof for pstats or snakeviz and <path>.txt with the
+                top functions by cumulative time. Slows the profiled thread
+                down noticeably.
+
+    sample      A background thread samples the stack of the profiled thread
+                every INTERVAL seconds. Writes <path>.folded with one line
+                of semicolon separated frames and a count per distinct stack,
+                the input flamegraph.pl and speedscope take. Costs the
+                profiled thread close to nothing.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import collections
+
+INTERVAL = 0.005    # seconds between stack samples
+TOPFUNCTIONS = 50   # functions listed in the cprofile text report
+
+class CProfileSession:
+    kind = 'cprofile'
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling, returns list of files written."""
+        self.profile.disable()
+        self.profile.dump_stats(self.path + '.prof')
+        with open(self.path + '.txt', 'w') as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(TOPFUNCTIONS)
+        return [self.path + '.prof', self.path + '.txt']
+
+class SamplingSession:
+    kind = 'sample'
+
+    def __init__(self, path, thread_id=None, interval=INTERVAL):
+        self.path = path
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        with open(self.path + '.folded', 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return [self.path + '.folded']
+
+def collapse(frame):
+    """Return the stack of frame, outermost first, joined by semicolons."""
+    names = []
+    while frame:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name,
+            os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+SESSIONS = {
+    'cprofile': CProfileSession,
+    'sample': SamplingSession,
+    }
+
+def session(kind, directory):
+    """Return a new session of kind, writing to a timestamped path in
+    directory. Raises ValueError for unknown kinds.
+    """
+    if kind not in SESSIONS:
+        raise ValueError('Unknown profile kind: {}'.format(kind))
+    path = os.path.join(directory, '{}-{}-{}'.format(kind,
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    return SESSIONS[kind](path)
@@ -0,0 +1,63 @@
+"""Topic based publish/subscribe used by the server to fan out broadcasts only
+to the connections that care about them.
+
+Subscribers are PlayerHandlers, or anything else with a topics set and an
+add_to_buffer method. The topics set is replaced rather than changed, so
+subscribers can start out sharing an empty frozenset.
+"""
+
+# Topics
+LOBBY = 'lobby'     # lobby roster
+CHAT = 'chat'       # global chat
+
+def table_topic(table_id):
+    """Topic for table status updates of a table."""
+    return 'table/{}'.format(table_id)
+
+def spectator_topic(table_id):
+    """Topic for the batched table status updates spectators of a table
+    get.
+    """
+    return 'table/{}/spectators'.format(table_id)
+
+def table_chat_topic(table_id):
+    """Topic for chat between players at a table."""
+    return 'table/{}/chat'.format(table_id)
+
+class Topics:
+    """Keeps a subscriber set per topic, so publishing costs O(subscribers)
+    of that topic instead of O(connections).
+    """
+
+    def __init__(self):
+        # dicts are used as insertion ordered sets
+        self.subscribers = {}
+
+    def subscribe(self, topic, subscriber):
+        self.subscribers.setdefault(topic, {})[subscriber] = None
+        subscriber.topics = subscriber.topics | {topic}
+
+    def unsubscribe(self, topic, subscriber):
+        subscribers = self.subscribers.get(topic)
+        if subscribers is not None:
+            subscribers.pop(subscriber, None)
+            if not subscribers:
+                del self.subscribers[topic]
+        subscriber.topics = subscriber.topics - {topic}
+
+    def unsubscribe_all(self, subscriber):
+        for topic in list(subscriber.topics):
+            self.unsubscribe(topic, subscriber)
+
+    def subscribers_of(self, topic):
+        """Return iterable of subscribers of topic."""
+        return self.subscribers.get(topic, {}).keys()
+
+    def publish(self, topic, msg):
+        """Send ASCII message to every subscriber of topic, returns the number
+        of subscribers it went to.
+        """
+        subscribers = self.subscribers.get(topic, {})
+        for subscriber in subscribers:
+            subscriber.add_to_buffer(msg)
+        return len(subscribers)
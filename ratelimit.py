@@ -0,0 +1,71 @@
+"""Token buckets limiting how fast a client may send each class of message.
+
+A bucket holds up to burst tokens and refills at rate tokens a second.
+Every message takes a token. Messages arriving at an empty bucket are
+dropped, and a client that keeps sending into an empty bucket earns a
+strike. Game messages aren't limited, turns can't be played faster than the
+game goes anyway.
+"""
+
+# Message type -> class of messages sharing a bucket
+CLASSES = {
+    'cplay': 'game',
+    'cswap': 'game',
+    'cjoin': 'lobby',
+    'cspec': 'lobby',
+    'cchat': 'chat',
+    'chand': 'hand',
+    'cresy': 'resync',
+    'cping': 'ping',
+    'cpong': 'ping',
+    }
+
+# Class -> (messages a second, burst), classes missing aren't limited
+LIMITS = {
+    'lobby': (0.2, 2),
+    'chat': (1, 5),
+    'hand': (1, 3),
+    'resync': (0.2, 2),
+    'ping': (1, 5),
+    }
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'drops')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.drops = 0      # messages dropped since one got through
+
+    def take(self, now):
+        """Take a token at time now, returns False if there is none."""
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.drops = 0
+            return True
+        self.drops += 1
+        return False
+
+def parse_limits(spec):
+    """Parse 'class=rate/burst,...' into dict of class -> (rate, burst).
+    A rate of 0 turns the limit of a class off.
+    """
+    limits = {}
+    for item in spec.split(','):
+        name, sep, limit = item.partition('=')
+        rate, slash, burst = limit.partition('/')
+        try:
+            rate, burst = float(rate), float(burst or 1)
+        except ValueError:
+            rate = burst = -1
+        name = name.strip()
+        if (not sep or name not in CLASSES.values() or rate < 0 or
+                burst < 1):
+            raise ValueError('Invalid rate limit: {}'.format(item))
+        limits[name] = (rate, burst) if rate else None
+    return limits
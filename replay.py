@@ -0,0 +1,298 @@
+"""
+Description:
+    Replays a capture recorded with server.py --record against a server,
+    re-driving every recorded connection in parallel.
+
+    The server's answers are checked against the recorded ones, which only
+    match where the game is deterministic, e.g. when the server is started
+    with the same --seed and no timeouts fire. Response times are compared
+    too: for every chunk of data a client sent, the time until the server
+    next sent it something, recorded against replayed.
+
+Usage:
+    python3 replay.py <args>
+
+Command line arguments:
+    -h, --help      Print this help.
+
+    -f, --file      Capture file to replay.
+
+    -s, --host      Host name of server to replay against.
+
+    -p, --port      Port to connect to.
+
+    -x, --speed     Speed up factor, 1 replays in real time, 0 replays as
+                    fast as the server answers: each connection sends its
+                    next data as soon as it got as much as was recorded
+                    before it (default 1).
+
+    -w, --wait      Seconds to wait for answers that are late or never come
+                    (default 1).
+
+    -k, --top       Number of largest response time divergences to list
+                    (default 10).
+"""
+
+import sys
+import common
+import capture
+import binmessage
+import swarm
+import bench
+import logging
+import getopt
+import asyncio
+import collections
+
+def group(records):
+    """Return dict of connection id -> list of (time, kind, data) records."""
+    conns = collections.OrderedDict()
+    for t, conn, kind, data in records:
+        conns.setdefault(conn, []).append((t, kind, data))
+    return conns
+
+def split_msgs(data):
+    """Split a server byte stream into ASCII messages, binary frames are
+    converted to the equivalent message.
+    """
+    msgs = []
+    msg, data = binmessage.retrieve_frame_from_buff(data)
+    while msg:
+        try:
+            msgs.append(binmessage.frame_to_msg(msg))
+        except (binmessage.FrameError, UnicodeDecodeError) as ex:
+            msgs.append('<invalid frame: {}>'.format(ex))
+        msg, data = binmessage.retrieve_frame_from_buff(data)
+    return msgs
+
+def response_times(sends, arrivals):
+    """For each send time, the time until the next arrival, if it came
+    before the following send.
+    """
+    times = []
+    i = 0
+    for n, sent in enumerate(sends):
+        while i < len(arrivals) and arrivals[i] < sent:
+            i += 1
+        next_send = sends[n+1] if n + 1 < len(sends) else float('inf')
+        if i < len(arrivals) and arrivals[i] < next_send:
+            times.append(arrivals[i] - sent)
+        else:
+            times.append(None)
+    return times
+
+def recorded(records):
+    """Return (send times, arrival times, data sent to the client) of a
+    recorded connection.
+    """
+    sends = [t for t, kind, data in records if kind == capture.IN]
+    arrivals = [t for t, kind, data in records if kind == capture.OUT]
+    out = b''.join([data for t, kind, data in records if kind == capture.OUT])
+    return sends, arrivals, out
+
+class Replayer(asyncio.Protocol):
+    """Client side of one replayed connection."""
+
+    def __init__(self, opts, start):
+        self.opts = opts
+        self.loop = asyncio.get_running_loop()
+        self.start = start          # loop time the replay started at
+        self.transport = None
+        self.sends = []             # times data was sent, from start
+        self.arrivals = []          # times data arrived, from start
+        self.received = bytearray()
+        self.expected = 0   # bytes the server had sent by now in the recording
+        self.closed = self.loop.create_future()
+        self.more = asyncio.Event()     # set when data arrives
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.arrivals.append(self.loop.time() - self.start)
+        self.received += data
+        self.more.set()
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self.more.set()
+
+    async def step(self, kind, data):
+        """Replay one record."""
+        if kind == capture.OUT:
+            self.expected += len(data)
+        elif kind == capture.OPEN:
+            try:
+                await self.loop.create_connection(lambda: self,
+                    self.opts['host'], self.opts['port'])
+            except OSError as ex:
+                logging.warning('Replay connection failed: %s', ex)
+        elif not self.transport or self.transport.is_closing():
+            return
+        elif kind == capture.IN:
+            self.sends.append(self.loop.time() - self.start)
+            self.transport.write(data)
+        elif kind == capture.CLOSE:
+            self.transport.close()
+
+    async def catch_up(self):
+        """Wait until as much was received as the server had sent at this
+        point of the recording, at most opts['wait'] seconds.
+        """
+        deadline = self.loop.time() + self.opts['wait']
+        while (self.transport and len(self.received) < self.expected and
+                not self.closed.done()):
+            self.more.clear()
+            try:
+                await asyncio.wait_for(self.more.wait(),
+                    deadline - self.loop.time())
+            except asyncio.TimeoutError:
+                return
+
+    async def finish(self):
+        """Wait for late answers, then close the connection."""
+        if self.transport and not self.transport.is_closing():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.closed),
+                    self.opts['wait'])
+            except asyncio.TimeoutError:
+                self.transport.close()
+
+async def replay(records, opts):
+    """Replay list of (time, connection, kind, data) records, returns dict of
+    connection id -> Replayer.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    base = records[0][0] if records else 0
+    replayers = collections.OrderedDict()
+    for t, conn, kind, data in records:
+        if conn not in replayers:
+            replayers[conn] = Replayer(opts, start)
+    # records are replayed one at a time in recorded order, so the order
+    # between connections is kept as well as the order within them
+    for t, conn, kind, data in records:
+        if kind == capture.OUT:
+            pass
+        elif opts['speed']:
+            delay = start + (t - base) / opts['speed'] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif kind in (capture.IN, capture.CLOSE):
+            await replayers[conn].catch_up()
+        await replayers[conn].step(kind, data)
+    await asyncio.gather(*[replayer.finish() for replayer in replayers.values()])
+    return replayers
+
+def compare(records, replayers, top):
+    """Compare replayed connections with the recording, returns dict report."""
+    conns = group(records)
+    report = {'connections': len(conns), 'matched': 0, 'mismatches': []}
+    divergences = []
+    recorded_times, replayed_times = [], []
+    for conn, conn_records in conns.items():
+        rec_sends, rec_arrivals, rec_out = recorded(conn_records)
+        replayer = replayers[conn]
+        sends, arrivals = replayer.sends, replayer.arrivals
+        rec_msgs, msgs = split_msgs(rec_out), split_msgs(bytes(replayer.received))
+        if rec_msgs == msgs:
+            report['matched'] += 1
+        else:
+            for i, (rec_msg, msg) in enumerate(zip(rec_msgs + [None] * len(msgs),
+                    msgs + [None] * len(rec_msgs))):
+                if rec_msg != msg:
+                    report['mismatches'].append((conn, i, rec_msg, msg))
+                    break
+        rec_times = response_times(rec_sends, rec_arrivals)
+        times = response_times(sends, arrivals)
+        for i, (rec_time, time) in enumerate(zip(rec_times, times)):
+            if rec_time is None or time is None:
+                continue
+            recorded_times.append(rec_time)
+            replayed_times.append(time)
+            divergences.append((time - rec_time, conn, i, rec_time, time))
+    recorded_times.sort()
+    replayed_times.sort()
+    for p in (50, 95, 99):
+        report['recorded_p{}'.format(p)] = bench.percentile(recorded_times, p)
+        report['replayed_p{}'.format(p)] = bench.percentile(replayed_times, p)
+    divergences.sort(reverse=True)
+    report['divergences'] = divergences[:top]
+    return report
+
+def print_report(report):
+    print('Connections matching the recording: {}/{}'.format(
+        report['matched'], report['connections']))
+    for conn, i, rec_msg, msg in report['mismatches']:
+        print('  connection {} message {}: recorded {} replayed {}'.format(
+            conn, i, rec_msg, msg))
+    print('Response times      recorded      replayed')
+    for p in (50, 95, 99):
+        rec_time = report['recorded_p{}'.format(p)]
+        time = report['replayed_p{}'.format(p)]
+        if rec_time is not None:
+            print('  p{:<2}          {:12.6f}  {:12.6f}'.format(p, rec_time,
+                time))
+    if report['divergences']:
+        print('Largest response time divergences:')
+    for diff, conn, i, rec_time, time in report['divergences']:
+        print('  connection {} send {}: recorded {:.6f} replayed {:.6f}'.format(
+            conn, i, rec_time, time))
+
+def usage():
+    print(__doc__)
+
+def parse_cmd_args(argv):
+    opts = {    # defaults
+        'file': None,
+        'host': common.HOST,
+        'port': common.PORT,
+        'speed': 1,
+        'wait': 1,
+        'top': 10,
+        }
+
+    try:
+        opt_list, args = getopt.getopt(argv, 'hf:s:p:x:w:k:', ['help', 'file=', 'host=', 'port=', 'speed=', 'wait=', 'top='])
+
+        for opt, arg in opt_list:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif opt in ('-f', '--file'):
+                opts['file'] = arg
+            elif opt in ('-s', '--host'):
+                opts['host'] = arg
+            elif opt in ('-p', '--port'):
+                opts['port'] = int(arg)
+            elif opt in ('-x', '--speed'):
+                opts['speed'] = max(float(arg), 0)
+            elif opt in ('-w', '--wait'):
+                opts['wait'] = max(float(arg), 0)
+            elif opt in ('-k', '--top'):
+                opts['top'] = max(int(arg), 0)
+            else:
+                raise getopt.GetoptError(msg='Invalid command line option')
+        if not opts['file']:
+            raise getopt.GetoptError(msg='No capture file given')
+
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex.msg if isinstance(ex, getopt.GetoptError) else ex)
+        usage()
+        sys.exit()
+    else:
+        return opts
+
+def main(argv):
+    opts = parse_cmd_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    swarm.raise_fd_limit()
+    records = list(capture.read(opts['file']))
+    replayers = asyncio.run(replay(records, opts))
+    report = compare(records, replayers, opts['top'])
+    print_report(report)
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
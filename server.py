@@ -13,20 +13,122 @@ Command line arguments:
     -l, --lobbytimeout Seconds to wait for clients to join before starting game.
 
     -s, --host         Hostname to run server on.
+
+    -w, --slobbwindow  Seconds to coalesce lobby updates for before sending
+                       them. 0 sends every update immediately.
+
+    -p, --port         Port to listen on.
+
+    -e, --seed         Random seed for shuffling, so runs deal the same cards.
+
+    -q, --quiet        Only log warnings and errors.
+
+    -r, --record       File to record all traffic to, for replay.py.
+
+    -d, --statedir     Directory to keep an event log and snapshots of game
+                       state in. Games in it are recovered on start up and
+                       players get their seats back by joining with the same
+                       name.
+
+    -f, --fsync        Event log durability: always fsyncs every batch of
+                       events, never leaves flushing to the OS
+                       (default always).
+
+    -i, --snapshotinterval  Seconds between snapshots of game state, which
+                            bounds how much of the event log a restart has
+                            to replay.
+
+    -u, --upgradesocket Unix socket to listen on for a new server process to
+                        hand the listening socket, connections and games to.
+
+    -k, --takeover     Take over from the server listening on --upgradesocket
+                       instead of opening a listening socket, then listen on
+                       it for the next upgrade. The old server exits once it
+                       handed everything over; clients stay connected.
+
+    -a, --adminsocket  Unix socket to answer admin commands on, see admin.py.
+
+    -g, --loglevels    Comma separated logger=level pairs, e.g.
+                       server.msgs=warning to turn off message traces.
+                       Loggers are root, server.msgs for every message sent
+                       and received, eventlog and the other module names.
+
+    -y, --logsample    Log only one in this many message traces.
+
+    -P, --profiledir   Directory to write profiles to (default .). SIGUSR1
+                       starts or stops a cProfile session, SIGUSR2 a stack
+                       sampling session, see profiler.py. The admin
+                       socket can start and stop them too.
+
+    -o, --profileseconds    Seconds a profiling session runs for unless
+                            stopped earlier (default 30).
+
+    -T, --timers       Time message dispatch, Table.play_cards and table
+                       update encoding into the server_handler_seconds
+                       metric.
+
+    -n, --pinginterval Seconds between pings to clients that negotiated
+                       timing, to measure their round trip times (default 5).
+                       0 only answers their pings.
+
+    -j, --tracesample  Trace one in this many received messages, timing
+                       each stage of handling them down to the socket
+                       flushes of the answers, see tracing.py. The admin
+                       traces command exports the last ones as JSON lines
+                       (default 0, no tracing).
+
+    -M, --memoryinterval    Seconds between tracemalloc snapshots, written
+                            to --profiledir with the memory they take by
+                            subsystem, see memprofile.py. The admin memory
+                            command lists the top growers (default 0, off).
+
+    -R, --ratelimits   Comma separated class=rate/burst pairs overriding the
+                       messages a second and burst each client may send of
+                       a class, e.g. chat=2/10, see ratelimit.py. A rate of
+                       0 turns the limit off. Messages over the limit are
+                       dropped, flooding earns strikes.
+
+    -V, --spectaterate Table updates a second sent to spectators at most,
+                       each with the latest table status (default 5). 0
+                       sends them every update.
+
+    -b, --bots         Seat up to this many built-in bots, playing straight
+                       against the table, when fewer than --minplayers are
+                       waiting in the lobby, so the game starts right away
+                       (default 0). Bots leave when their game ends.
+
+    -B, --botthink     Seconds a bot waits before it plays or swaps
+                       (default 0).
 """
 
 import common
 import socket
 import asyncore
 import message
+import binmessage
+import pubsub
 import logging
 import threading
 import time
 import queue
+import collections
+import itertools
 import getopt
 import sys
 import re
 import random
+import clock
+import capture
+import eventlog
+import handoff
+import metrics
+import logpipe
+import profiler
+import memprofile
+import tracing
+import ratelimit
+import signal
+import os
 
 # Constants
 MAX_CLIENTS = 20
@@ -34,53 +136,210 @@ TURNTIMEOUT = 15
 LOBBYTIMEOUT = 15
 MINPLAYERS = 3
 RUNNING = False
+RECORD = None       # capture file to record traffic to
+STATEDIR = None     # directory for the event log and snapshots
+FSYNC = True        # fsync every batch of logged events
+SNAPSHOTINTERVAL = 30   # seconds between game state snapshots
+UPGRADESOCKET = None    # Unix socket to hand over to a new server process on
+TAKEOVER = False    # take over from the server listening on UPGRADESOCKET
+ADMINSOCKET = None  # Unix socket to answer admin commands on
+LOGLEVELS = {}      # logger name -> level
+LOGSAMPLE = 1       # log one in this many message traces
+PROFILEDIR = '.'    # directory profiles are written to
+PROFILESECONDS = 30 # seconds a profiling session runs for
+MEMORYINTERVAL = 0  # seconds between memory snapshots, 0 for none
+TIMERS = False      # time the steps of handling a message
+PINGINTERVAL = 5    # seconds between pings to timing clients, 0 for never
+SLOWRTT = 1         # seconds of round trip time that make a client slow
+TABLE_ID = 0        # id of the one table, used in pub/sub topic names
+SLOBBWINDOW = 0.1   # seconds lobby updates are coalesced for
+BOTS = 0            # bots seated to make up MINPLAYERS
+BOTTHINK = 0        # seconds bots wait before they move
+SPECTATERATE = 5    # table updates a second spectators get, 0 for all
+FLOODSTRIKE = 10    # messages dropped in a row that earn a strike
+BACKLOGBUDGET = 20  # deferred messages handled each time round the loop
+# Message classes handled as soon as they arrive, the others wait until the
+# game messages received with them were handled
+URGENT = frozenset(['game', 'ping'])
+# Optional protocol features supported
+CAPABILITIES = [binmessage.CAPABILITY, message.DELTA_CAPABILITY,
+    message.LOBBY_DELTA_CAPABILITY, message.TIMING_CAPABILITY]
 
 # Module globals
 table = common.Table()  # Manages gameplay and players at table
 lobby = []              # List of players waiting in lobby
+spectators = []         # List of players watching the table
 client_to_player = {}   # Maps client to corresponding player
 player_to_client = {}   # Maps player to corresponding client
 server = None
+msg_log = logging.getLogger('server.msgs')  # trace of every message
+tracer = tracing.TRACER     # spans of sampled messages
+
+# Metrics
+MSGS_IN = metrics.REGISTRY.counter('server_messages_received_total',
+    'Messages received, by type.', 'type')
+MSGS_OUT = metrics.REGISTRY.counter('server_messages_sent_total',
+    'Messages sent, by type.', 'type')
+STRIKES = metrics.REGISTRY.counter('server_strikes_total',
+    'Strikes given, by code.', 'code')
+TIMEOUTS = metrics.REGISTRY.counter('server_timeouts_total',
+    'Turn and swap timeouts fired.', 'kind')
+HANDLER_SECONDS = metrics.REGISTRY.histogram('server_handler_seconds',
+    'Time spent in message handlers and broadcasts.', 'handler')
+FANOUT = metrics.REGISTRY.histogram('server_broadcast_recipients',
+    'Connections a broadcast went to, by message type.', 'type')
+DROPPED = metrics.REGISTRY.counter('server_messages_dropped_total',
+    'Messages over their rate limit dropped, by class.', 'class')
+CLIENT_RTT = metrics.REGISTRY.histogram('server_client_rtt_seconds',
+    'Round trip times of pings to timing clients.')
+metrics.REGISTRY.gauge('server_connections', 'Open client connections.',
+    lambda: sum(client.connected for client in server.clients.values())
+        if server else 0)
+metrics.REGISTRY.gauge('server_lobby_players', 'Players in the lobby.',
+    lambda: len(lobby))
+metrics.REGISTRY.gauge('server_table_players', 'Players seated at tables.',
+    lambda: len(table.players))
+metrics.REGISTRY.gauge('server_active_tables', 'Tables with a game going.',
+    lambda: 1 if table.players else 0)
+
+def output_buffer_depths():
+    depths = [len(client.out_buffer) for client in server.clients.values()
+        ] if server else []
+    return {'total': sum(depths), 'max': max(depths, default=0)}
+
+metrics.REGISTRY.gauge('server_output_buffer_bytes',
+    'Bytes queued for clients, in total and on the fullest connection.',
+    output_buffer_depths, 'stat')
+metrics.REGISTRY.gauge('server_backlog_messages',
+    'Messages received waiting behind game messages.',
+    lambda: len(server.backlog) if server else 0)
+metrics.REGISTRY.gauge('server_slow_connections',
+    'Timing clients with a smoothed round trip time over SLOWRTT.',
+    lambda: sum(client.slow() for client in server.clients.values())
+        if server else 0)
+
+def message_class(msg):
+    """Rate limit class of a message or frame, None if it has none."""
+    if isinstance(msg, tuple):
+        typ, payload = msg
+        if typ != binmessage.BIN_ASCII:
+            # compact cplay or cswap
+            return 'game'
+        msg = payload[:6].decode('ascii', 'replace')
+    return ratelimit.CLASSES.get(msg[1:6])
 
 class PlayerHandler(asyncore.dispatcher_with_send):
-    """Manages communication with an individual client."""
+    """Manages communication with an individual client.
+
+    Connection state starts out as the class attributes below, shared by
+    every connection, and is only stored on a connection once it changes,
+    so an idle connection costs little more than its socket.
+    """
+
+    player = None
+    buff = ''
+    msgs = ()  # messages received but not handled yet
+    strikes = 0  # for before player is initialized
+    binary = False  # client negotiated binary framing
+    delta = False  # client negotiated delta table updates
+    table_seq = None  # last table update sequence number sent
+    topics = frozenset()  # pub/sub topics this client is subscribed to
+    lobby_delta = False  # client negotiated lobby add/remove updates
+    lobby_synced = False  # client has seen the last lobby roster
+    timing = False  # client negotiated pings and server timings
+    read_at = None  # perf_counter() when data was last received
+    ping = None  # (token, perf_counter() sent) of unanswered ping
+    ping_timer = None
+    rtt = None  # smoothed round trip time in seconds
+    framed_at = None  # perf_counter() when received data was framed
+    bytes_queued = 0  # bytes ever added to out_buffer
+    bytes_sent = 0  # bytes ever sent from out_buffer
+    # deque of [bytes_queued, trace, span id] of traced output not yet sent
+    flushes = None
+    buckets = None  # message class -> ratelimit.TokenBucket once limited
+    deferred = 0  # messages waiting in the server's backlog
 
     def __init__(self, uid, sock=None, map=None):
         asyncore.dispatcher_with_send.__init__(self, sock)
         self._uid = uid
-        self.player = None
-        self.buff = ''
-        self.msgs = []
-        self.strikes = 0  # for before player is initialized
 
     # Socket communication
     def add_to_buffer(self, str):
-        logging.debug('Sending: {}'.format(str))
-        self.out_buffer += bytes(str, 'ascii')
+        msg_log.debug('Sending: %s', str)
+        MSGS_OUT.inc(str[1:6])
+        if self.binary:
+            self.add_frame_to_buffer(binmessage.msg_to_frame(str))
+        else:
+            self.add_frame_to_buffer(bytes(str, 'ascii'))
+
+    def add_frame_to_buffer(self, frame):
+        self.out_buffer += frame
+        self.bytes_queued += len(frame)
+        if tracer.current:
+            self.wait_flush(tracer.current)
+        if server.recorder:
+            server.recorder.record(self._uid, capture.OUT, frame)
+
+    def wait_flush(self, trace):
+        """Time until everything queued so far is sent as a span of trace."""
+        if self.flushes and self.flushes[-1][1] is trace:
+            self.flushes[-1][0] = self.bytes_queued
+        else:
+            if self.flushes is None:
+                self.flushes = collections.deque()
+            self.flushes.append([self.bytes_queued, trace,
+                trace.add('flush', time.perf_counter(), label=self._uid)])
+
+    def initiate_send(self):
+        queued = len(self.out_buffer)
+        asyncore.dispatcher_with_send.initiate_send(self)
+        self.sent(queued - len(self.out_buffer))
+
+    def sent(self, num_bytes):
+        """Account for num_bytes of out_buffer having been sent."""
+        self.bytes_sent += num_bytes
+        while self.flushes and self.flushes[0][0] <= self.bytes_sent:
+            size, trace, span_id = self.flushes.popleft()
+            trace.close(span_id)
 
     def handle_read(self):
-        buff = self.recv(1024)
-        buff = buff.decode('ascii')
-        self.buff += buff
+        self.receive(self.recv(1024))
+
+    def receive(self, buff):
+        """Parse and handle the messages in data received from the client."""
+        self.read_at = time.perf_counter()
+        if server.recorder:
+            server.recorder.record(self._uid, capture.IN, buff)
+        if self.binary:
+            self.buff += buff
+            retrieve = binmessage.retrieve_frame_from_buff
+        else:
+            self.buff += buff.decode('ascii')
+            retrieve = message.retrieve_msg_from_buff
 
-        msg, self.buff = message.retrieve_msg_from_buff(self.buff)
+        msg, self.buff = retrieve(self.buff)
+        if msg:
+            msgs = self.msgs = list(self.msgs)
         while msg:
-            self.msgs.append(msg)
-            logging.info('Server received message: %s', msg)
-            msg, self.buff = message.retrieve_msg_from_buff(self.buff)
+            msgs.append(msg)
+            msg_log.info('Server received message: %s', msg)
+            msg, self.buff = retrieve(self.buff)
+        self.framed_at = time.perf_counter()
 
         if len(self.buff) > 1000:
             # must be filled with crap
-            self.buff = ''
-            self.send_strike('32')
+            self.buff = b'' if self.binary else ''
+            self.send_input_strike('32')
 
         self.parse_msgs()
 
     def send_shand(self):
         if not self.player or not self.player.hand:
             return
-        msg = message.hand_to_msg(self.player.hand)
-        self.add_to_buffer(msg)
+        if self.binary:
+            self.add_frame_to_buffer(binmessage.hand_to_frame(self.player.hand))
+        else:
+            self.add_to_buffer(message.hand_to_msg(self.player.hand))
 
     def send_strike(self, code):
         if self.player:
@@ -92,22 +351,184 @@ class PlayerHandler(asyncore.dispatcher_with_send):
             self.strikes += 1
             strikes = self.strikes
         logging.info('Sending strike to client %s', name)
+        STRIKES.inc(code)
         self.add_to_buffer('[strik|{}|{}]'.format(code, strikes))
-        if self.player.strikes >= 3:
+        if strikes >= 3:
             # kick em
             self.handle_close()
 
+    # Round trip times
+    def send_ping(self):
+        """Ping the client and ping it again in PINGINTERVAL seconds."""
+        token = (self.ping[0] + 1) % message.SEQ_MOD if self.ping else 0
+        self.ping = (token, time.perf_counter())
+        self.add_to_buffer('[sping|{:05d}]'.format(token))
+        self.ping_timer = server.call_later(PINGINTERVAL, self.send_ping)
+
+    def start_pings(self):
+        if PINGINTERVAL > 0 and not self.ping_timer:
+            self.ping_timer = server.call_later(PINGINTERVAL, self.send_ping)
+
+    def handle_cpong(self, msg):
+        token = int(message.fields(msg)[0])
+        if not self.ping or self.ping[0] != token or self.ping[1] is None:
+            return
+        rtt = time.perf_counter() - self.ping[1]
+        # answered, count it once
+        self.ping = (token, None)
+        CLIENT_RTT.observe(rtt)
+        was_slow = self.slow()
+        # smoothed like TCP's round trip time
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        if self.slow() and not was_slow:
+            logging.warning('Client %s is slow, round trip time %.3fs',
+                self.player.name if self.player else self._uid, self.rtt)
+
+    def slow(self):
+        return self.rtt is not None and self.rtt > SLOWRTT
+
+    def send_stime(self, msg_type, started):
+        """Tell a timing client how long its message waited after being
+        received and how long handling it took.
+        """
+        processed = time.perf_counter() - started
+        self.add_to_buffer(message.timing_to_stime(msg_type,
+            started - self.read_at if self.read_at else 0, processed))
+
+    def handoff_state(self):
+        """Return dict of connection state for a server taking over."""
+        return {
+            'name': self.player.name if self.player else None,
+            'strikes': self.strikes,
+            'binary': self.binary,
+            'delta': self.delta,
+            'lobby_delta': self.lobby_delta,
+            'table_seq': self.table_seq,
+            'lobby_synced': self.lobby_synced,
+            'timing': self.timing,
+            # bytes survive JSON as latin-1 strings
+            'buff': self.buff.decode('latin-1') if self.binary else self.buff,
+            'out_buffer': self.out_buffer.decode('latin-1'),
+            }
+
+    def take_over(self, state):
+        """Carry on from handoff_state of the old server's connection."""
+        self.strikes = state['strikes']
+        self.binary = state['binary']
+        self.delta = state['delta']
+        self.lobby_delta = state['lobby_delta']
+        self.table_seq = state['table_seq']
+        self.lobby_synced = state['lobby_synced']
+        self.timing = state.get('timing', False)
+        if self.timing:
+            self.start_pings()
+        self.buff = (state['buff'].encode('latin-1') if self.binary else
+            state['buff'])
+        self.out_buffer = state['out_buffer'].encode('latin-1')
+        self.bytes_queued = len(self.out_buffer)
+
+    def send_input_strike(self, code):
+        """Strike for bad input. Logged as an event of its own, since the bad
+        input isn't.
+        """
+        if self.player:
+            server.log_event('strike', self.player.name, code)
+        self.send_strike(code)
+
+    # Rate limits
+    def allow(self, msg_class):
+        """Take a token from the bucket of msg_class, returns False if the
+        message is over the limit.
+        """
+        limit = ratelimit.LIMITS.get(msg_class)
+        if not limit:
+            return True
+        now = server.scheduler.time()
+        if self.buckets is None:
+            self.buckets = {}
+        bucket = self.buckets.get(msg_class)
+        if bucket is None:
+            bucket = self.buckets[msg_class] = ratelimit.TokenBucket(
+                limit[0], limit[1], now)
+        return bucket.take(now)
+
+    def flooding(self, msg_class):
+        """Whether the client kept sending msg_class over its limit for
+        long enough to earn a strike, starting the count over if so.
+        """
+        bucket = self.buckets[msg_class]
+        if bucket.drops < FLOODSTRIKE:
+            return False
+        bucket.drops = 0
+        return True
+
     # Message parsing
     def parse_msgs(self):
         msgs = self.msgs
-        self.msgs = []
+        self.msgs = ()
         for msg in msgs:
-            if not message.is_valid(msg):
-                logging.info('Message flagged invalid: %s', msg)
-                self.send_strike('30')
-                # need to add other strike codes
+            msg_class = message_class(msg)
+            if not self.allow(msg_class):
+                DROPPED.inc(msg_class)
+                if self.flooding(msg_class):
+                    logging.info('Client %s is flooding %s messages',
+                        self.player.name if self.player else self._uid,
+                        msg_class)
+                    # the rest is likely more of the same
+                    self.send_input_strike('33')
+                    return
+                continue
+            if self.deferred or msg_class not in URGENT:
+                # after the game messages of other clients, and in order
+                # with the client's own
+                self.deferred += 1
+                server.backlog.append((self, msg, self.read_at,
+                    self.framed_at))
+            elif not self.handle_msg(msg):
                 return
-            msg_type = message.msg_type(msg) 
+
+    def handle_msg(self, msg, deferred=False):
+        """Handle one message or frame received at read_at, traced if it is
+        sampled. Returns False if the rest of the messages received should be
+        dropped.
+        """
+        trace = tracer.begin('frame', self.read_at, client=self._uid)
+        if trace:
+            trace.add('read', self.read_at, self.framed_at)
+            if deferred:
+                trace.add('backlog', self.framed_at, time.perf_counter())
+        try:
+            return self.parse_msg(msg)
+        finally:
+            if trace:
+                tracer.finish(trace)
+
+    def parse_msg(self, msg):
+        """Handle one message or frame, returns False if the rest of the
+        messages received should be dropped.
+        """
+        if isinstance(msg, tuple):
+            try:
+                msg = self.parse_frame(*msg)
+            except (binmessage.FrameError, UnicodeDecodeError) as ex:
+                logging.info('Frame flagged invalid: %s', ex)
+                self.send_input_strike('30')
+                return False
+            if not msg:
+                # compact frame, already handled
+                return True
+        with tracer.span('is_valid'):
+            valid = message.is_valid(msg)
+        if not valid:
+            logging.info('Message flagged invalid: %s', msg)
+            self.send_input_strike('30')
+            # need to add other strike codes
+            return False
+        msg_type = message.msg_type(msg) 
+        MSGS_IN.inc(msg_type)
+        tracer.rename(msg_type)
+        started = time.perf_counter()
+        with tracer.span('handle', msg_type):
             if msg_type == 'cjoin':
                 self.handle_cjoin(msg)
             elif msg_type == 'cplay':
@@ -118,63 +539,139 @@ class PlayerHandler(asyncore.dispatcher_with_send):
                 server.handle_cswap(self, msg)
             elif msg_type == 'chand':
                 self.send_shand()
+            elif msg_type == 'cresy':
+                server.send_snapshot(self)
+            elif msg_type == 'cping':
+                self.add_to_buffer('[spong|{}]'.format(message.fields(msg)[0]))
+            elif msg_type == 'cpong':
+                self.handle_cpong(msg)
+            elif msg_type == 'cspec':
+                self.handle_cspec(msg)
+        if self.timing and msg_type in message.TIMED_TYPES:
+            self.send_stime(msg_type, started)
+        return True
+
+    def parse_frame(self, typ, payload):
+        """Handle a compact binary frame. Frames wrapping an ASCII message
+        are returned as the message so they go through normal validation.
+        """
+        if typ == binmessage.BIN_ASCII:
+            return payload.decode('ascii')
+        started = time.perf_counter()
+        if typ == binmessage.BIN_CPLAY and len(payload) <= 4:
+            msg_type = 'cplay'
+            MSGS_IN.inc(msg_type)
+            tracer.rename(msg_type)
+            with tracer.span('handle', msg_type):
+                self.handle_play(binmessage.bytes_to_cards(payload))
+        elif typ == binmessage.BIN_CSWAP and len(payload) == 1:
+            msg_type = 'cswap'
+            MSGS_IN.inc(msg_type)
+            tracer.rename(msg_type)
+            with tracer.span('handle', msg_type):
+                server.handle_swap(self, binmessage.bytes_to_cards(payload)[0])
+        else:
+            raise binmessage.FrameError('unexpected frame type: {}'.format(typ))
+        if self.timing:
+            self.send_stime(msg_type, started)
+        return None
 
+    @metrics.timed(HANDLER_SECONDS, 'cjoin')
     def handle_cjoin(self, msg):
         global lobby
         fields = message.fields(msg)
-        assert(len(fields) == 1)
+        assert(len(fields) in (1, 2))
         assert(len(fields[0]) == 8)
         if self.player:
             # we already initialized the player
             raise common.PlayerError(self.player, 'invalid cjoin')
-        # check if name needs to be mangled
         name = fields[0].strip()
-        current_names = [player.name for player in lobby]
-        current_names += [player.name for player in table.players]
-        name = mangle_name(current_names, name)
-
-        # add the player to the table or the lobby
-        self.player = common.Player(name)
-        self.player.strikes = self.strikes
-        client_to_player[self] = self.player
-        player_to_client[self.player] = self
-        logging.info('Player added to lobby: {}'.format(name))
-        lobby.append(self.player)
-        # reply with sjoin
-        self.add_to_buffer('[sjoin|{}]'.format(name.ljust(8)))
+        orphan = server.find_orphan(name)
+        if orphan:
+            # player recovered after a restart, give them their place back
+            server.adopt_orphan(orphan, self)
+            logging.info('Player reclaimed: %s', name)
+        else:
+            # check if name needs to be mangled
+            current_names = [player.name for player in lobby]
+            current_names += [player.name for player in table.players]
+            current_names += [player.name for player in spectators]
+            name = mangle_name(current_names, name)
+
+            # add the player to the lobby
+            self.player = common.Player(name)
+            self.player.strikes = self.strikes
+            server.register_player(self, self.player)
+            logging.info('Player added to lobby: %s', name)
+            lobby.append(self.player)
+            server.log_event('join', name)
+        # reply with sjoin, listing the optional capabilities we agreed to
+        caps = [cap for cap in message.capabilities(msg) if cap in CAPABILITIES]
+        if caps:
+            self.add_to_buffer('[sjoin|{}|{}]'.format(name.ljust(8),
+                ','.join(caps)))
+        else:
+            self.add_to_buffer('[sjoin|{}]'.format(name.ljust(8)))
+        if binmessage.CAPABILITY in caps:
+            # everything after the sjoin is framed
+            self.binary = True
+            self.buff = self.buff.encode('ascii')
+        self.delta = message.DELTA_CAPABILITY in caps
+        self.lobby_delta = message.LOBBY_DELTA_CAPABILITY in caps
+        self.timing = message.TIMING_CAPABILITY in caps
+        if self.timing:
+            self.start_pings()
+        server.topics.subscribe(pubsub.LOBBY, self)
+        server.topics.subscribe(pubsub.CHAT, self)
+        if orphan:
+            self.send_shand()
+            if self.player in table.players:
+                server.send_table_update(self)
         server.send_slobb()
+        server.check_lobby()
 
     def handle_cplay(self, msg):
         fields = message.fields(msg)
         assert(len(fields) == 1)
-        cards = message.str_to_cards(fields[0])
-        server.new_play = True
+        self.handle_play(message.str_to_cards(fields[0]))
+
+    @metrics.timed(HANDLER_SECONDS, 'cplay')
+    def handle_play(self, cards):
+        if not self.player:
+            # client hasn't sent cjoin
+            self.send_strike('30')
+            return
         try:
             if server.first_play:
                 if table.starting_round and 0 not in cards:
                     # they have to play the 3 of clubs on the first play
-                    self.send_strike('16')
+                    self.send_input_strike('16')
                     self.send_shand()
                     return
                 elif not cards:
                     # they can't pass on first play
-                    self.send_strike('18')
+                    self.send_input_strike('18')
                     return
                 else:
                     table.validate_play(self.player, cards)
                     server.first_play = False
-            table.play_cards(self.player, cards)
+            with tracer.span('play_cards'):
+                table.play_cards(self.player, cards)
         except common.PlayerError as ex:
             logging.info(ex)
-            self.send_strike(ex.strike_code)
+            self.send_input_strike(ex.strike_code)
             self.send_shand()
         else:
-            # successfull play
-            logging.info('Player {} succesfully played: {}'.format(
-                self.player.name, repr(cards)))
+            # successfull play, only these are logged
+            server.log_event('play', self.player.name, cards)
+            logging.info('Player %s succesfully played: %r', self.player.name,
+                cards)
             # see if the game is over
             if len(table.active_players()) <= 1:
                 server.finish_game()
+            elif server.swap_card is None:
+                # the next player's turn
+                server.restart_turn_timer()
         finally:
             server.send_stabl()
 
@@ -188,7 +685,21 @@ class PlayerHandler(asyncore.dispatcher_with_send):
             self.send_strike('30')
             return
         name = self.player.name
-        server.send_schat(name, chat)
+        if self.player in table.players:
+            server.send_schat(name, chat, pubsub.table_chat_topic(TABLE_ID))
+        else:
+            server.send_schat(name, chat)
+
+    def handle_cspec(self, msg):
+        fields = message.fields(msg)
+        if (not self.player or self.player in table.players or
+                int(fields[0]) != TABLE_ID):
+            # not joined, already watching from their seat or no such table
+            self.send_strike('30')
+        elif fields[1] == '1':
+            server.spectate(self)
+        else:
+            server.stop_spectating(self)
 
     def handle_close(self):
         global lobby
@@ -203,46 +714,253 @@ class PlayerHandler(asyncore.dispatcher_with_send):
                 else:
                     table.turn %= len(active_players)
                     active_players[table.turn].status = 'a'
-                server.new_play = True
+                    # only the player who had to lead is bound by first play
+                    server.first_play = False
+                    server.restart_turn_timer()
             else:
                 self.player.status = 'd'
-            logging.info('Player {} left the table'.format(self.player.name))
+            logging.info('Player %s left the table', self.player.name)
         elif self.player in lobby:
-            logging.info('Player {} left the lobby'.format(self.player.name))
+            logging.info('Player %s left the lobby', self.player.name)
             lobby.remove(self.player)
             # send a lobby update message
             server.send_slobb()
+            server.check_lobby()
         elif self.player in table.winners:
-            logging.info('Player {} left the winners circle'.format(
-                self.player.name))
+            logging.info('Player %s left the winners circle',
+                self.player.name)
             table.winners.remove(self.player)
+        elif self.player in spectators:
+            logging.info('Spectator %s left', self.player.name)
+            spectators.remove(self.player)
         elif self.player:
-            logging.info('Player {} can\'t be found'.format(self.player.name))
-        # server.handle_client_disconnect(self._uid)
-        # player_to_client.pop(self.player, None)
+            logging.info('Player %s can\'t be found', self.player.name)
+        server.handle_client_disconnect(self._uid)
+        if self.player:
+            server.log_event('leave', self.player.name)
+        if server.recorder:
+            server.recorder.record(self._uid, capture.CLOSE)
+        server.topics.unsubscribe_all(self)
+        if self.ping_timer:
+            self.ping_timer.cancel()
+            self.ping_timer = None
+        # never flushed, their spans stay open
+        self.flushes = None
+        self.close()
+
+class OrphanHandler(PlayerHandler):
+    """Stands in for the connection of a player recovered after a restart,
+    until their client joins again with the same name. Output is dropped.
+    """
+
+    closed = False
+
+    def add_frame_to_buffer(self, frame):
+        pass
+
+    def close(self):
+        self.closed = True
+        PlayerHandler.close(self)
+
+class BotHandler(OrphanHandler):
+    """Plays a seat with the automated strategy, straight against the table
+    instead of over a connection. Output is dropped without being encoded.
+    """
+
+    move_timer = None
+
+    def __init__(self, uid, strategy=common.lowest_card_strategy):
+        OrphanHandler.__init__(self, uid)
+        self.strategy = strategy
+
+    def add_to_buffer(self, str):
+        pass
+
+    def send_shand(self):
+        pass
+
+    def wake(self):
+        """Move in BOTTHINK seconds if it is the bot's turn or it has to
+        swap.
+        """
+        if not self.move_timer and (self.player.status == 'a' or (
+                server.swap_card is not None and table.players and
+                table.players[0] is self.player)):
+            self.move_timer = server.call_later(BOTTHINK, self.move)
+
+    def move(self):
+        self.move_timer = None
+        if self.closed or self.player not in table.players:
+            return
+        if server.swap_card is not None:
+            if table.players[0] is self.player:
+                # give the scumbag the lowest card
+                server.handle_swap(self, min(self.player.hand))
+        elif self.player.status == 'a':
+            last_play = table.last_play() or []
+            cards = self.strategy(list(self.player.hand), last_play)
+            try:
+                table.validate_play(self.player, cards)
+            except common.PlayerError:
+                cards = []
+            self.handle_play(cards)
+
+    def close(self):
+        if self.move_timer:
+            self.move_timer.cancel()
+            self.move_timer = None
+        OrphanHandler.close(self)
+
+class Waker(asyncore.dispatcher):
+    """Wakes up the main loop when another thread needs its attention."""
+
+    def __init__(self):
+        rsock, self.wsock = socket.socketpair()
+        asyncore.dispatcher.__init__(self, rsock)
+
+    def wake(self):
+        try:
+            self.wsock.send(b'x')
+        except OSError:
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(1024)
+
+    def handle_close(self):
+        self.close()
+        self.wsock.close()
+
+class UnixListener(asyncore.dispatcher):
+    """Listens on a Unix socket."""
+
+    def __init__(self, path):
+        asyncore.dispatcher.__init__(self)
+        self.path = path
+        try:
+            # left behind by the server we took over from, or a crash
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bind(path)
+        self.listen(5)
+
+    def remove(self):
+        """Close and remove the socket file."""
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+class UpgradeListener(UnixListener):
+    """Waits for a new server process to hand over to."""
+
+    def handle_accepted(self, sock, addr):
+        server.hand_over(sock)
+
+class AdminListener(UnixListener):
+    """Accepts connections on the admin socket."""
+
+    def handle_accepted(self, sock, addr):
+        AdminHandler(sock)
+
+class AdminHandler(asyncore.dispatcher_with_send):
+    """Answers one command line on the admin socket, then closes."""
+
+    def __init__(self, sock):
+        asyncore.dispatcher_with_send.__init__(self, sock)
+        self.buff = b''
+        self.answered = False
+
+    def readable(self):
+        return not self.answered
+
+    def handle_read(self):
+        self.buff += self.recv(1024)
+        if b'\n' in self.buff or len(self.buff) > 1000:
+            line = self.buff.split(b'\n')[0].decode('ascii', 'replace')
+            self.out_buffer += server.handle_admin(line.split()).encode(
+                'utf-8')
+            self.answered = True
+
+    def handle_write(self):
+        self.initiate_send()
+        if self.answered and not self.out_buffer:
+            self.close()
+
+    def handle_close(self):
         self.close()
 
 class GameServer(asyncore.dispatcher):
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, scheduler=None, sock=None):
         asyncore.dispatcher.__init__(self)
-        self.create_socket()
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.listen(20)
+        if sock:
+            # listening socket handed over by the server we took over from
+            self.set_socket(sock)
+            self.accepting = True
+        else:
+            self.create_socket()
+            self.set_reuse_addr()
+            self.bind((host, port))
+            self.listen(20)
         self._next_uid = 1
         self.clients = {} 
+        self.topics = pubsub.Topics()
         self.clients_at_table = []
         table.starting_round = True
-        self.new_play = True
         self.first_play = True
-        self.swap_timeout = None
-    
+        self.swap_timeout = None    # Timer while waiting for the warlord's swap
+        self.swap_card = None       # card offered from the scumbag
+        self.turn_timer = None
+        self.lobby_timer = None
+        self.start_timer = None
+        self.waker = Waker()
+        self.table_seq = 0          # sequence number of table_state
+        self.table_state = None     # table state at last broadcast
+        self.table_changes = None   # changes that led to table_state
+        # runs every timeout, against the real clock unless simulating
+        self.scheduler = scheduler or clock.Scheduler()
+        self.recorder = None        # capture.Recorder when recording traffic
+        self.eventlog = None        # eventlog.EventLog when keeping state
+        self.snapshot_timer = None
+        self.slobb_timer = None     # pending coalesced lobby update
+        self.slobb_names = None     # lobby roster at last lobby update
+        self.spectate_timer = None  # pending batched spectator update
+        self.bots = []              # BotHandlers of bots seated
+        self.spectate_sent = None   # scheduler time of the last one
+        self.upgrade_listener = None    # UpgradeListener if upgradable
+        self.admin_listener = None      # AdminListener if administrable
+        self.profile = None         # running profiler session
+        self.profile_timer = None
+        self.profile_request = None  # session kind a signal asked for
+        # (client, msg, read_at, framed_at) of messages waiting behind game
+        # messages
+        self.backlog = collections.deque()
+        self.memory = None          # memprofile.MemoryProfiler if profiling
+        self.memory_timer = None
+
+    # Timers
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) from the main loop after delay seconds."""
+        return self.scheduler.call_later(delay, callback, *args)
+
     def add_player_to_table(self, uid, player):
         assert(len(table.players) == len(self.clients_at_table))
         player.status = 'w'
         if table.add_player(player):
             self.clients_at_table.append(uid)
+            client = player_to_client[player]
+            if not isinstance(client, BotHandler):
+                # bots read the table itself
+                self.topics.subscribe(pubsub.table_topic(TABLE_ID), client)
+                self.topics.subscribe(pubsub.table_chat_topic(TABLE_ID),
+                    client)
         else:
             logging.info("tried to add played to table when already full")
         assert(len(table.players) == len(self.clients_at_table))
@@ -250,14 +968,21 @@ class GameServer(asyncore.dispatcher):
     def remove_player_from_table(self, uid, player):
         table.remove_player(player)
         self.clients_at_table.remove(uid)
+        self.unsubscribe_from_table(player_to_client[player])
+
+    def unsubscribe_from_table(self, client):
+        self.topics.unsubscribe(pubsub.table_topic(TABLE_ID), client)
+        self.topics.unsubscribe(pubsub.table_chat_topic(TABLE_ID), client)
 
     def handle_accepted(self, sock, addr):
-        logging.debug('Incoming connection from %s' % repr(addr))
+        logging.debug('Incoming connection from %r', addr)
         if len(lobby) >= common.LOBBYSIZE:
             # lobby is full
             return
         handler = PlayerHandler(self._next_uid, sock)
         self.clients[self._next_uid] = handler
+        if self.recorder:
+            self.recorder.record(self._next_uid, capture.OPEN)
         self._next_uid += 1
 
     def handle_close(self):
@@ -265,48 +990,383 @@ class GameServer(asyncore.dispatcher):
         self.close()
     
     def shutdown(self):
+        if self.profile:
+            self.stop_profile()
+        if self.memory:
+            self.stop_memory_profile()
+        if self.eventlog:
+            # stop logging first, the games carry on after a restart
+            self.take_snapshot()
+            self.snapshot_timer.cancel()
+            self.eventlog.close()
+            self.eventlog = None
+        if self.upgrade_listener:
+            self.upgrade_listener.remove()
+            self.upgrade_listener = None
+        if self.admin_listener:
+            self.admin_listener.remove()
+            self.admin_listener = None
         self.handle_close()
+        self.waker.handle_close()
         while True:
             try:
                 client = self.clients.popitem()
                 client[1].handle_close()
             except KeyError:
-                return
-
+                break
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+
+    def run_backlog(self, budget=BACKLOGBUDGET):
+        """Handle up to budget of the messages deferred behind game
+        messages, all of them if None.
+        """
+        while self.backlog and (budget is None or budget > 0):
+            client, msg, read_at, framed_at = self.backlog.popleft()
+            client.deferred -= 1
+            if self.clients.get(client._uid) is not client:
+                # disconnected since
+                continue
+            if budget:
+                budget -= 1
+            client.read_at, client.framed_at = read_at, framed_at
+            if not client.handle_msg(msg, deferred=True):
+                # drop the rest, like an invalid message does
+                self.backlog = collections.deque(entry for entry in
+                    self.backlog if entry[0] is not client)
+                client.deferred = 0
+
+    # Bots
+    def bots_needed(self):
+        """Bots it takes to start a table with the players in the lobby
+        now, 0 if it takes none or more than BOTS.
+        """
+        if not lobby or len(lobby) >= MINPLAYERS:
+            return 0
+        needed = MINPLAYERS - len(lobby)
+        return needed if needed <= BOTS else 0
+
+    def add_bot(self, player=None):
+        """Return a new BotHandler playing player, a new one named botN if
+        None.
+        """
+        if player is None:
+            names = {player.name for player in lobby + table.players +
+                spectators}
+            name = next(name for name in ('bot{}'.format(i)
+                for i in itertools.count(1)) if name not in names)
+            player = common.Player(name)
+        bot = BotHandler(self._next_uid)
+        self.clients[self._next_uid] = bot
+        self._next_uid += 1
+        bot.player = player
+        self.register_player(bot, player)
+        self.bots.append(bot)
+        logging.info('Bot %s added', player.name)
+        return bot
+
+    def remove_bot(self, bot):
+        self.bots.remove(bot)
+        self.clients.pop(bot._uid, None)
+        client_to_player.pop(bot, None)
+        player_to_client.pop(bot.player, None)
+        bot.close()
+
+    def register_player(self, client, player):
+        client_to_player[client] = player
+        player_to_client[player] = client
 
     def handle_client_disconnect(self, uid):
+        """Forget the connection uid. Its player keeps their entry while
+        seated, until the game ends.
+        """
         client = self.clients.pop(uid, None)
-        try:
-            self.clients_at_table.remove(uid)
-            table.remove_player(client.player)
-        except ValueError:
-            pass
-        except AttributeError:
-            pass
-        client_to_player.pop(client, None)
+        player = client_to_player.pop(client, None)
+        if (player and player not in table.players and
+                player_to_client.get(player) is client):
+            del player_to_client[player]
+
+    def update_table_state(self):
+        """Record the current table state, bumping the sequence number and
+        keeping the changes from the previous state if anything changed.
+        """
+        state = message.table_state(table)
+        if state == self.table_state:
+            return
+        if self.table_state:
+            self.table_changes = message.diff_table_state(self.table_state,
+                state)
+        else:
+            self.table_changes = None
+        self.table_state = state
+        self.table_seq = (self.table_seq + 1) % message.SEQ_MOD
 
+    @metrics.timed(HANDLER_SECONDS, 'send_stabl')
     def send_stabl(self):
-        msg = message.table_to_stabl(table)
-        logging.info('Client broadcast: ' + msg)
-        for client in self.clients.values():
-            client.add_to_buffer(msg)
+        with tracer.span('table_state'):
+            self.update_table_state()
+        msg_log.info('Client broadcast: %s', logpipe.Lazy(
+            message.state_to_stabl, self.table_state))
+        encoded = {}
+        clients = self.topics.subscribers_of(pubsub.table_topic(TABLE_ID))
+        with tracer.span('send_stabl', len(clients)):
+            for client in clients:
+                self.send_table_update(client, encoded)
+        FANOUT.observe(len(clients), 'stabl')
+        if self.topics.subscribers_of(pubsub.spectator_topic(TABLE_ID)):
+            self.send_spectators(encoded)
+        for bot in self.bots:
+            bot.wake()
+
+    # Spectators
+    def send_spectators(self, encoded=None):
+        """Send spectators the table state at most SPECTATERATE times a
+        second. An update coming sooner waits, and the latest state goes out
+        when the time is up. encoded may hold the encodings of the current
+        state already.
+        """
+        if self.spectate_timer:
+            return
+        now = self.scheduler.time()
+        if (SPECTATERATE <= 0 or self.spectate_sent is None or
+                now - self.spectate_sent >= 1 / SPECTATERATE):
+            self.flush_spectators(encoded)
+        else:
+            self.spectate_timer = self.scheduler.call_at(
+                self.spectate_sent + 1 / SPECTATERATE, self.flush_spectators)
+
+    def flush_spectators(self, encoded=None):
+        """Send every spectator the latest table state, encoding each form
+        of it once.
+        """
+        self.spectate_timer = None
+        self.spectate_sent = self.scheduler.time()
+        self.update_table_state()
+        if encoded is None:
+            encoded = {}
+        clients = self.topics.subscribers_of(pubsub.spectator_topic(TABLE_ID))
+        with tracer.span('send_spectators', len(clients)):
+            for client in clients:
+                self.send_table_update(client, encoded)
+        FANOUT.observe(len(clients), 'spectate')
+
+    def spectate(self, client):
+        """Take the player of client out of the lobby to watch the table,
+        its status updates and chat.
+        """
+        player = client.player
+        if player in lobby:
+            lobby.remove(player)
+            self.send_slobb()
+            self.check_lobby()
+        if player not in spectators:
+            spectators.append(player)
+            self.log_event('spectate', player.name, True)
+            logging.info('Player %s is spectating', player.name)
+        self.subscribe_spectator(client)
+        # catch up with the table as it is
+        self.send_snapshot(client)
+
+    def subscribe_spectator(self, client):
+        self.topics.subscribe(pubsub.spectator_topic(TABLE_ID), client)
+        self.topics.subscribe(pubsub.table_chat_topic(TABLE_ID), client)
+
+    def stop_spectating(self, client):
+        """Put the player of a spectating client back in the lobby."""
+        player = client.player
+        if player not in spectators:
+            return
+        spectators.remove(player)
+        self.log_event('spectate', player.name, False)
+        logging.info('Player %s stopped spectating', player.name)
+        self.topics.unsubscribe(pubsub.spectator_topic(TABLE_ID), client)
+        self.topics.unsubscribe(pubsub.table_chat_topic(TABLE_ID), client)
+        lobby.append(player)
+        self.send_slobb()
+        self.check_lobby()
+
+    def send_snapshot(self, client):
+        """Resend the whole table state to a delta client that lost track."""
+        self.update_table_state()
+        client.table_seq = None
+        self.send_table_update(client)
+
+    def send_table_update(self, client, encoded=None):
+        """Send client the table state in the form it negotiated: a full stabl
+        for legacy clients, otherwise a delta if the client saw the previous
+        state or a snapshot if it didn't. Encodings are cached in encoded so a
+        broadcast builds each form at most once.
+        """
+        if not client.delta:
+            kind = 'stabl'
+        elif client.table_seq == self.table_seq:
+            # already up to date
+            return
+        elif (self.table_changes and
+                client.table_seq == (self.table_seq - 1) % message.SEQ_MOD):
+            kind = 'sdelt'
+        else:
+            kind = 'ssnap'
+        if client.delta:
+            client.table_seq = self.table_seq
+        if encoded is None:
+            encoded = {}
+        key = (kind, client.binary)
+        if key not in encoded:
+            with tracer.span('encode', kind):
+                encoded[key] = self.encode_table_update(kind, client.binary)
+        MSGS_OUT.inc(kind)
+        client.add_frame_to_buffer(encoded[key])
+
+    def encode_table_update(self, kind, binary):
+        """Return bytes for a stabl, ssnap or sdelt of the current state."""
+        if binary:
+            if kind == 'stabl':
+                return binmessage.table_to_frame(table)
+            elif kind == 'ssnap':
+                return binmessage.table_to_snapshot_frame(table, self.table_seq)
+            else:
+                return binmessage.changes_to_delta_frame(table,
+                    self.table_changes, self.table_seq)
+        stabl = message.state_to_stabl(self.table_state)
+        if kind == 'stabl':
+            msg = stabl
+        elif kind == 'ssnap':
+            msg = message.stabl_to_ssnap(stabl, self.table_seq)
+        else:
+            msg = message.changes_to_sdelt(self.table_changes, self.table_seq)
+        return bytes(msg, 'ascii')
 
     def send_slobb(self):
+        """Schedule a lobby update. Updates are coalesced for SLOBBWINDOW
+        seconds so a burst of lobby changes sends one roster per subscriber.
+        """
+        if SLOBBWINDOW <= 0:
+            self.flush_slobb()
+        elif not self.slobb_timer:
+            self.slobb_timer = self.call_later(SLOBBWINDOW, self.flush_slobb)
+
+    def flush_slobb(self):
+        """Send the latest lobby roster, or just the names added and removed
+        since the last one to clients that support it, unless the order
+        changed otherwise.
+        """
         global lobby
+        self.slobb_timer = None
+        names = [player.name for player in lobby]
         msg = message.lobby_to_slobb(lobby)
-        logging.info('Server broadcasting: ' + msg)
-        for client in self.clients.values():
-            client.add_to_buffer(msg)
-
-    def send_schat(self, name, chat):
+        sldel = None
+        changed = names != self.slobb_names
+        if self.slobb_names is not None and changed:
+            added = [name for name in names if name not in self.slobb_names]
+            removed = [name for name in self.slobb_names if name not in names]
+            sldel = message.lobby_changes_to_sldel(added, removed)
+            if message.apply_sldel(self.slobb_names, sldel) != names:
+                # players were put back ahead of others, e.g. after a game,
+                # which a delta can't say
+                sldel = msg
+        msg_log.info('Server broadcasting: %s', msg)
+        clients = self.topics.subscribers_of(pubsub.LOBBY)
+        FANOUT.observe(len(clients), 'slobb')
+        for client in clients:
+            if not client.lobby_synced:
+                client.add_to_buffer(msg)
+                client.lobby_synced = True
+            elif client.lobby_delta:
+                if sldel:
+                    client.add_to_buffer(sldel)
+            elif changed:
+                client.add_to_buffer(msg)
+        self.slobb_names = names
+
+    def send_schat(self, name, chat, topic=pubsub.CHAT):
         assert(len(chat) <= 63)
         msg = '[schat|{}|{}]'.format(name.ljust(8), chat.ljust(63))
-        logging.info('Server broadcasting: ' + msg)
-        for client in self.clients.values():
-            client.add_to_buffer(msg)
+        msg_log.info('Server broadcasting: %s', msg)
+        FANOUT.observe(self.topics.publish(topic, msg), 'schat')
+
+    # Game flow, driven by lobby events and timers
+    def check_lobby(self):
+        """Called when the lobby changes. Starts a game straight away if the
+        table can be filled, otherwise gives late comers LOBBYTIMEOUT seconds
+        once MINPLAYERS are waiting.
+        """
+        if table.players or self.start_timer:
+            # game already running or about to start
+            return
+        if len(lobby) >= common.TABLESIZE or self.bots_needed():
+            self.start_table_soon()
+        elif len(lobby) >= MINPLAYERS:
+            if not self.lobby_timer:
+                logging.info('Enough players, starting game in %s seconds',
+                    LOBBYTIMEOUT)
+                self.lobby_timer = self.call_later(LOBBYTIMEOUT,
+                    self.start_table_soon)
+        elif self.lobby_timer:
+            logging.info('Not enough players, waiting for more')
+            self.lobby_timer.cancel()
+            self.lobby_timer = None
+
+    def start_table_soon(self):
+        """Start the game once the current event is done being handled."""
+        if self.lobby_timer:
+            self.lobby_timer.cancel()
+            self.lobby_timer = None
+        if not self.start_timer:
+            self.start_timer = self.call_later(0, self.start_table)
+
+    def start_table(self, seed=None):
+        global lobby
+        if self.start_timer:
+            self.start_timer.cancel()
+        self.start_timer = None
+        if table.players or len(lobby) + self.bots_needed() < MINPLAYERS:
+            self.check_lobby()
+            return
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.log_event('start', seed)
+        for i in range(self.bots_needed()):
+            lobby.append(self.add_bot().player)
 
-    def send_hands(self):
-        hands = table.deal()
+        # move players from lobby to table
+        for player in lobby[:common.TABLESIZE]:
+            try:
+                self.add_player_to_table(player_to_client[player]._uid, player)
+            except KeyError as e:
+                pass
+        lobby = lobby[common.TABLESIZE:]
+        self.send_slobb()
+
+        logging.info('Table ready, game starting, number players: %s',
+            len(table.players))
+
+        # deal the cards
+        self.send_hands(seed)
+
+        if not self.swap_timeout:
+            # send the initial stabl
+            self.send_stabl()
+            self.restart_turn_timer()
+
+    def restart_turn_timer(self):
+        """Give whoever's turn it is TURNTIMEOUT seconds to play."""
+        if self.turn_timer:
+            self.turn_timer.cancel()
+        self.turn_timer = self.call_later(TURNTIMEOUT, self.turn_timedout)
+
+    def turn_timedout(self):
+        self.log_event('timeout', 'turn')
+        TIMEOUTS.inc('turn')
+        self.turn_timer = None
+        self.play_timedout()
+        if table.players:
+            self.restart_turn_timer()
+
+    def send_hands(self, seed):
+        hands = table.deal(random.Random(seed))
         assert(len(table.players) == len(hands))
         assert(len(self.clients_at_table) == len(hands))
         if table.starting_round:
@@ -329,41 +1389,59 @@ class GameServer(asyncore.dispatcher):
             msg = '[swapw|{}]'.format(card_from_scum)
             player_to_client[warlord].add_to_buffer(msg)
             
-            # wait for response
+            # wait for response, finish_swap takes care of the rest
             logging.info("Offered warlord swap, waiting for response")
-            self.swap_timeout = time.time() + TURNTIMEOUT
-            while asyncore.socket_map:
-                asyncore.loop(timeout=0.5, count=1)
-                if not self.swap_timeout:
-                    # the warlord sent the cswap
-                    # remove the card from the scumbags hand
-                    scumbag.hand.remove(card_from_scum)
-                    # send the scumbag swaps
-                    msg = '[swaps|{}|{}]'.format(scumbag.hand[-1], card_from_scum)
-                    player_to_client[scumbag].add_to_buffer(msg)
-                    logging.info("Swap completed succesfully")
-                    break
-                elif time.time() > self.swap_timeout:
-                    logging.info("Warlord timed out in swap, giving original hand")
-                    # swap timed out
-                    # send warlord strike
-                    player_to_client[warlord].send_strike('20')
-                    # resend warlord his old hand
-                    warlord.hand.remove(card_from_scum)
-                    player_to_client[warlord].send_shand()
-                    # send swaps to scumbag
-                    player_to_client[scumbag].add_to_buffer('[swaps|52|52]')
-                    # reset the timeout
-                    self.swap_timeout = None
-                    break
-            # send scumbag his hand
-            msg = message.hand_to_msg(scumbag.hand)
-            player_to_client[scumbag].send_shand()
-            # set the warlord's status to active
-            table.players[0].status = 'a'
-            self.first_play = True
-                
+            self.swap_card = card_from_scum
+            self.swap_timeout = self.call_later(TURNTIMEOUT, self.finish_swap,
+                False)
+            if isinstance(player_to_client[warlord], BotHandler):
+                player_to_client[warlord].wake()
+
+    def finish_swap(self, swapped):
+        """Called when the warlord sent their cswap, or timed out if not
+        swapped.
+        """
+        warlord = table.players[0]
+        scumbag = table.players[-1]
+        card_from_scum = self.swap_card
+        if self.swap_timeout:
+            self.swap_timeout.cancel()
+        self.swap_timeout = None
+        self.swap_card = None
+        if swapped:
+            # the warlord sent the cswap
+            # remove the card from the scumbags hand
+            scumbag.hand.remove(card_from_scum)
+            # send the scumbag swaps
+            msg = '[swaps|{}|{}]'.format(scumbag.hand[-1], card_from_scum)
+            player_to_client[scumbag].add_to_buffer(msg)
+            logging.info("Swap completed succesfully")
+        else:
+            self.log_event('timeout', 'swap')
+            TIMEOUTS.inc('swap')
+            logging.info("Warlord timed out in swap, giving original hand")
+            # swap timed out
+            # send warlord strike
+            player_to_client[warlord].send_strike('20')
+            # resend warlord his old hand
+            warlord.hand.remove(card_from_scum)
+            player_to_client[warlord].send_shand()
+            # send swaps to scumbag
+            player_to_client[scumbag].add_to_buffer('[swaps|52|52]')
+        # send scumbag his hand
+        player_to_client[scumbag].send_shand()
+        # set the warlord's status to active
+        table.players[0].status = 'a'
+        self.first_play = True
+        self.send_stabl()
+        self.restart_turn_timer()
+
     def handle_cswap(self, client, msg):
+        self.handle_swap(client, int(msg[7:9]))
+
+    def handle_swap(self, client, card):
+        if client.player:
+            self.log_event('swap', client.player.name, card)
         if not self.swap_timeout:
             # we are not waiting for a swap, this is invalid
             logging.info("Unexpected cswap message received")
@@ -377,20 +1455,21 @@ class GameServer(asyncore.dispatcher):
                 logging.info("Non-warlord client sent swapw")
                 return
             # check that the warlord has the card
-            card = int(msg[7:9])
             if card not in client.player.hand:
                 # doesn't have the card, let them try again
                 logging.info("Warlord tried to swap a card they don't have, " +
                     "going to let them try again")
                 client.send_strike('70')
                 client.send_shand()
-                self.swap_timeout += TURNTIMEOUT
+                deadline = self.swap_timeout.deadline + TURNTIMEOUT
+                self.swap_timeout.cancel()
+                self.swap_timeout = self.scheduler.call_at(deadline,
+                    self.finish_swap, False)
                 return
             # passed all checks, move card into scumbags hand
             client.player.hand.remove(card)
             table.players[-1].hand.append(card)
-            self.swap_timeout = None
-            # send_hands will take care of the rest
+            self.finish_swap(True)
 
     def play_timedout(self):
         who = None
@@ -404,14 +1483,20 @@ class GameServer(asyncore.dispatcher):
             server.finish_game()
             return
         client = player_to_client[who]
-        # pass for him
+        # pass for him, the next player leads without the 3 of clubs
         table.play_cards(who, [])
+        self.first_play = False
         client.send_strike('20')
         self.send_stabl()
+        if len(table.active_players()) <= 1:
+            self.finish_game()
 
     def finish_game(self):
         global lobby
         logging.info('Game ended, new game starting')
+        if self.turn_timer:
+            self.turn_timer.cancel()
+            self.turn_timer = None
         # send one last stabl
         self.send_stabl()
         table.starting_round = False
@@ -423,14 +1508,418 @@ class GameServer(asyncore.dispatcher):
             # get the asshole off the table
             table.winners.append(active_players[0])
         # reset the table
+        for player in table.players:
+            self.unsubscribe_from_table(player_to_client[player])
+            if player.status == 'd':
+                # left during the game
+                del player_to_client[player]
         table.players = []
         self.clients_at_table = []
+        for bot in list(self.bots):
+            # done filling in
+            bot.player.status = 'd'
+            self.remove_bot(bot)
         # add players back into lobby 
-        lobby = table.winners + lobby
+        lobby = [player for player in table.winners
+            if player.status != 'd'] + lobby
         table.winners = []
 
         # send a lobby update message
         server.send_slobb()
+        if len(lobby) >= MINPLAYERS:
+            # they were all waiting at the table, deal them in again
+            self.start_table_soon()
+        else:
+            self.check_lobby()
+
+    # Event log and recovery
+    def log_event(self, *event):
+        """Log a state changing event, if keeping state."""
+        if self.eventlog:
+            self.eventlog.append(*event)
+
+    def start_event_log(self, path, fsync=True, seq=None):
+        """Recover the games kept in path, then keep logging to it. Given
+        seq, the games were handed over by a server that logged up to event
+        seq and there is nothing to recover.
+        """
+        if seq is None:
+            state, events = eventlog.recover(path)
+            seq = self.recover(state, events)
+            logging.info('Recovered %s players from %s, replayed %s events',
+                len(lobby) + len(table.players), path, len(events))
+        self.eventlog = eventlog.EventLog(path, self.scheduler, seq, fsync)
+        self.take_snapshot()
+
+    def take_snapshot(self):
+        if self.snapshot_timer:
+            self.snapshot_timer.cancel()
+        self.eventlog.snapshot(self.snapshot())
+        self.snapshot_timer = self.call_later(SNAPSHOTINTERVAL,
+            self.take_snapshot)
+
+    def snapshot(self):
+        """Return the game state as a dict of plain data."""
+        def player_state(player):
+            return [player.name, player.status, player.strikes,
+                list(player.hand)]
+        return {
+            'players': [player_state(player) for player in table.players],
+            'winners': [player.name for player in table.winners],
+            # copied, the snapshot is written out on another thread
+            'played_cards': [list(cards) for cards in table.played_cards],
+            'turn': table.turn,
+            'starting_round': table.starting_round,
+            'lobby': [player_state(player) for player in lobby],
+            'spectators': [player_state(player) for player in spectators],
+            'bots': [bot.player.name for bot in self.bots],
+            'first_play': self.first_play,
+            'swap_card': self.swap_card,
+            }
+
+    def restore(self, state):
+        """Replace the game state with a snapshot, every player gets an
+        OrphanHandler until their client joins again.
+        """
+        global lobby
+        global spectators
+        def restore_player(player_state):
+            name, status, strikes, hand = player_state
+            player = common.Player(name)
+            player.status = status
+            player.strikes = strikes
+            player.hand = list(hand)
+            if name in state.get('bots', ()):
+                self.add_bot(player)
+            else:
+                self.add_orphan(player)
+            return player
+        lobby = [restore_player(ps) for ps in state['lobby']]
+        spectators = [restore_player(ps) for ps in state.get('spectators', [])]
+        for player in spectators:
+            self.subscribe_spectator(player_to_client[player])
+        table.players = []
+        self.clients_at_table = []
+        for player_state in state['players']:
+            player = restore_player(player_state)
+            self.add_player_to_table(player_to_client[player]._uid, player)
+        # add_player_to_table resets the status
+        for player, player_state in zip(table.players, state['players']):
+            player.status = player_state[1]
+        table.winners = [player for player in table.players
+            if player.name in state['winners']]
+        table.played_cards = state['played_cards']
+        table.turn = state['turn']
+        table.starting_round = state['starting_round']
+        self.first_play = state['first_play']
+        self.swap_card = state['swap_card']
+
+    def recover(self, state, events):
+        """Rebuild the game state from a snapshot and the events logged after
+        it, returns the sequence number of the last event.
+        """
+        seq = 0
+        if state:
+            self.restore(state)
+            seq = state['seq']
+        for event in events:
+            self.replay_event(*event[1:])
+            seq = event[0]
+        self.resume()
+        return seq
+
+    def resume(self, time_left=None):
+        """Pick up where the timers of restored games left off, giving the
+        turn or swap time_left seconds, TURNTIMEOUT if None.
+        """
+        if time_left is None:
+            time_left = TURNTIMEOUT
+        self.update_table_state()
+        if self.swap_card is not None:
+            if not self.swap_timeout:
+                self.swap_timeout = self.call_later(time_left,
+                    self.finish_swap, False)
+        elif table.players and not self.turn_timer:
+            self.turn_timer = self.call_later(time_left, self.turn_timedout)
+        for bot in self.bots:
+            bot.wake()
+        self.check_lobby()
+
+    def replay_event(self, kind, *args):
+        """Apply a logged event by running the code that logged it."""
+        if kind == 'join':
+            self.add_orphan().handle_cjoin('[cjoin|{}]'.format(
+                args[0].ljust(8)))
+        elif kind == 'start':
+            self.start_table(args[0])
+        elif kind == 'timeout' and args[0] == 'turn':
+            self.turn_timedout()
+        elif kind == 'timeout' and args[0] == 'swap':
+            self.finish_swap(False)
+        else:
+            client = player_to_client.get(self.find_player(args[0]))
+            if not isinstance(client, OrphanHandler) or client.closed:
+                logging.warning('Event for unknown player: %s %s', kind, args)
+            elif kind == 'play':
+                client.handle_play(args[1])
+            elif kind == 'swap':
+                self.handle_swap(client, args[1])
+            elif kind == 'strike':
+                client.send_strike(args[1])
+            elif kind == 'leave':
+                client.handle_close()
+            elif kind == 'spectate' and args[1]:
+                self.spectate(client)
+            elif kind == 'spectate':
+                self.stop_spectating(client)
+
+    def add_orphan(self, player=None):
+        """Return a new OrphanHandler for player."""
+        orphan = OrphanHandler(self._next_uid)
+        self.clients[self._next_uid] = orphan
+        self._next_uid += 1
+        if player:
+            orphan.player = player
+            self.register_player(orphan, player)
+            self.topics.subscribe(pubsub.LOBBY, orphan)
+            self.topics.subscribe(pubsub.CHAT, orphan)
+        return orphan
+
+    def find_player(self, name):
+        for player in lobby + table.players + spectators:
+            if player.name == name:
+                return player
+        return None
+
+    def find_orphan(self, name):
+        """Return OrphanHandler of player called name, if they have one."""
+        client = player_to_client.get(self.find_player(name))
+        if (isinstance(client, OrphanHandler) and
+                not isinstance(client, BotHandler) and not client.closed):
+            return client
+        return None
+
+    def adopt_orphan(self, orphan, client):
+        """Hand the orphan's player, seat and subscriptions to client."""
+        player = orphan.player
+        client.player = player
+        self.register_player(client, player)
+        client_to_player.pop(orphan, None)
+        if orphan._uid in self.clients_at_table:
+            self.clients_at_table[self.clients_at_table.index(orphan._uid)] = (
+                client._uid)
+        for topic in list(orphan.topics):
+            self.topics.unsubscribe(topic, orphan)
+            self.topics.subscribe(topic, client)
+        self.clients.pop(orphan._uid, None)
+        orphan.player = None
+        orphan.close()
+
+    # Administration
+    def handle_admin(self, args):
+        """Run an admin command, returns the answer as text."""
+        command = args[0] if args else None
+        if command == 'metrics':
+            return metrics.REGISTRY.render()
+        elif command == 'clients':
+            return self.describe_clients()
+        elif command == 'traces' and len(args) <= 2:
+            try:
+                return tracer.export(int(args[1]) if len(args) == 2 else None)
+            except ValueError as ex:
+                return '{}\n'.format(ex)
+        elif command == 'profile' and args[1:2] == ['stop']:
+            return self.stop_profile()
+        elif command == 'profile' and len(args) in (2, 3):
+            try:
+                seconds = float(args[2]) if len(args) == 3 else None
+                return self.start_profile(args[1], seconds)
+            except ValueError as ex:
+                return '{}\n'.format(ex)
+        elif command == 'memory' and args[1:2] == ['start'] and len(args) <= 3:
+            try:
+                return self.start_memory_profile(float(args[2])
+                    if len(args) == 3 else MEMORYINTERVAL)
+            except ValueError as ex:
+                return '{}\n'.format(ex)
+        elif command == 'memory' and args[1:] == ['stop']:
+            return self.stop_memory_profile()
+        elif command == 'memory' and len(args) <= 2:
+            if not self.memory:
+                return 'No memory profile running\n'
+            try:
+                return self.memory.describe(int(args[1]) if len(args) == 2
+                    else memprofile.TOPGROWERS)
+            except ValueError as ex:
+                return '{}\n'.format(ex)
+        return ('Unknown command, commands are: metrics, clients, '
+            'traces [count], profile cprofile|sample [seconds], '
+            'profile stop, memory [count], memory start [seconds], '
+            'memory stop\n')
+
+    def describe_clients(self):
+        """One line per connection: uid, name, smoothed round trip time and
+        bytes waiting to be sent, slowest first.
+        """
+        clients = [client for client in self.clients.values()
+            if client.connected]
+        clients.sort(key=lambda client: (client.rtt is not None,
+            client.rtt or 0, len(client.out_buffer)), reverse=True)
+        lines = []
+        for client in clients:
+            lines.append('{:<6} {:<8} {:>10} {:>8}{}'.format(client._uid,
+                client.player.name if client.player else '-',
+                '{:.1f}ms'.format(client.rtt * 1000) if client.rtt is not None
+                    else '-',
+                len(client.out_buffer), ' slow' if client.slow() else ''))
+        return ''.join(line + '\n' for line in lines)
+
+    # Profiling
+    def start_profile(self, kind, seconds=None):
+        """Profile the main loop with a profiler session of kind for
+        seconds, PROFILESECONDS if None. Returns a description for admins.
+        """
+        if self.profile:
+            return 'Already running a {} session\n'.format(self.profile.kind)
+        self.profile = profiler.session(kind, PROFILEDIR)
+        self.profile.start()
+        self.profile_timer = self.call_later(seconds or PROFILESECONDS,
+            self.stop_profile)
+        logging.info('Started %s profiling session', kind)
+        return 'Started {} session\n'.format(kind)
+
+    def stop_profile(self):
+        """Stop the profiler session and write its results."""
+        if not self.profile:
+            return 'No profiling session running\n'
+        self.profile_timer.cancel()
+        files = self.profile.stop()
+        self.profile = None
+        logging.info('Wrote profile to %s', ', '.join(files))
+        return 'Wrote {}\n'.format(', '.join(files))
+
+    def start_memory_profile(self, interval):
+        """Trace allocations, writing a memory snapshot every interval
+        seconds, only when stopped if 0. Returns a description for admins.
+        """
+        if self.memory:
+            return 'Already profiling memory\n'
+        self.memory = memprofile.MemoryProfiler(PROFILEDIR)
+        self.memory.start()
+        if interval > 0:
+            self.memory_timer = self.call_later(interval,
+                self.take_memory_snapshot, interval)
+        logging.info('Started memory profile, writing %s', self.memory.path)
+        return 'Started memory profile\n'
+
+    def take_memory_snapshot(self, interval):
+        self.memory.snapshot()
+        self.memory_timer = self.call_later(interval,
+            self.take_memory_snapshot, interval)
+
+    def stop_memory_profile(self):
+        """Write a last memory snapshot and stop tracing allocations."""
+        if not self.memory:
+            return 'No memory profile running\n'
+        if self.memory_timer:
+            self.memory_timer.cancel()
+            self.memory_timer = None
+        self.memory.snapshot()
+        files = self.memory.stop()
+        self.memory = None
+        logging.info('Wrote memory profile to %s', ', '.join(files))
+        return 'Wrote {}\n'.format(', '.join(files))
+
+    def request_profile(self, kind):
+        """Ask for a profiling session of kind to be started or stopped, from
+        a signal handler. The main loop does it in toggle_profile, a signal
+        may land anywhere, e.g. while timers are being run.
+        """
+        self.profile_request = kind
+        self.waker.wake()
+
+    def toggle_profile(self):
+        """Start or stop the profiling session a signal asked for."""
+        kind, self.profile_request = self.profile_request, None
+        if not kind:
+            return
+        if self.profile:
+            self.stop_profile()
+        else:
+            self.start_profile(kind)
+
+    # Hot upgrade
+    def hand_over(self, sock):
+        """Hand the listening socket, client connections and games to the
+        new server process connected on sock, then stop. If the handoff
+        fails, carry on serving.
+        """
+        sock.setblocking(True)
+        logging.info('Handing over to new server process')
+        self.run_backlog(None)
+        # orphans have no connection to hand over
+        clients = [client for client in self.clients.values()
+            if client.connected]
+        statedir, seq = None, 0
+        if self.eventlog:
+            # the new server logs on from the last event we logged
+            statedir, fsync = self.eventlog.path, self.eventlog.fsync
+            seq = self.eventlog.seq
+            self.take_snapshot()
+            self.snapshot_timer.cancel()
+            self.eventlog.close()
+            self.eventlog = None
+        timer = self.swap_timeout or self.turn_timer
+        state = {
+            'game': self.snapshot(),
+            'clients': [client.handoff_state() for client in clients],
+            'table_seq': self.table_seq,
+            'slobb_names': self.slobb_names,
+            'time_left': timer.deadline - self.scheduler.time()
+                if timer and not timer.cancelled else None,
+            'seq': seq,
+            }
+        fds = [self.socket.fileno()]
+        fds += [client.socket.fileno() for client in clients]
+        try:
+            handoff.send(sock, state, fds)
+        except (OSError, handoff.HandoffError) as ex:
+            logging.error('Handoff failed, carrying on: %s', ex)
+            if statedir:
+                self.start_event_log(statedir, fsync, seq)
+            return
+        finally:
+            sock.close()
+        logging.info('Handed over %s connections', len(clients))
+        # the new server has the sockets now, closing ours doesn't close
+        # the connections and the new server listens on the upgrade socket
+        for client in clients:
+            client.close()
+        self.clients = {}
+        self.upgrade_listener.close()
+        self.upgrade_listener = None
+        if self.admin_listener:
+            self.admin_listener.close()
+            self.admin_listener = None
+        stop()
+
+    def take_over(self, state, fds):
+        """Carry on serving the games and clients of the server that sent
+        state and the client sockets fds.
+        """
+        self.restore(state['game'])
+        self.table_seq = state['table_seq']
+        self.slobb_names = state['slobb_names']
+        for client_state, fd in zip(state['clients'], fds):
+            client = PlayerHandler(self._next_uid, socket.socket(fileno=fd))
+            self.clients[self._next_uid] = client
+            self._next_uid += 1
+            client.take_over(client_state)
+            if client_state['name'] is not None:
+                self.adopt_orphan(self.find_orphan(client_state['name']),
+                    client)
+        logging.info('Took over %s connections', len(fds))
+        self.resume(state['time_left'])
 
 def mangle_name(current_names, name):
     name_regex = '^[a-zA-Z_]\w{0,7}$'
@@ -466,96 +1955,80 @@ def start_server():
     global server
     global RUNNING
     RUNNING = True
-    server = GameServer(common.HOST, common.PORT)
+    if TAKEOVER:
+        sock = handoff.connect(UPGRADESOCKET)
+        try:
+            state, fds = handoff.recv(sock)
+        finally:
+            sock.close()
+        server = GameServer(common.HOST, common.PORT,
+            sock=socket.socket(fileno=fds[0]))
+        server.take_over(state, fds[1:])
+    else:
+        state = None
+        server = GameServer(common.HOST, common.PORT)
+    if RECORD:
+        server.recorder = capture.Recorder(RECORD, server.scheduler)
+    if STATEDIR:
+        server.start_event_log(STATEDIR, FSYNC, state['seq'] if state else None)
+    if UPGRADESOCKET:
+        server.upgrade_listener = UpgradeListener(UPGRADESOCKET)
+    if ADMINSOCKET:
+        server.admin_listener = AdminListener(ADMINSOCKET)
+    if MEMORYINTERVAL:
+        server.start_memory_profile(MEMORYINTERVAL)
+
+def install_timers():
+    """Time the steps of handling a message into HANDLER_SECONDS."""
+    PlayerHandler.parse_msgs = metrics.timed(HANDLER_SECONDS,
+        'parse_msgs')(PlayerHandler.parse_msgs)
+    common.Table.play_cards = metrics.timed(HANDLER_SECONDS,
+        'play_cards')(common.Table.play_cards)
+    message.table_state = metrics.timed(HANDLER_SECONDS,
+        'table_state')(message.table_state)
+    message.state_to_stabl = metrics.timed(HANDLER_SECONDS,
+        'state_to_stabl')(message.state_to_stabl)
+    binmessage.table_to_frame = metrics.timed(HANDLER_SECONDS,
+        'table_to_frame')(binmessage.table_to_frame)
 
 def start_server_in_thread():
     server_thread = threading.Thread(target=main)
     server_thread.start()
     return server, server_thread
 
-def wait_for_players():
-    global RUNNING
-    global LOBBYTIMEOUT
-    timeout = time.time() + LOBBYTIMEOUT
-    while asyncore.socket_map and RUNNING:
-        asyncore.loop(timeout=0.5, count=1)
-        if time.time() > timeout or len(lobby) >= 7:
-            break
+def poll(timeout):
+    """Wait up to timeout seconds for socket activity, then start or stop
+    profiling if a signal asked to, run any timers that are due and some of
+    the messages waiting behind game messages.
+    """
+    if server.backlog:
+        # only pick up what arrived meanwhile
+        timeout = 0
+    asyncore.loop(timeout=server.scheduler.timeout(timeout), count=1,
+        use_poll=True)
+    server.toggle_profile()
+    server.scheduler.run_timers()
+    server.run_backlog()
 
 def main_loop():
-    global RUNNING
-    global TURNTIMEOUT
-    global lobby
-    turntimeout = time.time() + TURNTIMEOUT
+    """Serve clients until stopped. Everything the game does is driven by
+    socket events and timers, so this sleeps until one of them happens.
+    """
     while asyncore.socket_map and RUNNING:
-        if len(table.players) < 2:
-            server.finish_game()
-            # start a new game
-            while not len(lobby) >= MINPLAYERS:
-                wait_for_players()
-                logging.info('Table not ready, players: {}'.format([p.name for p in lobby]))
-
-            # move players from lobby to table
-            for player in lobby[:7]:
-                try:
-                    server.add_player_to_table(player_to_client[player]._uid, player)
-                except KeyError as e:
-                    pass
-            lobby = lobby[7:]
-            server.send_slobb()
-
-            logging.info('Table ready, game starting, number players: {}'.format(len(lobby)))
-            
-            # deal the cards
-            server.send_hands()
-
-            # send the initial stabl
-            server.send_stabl()
-        # wait for players to play
-        turntimeleft = turntimeout - time.time()
-        if turntimeleft > 0:
-            asyncore.loop(timeout=turntimeleft, count = 1)
-        if server.new_play:
-            server.new_play = False
-            turntimeout = time.time() + TURNTIMEOUT
-        else:
-            if turntimeout - time.time() <= 0.1:
-                # the client timed out
-                server.play_timedout()
-                turntimeout = time.time() + TURNTIMEOUT
-            else:
-                # they still have some time
-                pass
+        poll(None)
 
 def stop():
     global RUNNING
     RUNNING = False
+    if server:
+        server.waker.wake()
 
 def start_game():
-    global RUNNING
-    global lobby
-    global MINPLAYERS
-    while RUNNING:
-        while not len(lobby) >= MINPLAYERS:
-            wait_for_players()
-            logging.info('Table not ready, players: {}'.format([p.name for p in lobby]))
+    # a full lobby may be waiting already
+    server.check_lobby()
 
-        # move players from lobby to table
-        for player in lobby[:7]:
-            server.add_player_to_table(player_to_client[player]._uid, player)
-        lobby = lobby[7:]
-        server.send_slobb()
-
-        logging.info('Table ready, game starting, number players: {}'.format(len(table.players)))
-        
-        # deal the cards
-        server.send_hands()
-
-        # send the initial stabl
-        server.send_stabl()
-
-        # start the game
-        main_loop()
+    # start the game
+    main_loop()
 
     # shutdown server
     server.shutdown()
@@ -566,10 +2039,28 @@ def usage():
     print(__doc__)
 
 def parse_cmd_args(argv):
+    global SLOBBWINDOW
+    global SPECTATERATE
+    global BOTS
+    global BOTTHINK
+    global RECORD
+    global STATEDIR
+    global FSYNC
+    global SNAPSHOTINTERVAL
+    global UPGRADESOCKET
+    global TAKEOVER
+    global ADMINSOCKET
+    global LOGLEVELS
+    global LOGSAMPLE
+    global PROFILEDIR
+    global PROFILESECONDS
+    global MEMORYINTERVAL
+    global TIMERS
+    global PINGINTERVAL
     turntimeout, lobbytimeout, minplayers = 15, 15, 3 # defaults
 
     try:
-        opts, args = getopt.getopt(argv, 'ht:l:m:s:', ['help', 'turntimeout', 'minplayers', 'lobbytimeout', 'host'])
+        opts, args = getopt.getopt(argv, 'ht:l:m:s:w:p:e:qr:d:f:i:u:ka:g:y:P:o:Tn:j:M:R:V:b:B:', ['help', 'turntimeout', 'minplayers', 'lobbytimeout', 'host', 'slobbwindow=', 'port=', 'seed=', 'quiet', 'record=', 'statedir=', 'fsync=', 'snapshotinterval=', 'upgradesocket=', 'takeover', 'adminsocket=', 'loglevels=', 'logsample=', 'profiledir=', 'profileseconds=', 'timers', 'pinginterval=', 'tracesample=', 'memoryinterval=', 'ratelimits=', 'spectaterate=', 'bots=', 'botthink='])
 
         for opt, arg in opts:
             if opt in ('-h', '--help'):
@@ -583,11 +2074,61 @@ def parse_cmd_args(argv):
                 minplayers = int(arg)
             elif opt in ('-s', '--host'):
                 common.HOST = arg
+            elif opt in ('-w', '--slobbwindow'):
+                SLOBBWINDOW = max(float(arg), 0)
+            elif opt in ('-p', '--port'):
+                common.PORT = int(arg)
+            elif opt in ('-e', '--seed'):
+                random.seed(int(arg))
+            elif opt in ('-q', '--quiet'):
+                logging.getLogger().setLevel(logging.WARNING)
+            elif opt in ('-r', '--record'):
+                RECORD = arg
+            elif opt in ('-d', '--statedir'):
+                STATEDIR = arg
+            elif opt in ('-f', '--fsync'):
+                if arg not in ('always', 'never'):
+                    raise getopt.GetoptError(msg='Invalid fsync: ' + arg)
+                FSYNC = arg == 'always'
+            elif opt in ('-i', '--snapshotinterval'):
+                SNAPSHOTINTERVAL = max(float(arg), 1)
+            elif opt in ('-u', '--upgradesocket'):
+                UPGRADESOCKET = arg
+            elif opt in ('-k', '--takeover'):
+                TAKEOVER = True
+            elif opt in ('-a', '--adminsocket'):
+                ADMINSOCKET = arg
+            elif opt in ('-g', '--loglevels'):
+                LOGLEVELS = logpipe.parse_levels(arg)
+            elif opt in ('-y', '--logsample'):
+                LOGSAMPLE = max(int(arg), 1)
+            elif opt in ('-P', '--profiledir'):
+                PROFILEDIR = arg
+            elif opt in ('-o', '--profileseconds'):
+                PROFILESECONDS = max(float(arg), 1)
+            elif opt in ('-T', '--timers'):
+                TIMERS = True
+            elif opt in ('-n', '--pinginterval'):
+                PINGINTERVAL = max(float(arg), 0)
+            elif opt in ('-j', '--tracesample'):
+                tracer.sample = max(int(arg), 0)
+            elif opt in ('-M', '--memoryinterval'):
+                MEMORYINTERVAL = max(float(arg), 0)
+            elif opt in ('-b', '--bots'):
+                BOTS = max(int(arg), 0)
+            elif opt in ('-B', '--botthink'):
+                BOTTHINK = max(float(arg), 0)
+            elif opt in ('-V', '--spectaterate'):
+                SPECTATERATE = max(float(arg), 0)
+            elif opt in ('-R', '--ratelimits'):
+                ratelimit.LIMITS.update(ratelimit.parse_limits(arg))
             else:
                 raise getopt.GetoptError(msg='Invalid command line option')
+        if TAKEOVER and not UPGRADESOCKET:
+            raise getopt.GetoptError(msg='--takeover needs --upgradesocket')
 
-    except getopt.GetoptError as ex:
-        print(ex.msg)
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex.msg if isinstance(ex, getopt.GetoptError) else ex)
         usage()
         sys.exit()
     else:
@@ -604,15 +2145,31 @@ def main(argv):
     global LOBBYTIMEOUT
     global MINPLAYERS
     TURNTIMEOUT, LOBBYTIMEOUT, MINPLAYERS = parse_cmd_args(argv)
+    logpipe.set_levels(LOGLEVELS)
+    logpipe.sample(msg_log.name, LOGSAMPLE)
+    if TIMERS:
+        install_timers()
+    # log records are written out by a background thread
+    listener = logpipe.start()
+    try:
+        start_server()
+        logging.info('Game server started')
+        if threading.current_thread() is threading.main_thread():
+            # shut down cleanly when killed, e.g. by bench.py
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop())
+            signal.signal(signal.SIGUSR1,
+                lambda signum, frame: server.request_profile('cprofile'))
+            signal.signal(signal.SIGUSR2,
+                lambda signum, frame: server.request_profile('sample'))
 
-    start_server()
-    logging.info('Game server started')
-
-    start_game()
+        start_game()
 
-    logging.info('Game server shutdown')
+        logging.info('Game server shutdown')
+    finally:
+        logpipe.stop(listener)
 
 
 if __name__ == '__main__':
-    common.setup_logging()
+    # sent message traces are DEBUG, use -g server.msgs=debug to see them
+    common.setup_logging(level=logging.INFO)
     main(sys.argv[1:])
@@ -0,0 +1,132 @@
+"""Runs the server and automated clients in one process on simulated time.
+
+Clients talk to their PlayerHandlers through in-memory pipes instead of
+sockets, and whenever nothing is left to deliver the clock jumps to the next
+timer. Turn and swap timeouts and lobby waits cost no wall time, so whole
+games run as fast as the CPU allows.
+"""
+
+import common
+import random
+import server
+import client
+import clock
+import capture
+
+class Pipe:
+    """Client transport collecting what the client writes for delivery."""
+
+    def __init__(self):
+        self.pending = []
+        self.closed = False
+
+    def write(self, data):
+        self.pending.append(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+class SimPlayerHandler(server.PlayerHandler):
+    """PlayerHandler without a socket, output is left in out_buffer."""
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+        server.PlayerHandler.close(self)
+
+class Simulation:
+    """A server and its clients on a shared simulated clock.
+
+    The server module globals are reset, so only one simulation can run at a
+    time and not next to a real server in the same process.
+    """
+
+    def __init__(self, seed=None):
+        if seed is not None:
+            # deal the same cards every run
+            random.seed(seed)
+        self.clock = clock.SimClock()
+        self.scheduler = clock.Scheduler(self.clock)
+        server.table = common.Table()
+        server.lobby = []
+        server.spectators = []
+        server.client_to_player = {}
+        server.player_to_client = {}
+        server.server = server.GameServer('localhost', 0, self.scheduler)
+        self.server = server.server
+        self.links = []     # (client, pipe, handler)
+
+    def add_client(self, name, **kwargs):
+        """Connect a new automated client and send its cjoin."""
+        uid = self.server._next_uid
+        self.server._next_uid += 1
+        handler = SimPlayerHandler(uid)
+        self.server.clients[uid] = handler
+        if self.server.recorder:
+            self.server.recorder.record(uid, capture.OPEN)
+        bot = client.Client(name, scheduler=self.scheduler, **kwargs)
+        pipe = Pipe()
+        bot.connection_made(pipe)
+        self.links.append((bot, pipe, handler))
+        bot.send_msg(bot.join_msg())
+        return bot
+
+    def remove_client(self, bot):
+        """Disconnect the client and forget it."""
+        for link in self.links:
+            if link[0] is bot:
+                link[1].close()
+                self.deliver()
+                self.links.remove(link)
+                return
+
+    def deliver(self):
+        """Pass data both ways until nothing is left in flight."""
+        moved = True
+        while moved:
+            moved = False
+            for bot, pipe, handler in self.links:
+                if pipe.pending and not handler.closed:
+                    data = b''.join(pipe.pending)
+                    pipe.pending = []
+                    handler.receive(data)
+                    moved = True
+                if handler.out_buffer:
+                    data, handler.out_buffer = handler.out_buffer, b''
+                    handler.sent(len(data))
+                    if not pipe.closed:
+                        bot.data_received(data)
+                    moved = True
+                if pipe.closed and not handler.closed:
+                    handler.handle_close()
+                    moved = True
+                elif handler.closed and bot.run:
+                    pipe.closed = True
+                    bot.connection_lost(None)
+                    moved = True
+            if self.server.backlog:
+                # as the main loop does after every poll
+                self.server.run_backlog()
+                moved = True
+
+    def run(self, seconds):
+        """Run for seconds of simulated time."""
+        end = self.clock.time() + seconds
+        self.deliver()
+        while True:
+            deadline = self.scheduler.next_deadline()
+            if deadline is None or deadline > end:
+                break
+            self.scheduler.advance()
+            self.deliver()
+        self.clock.advance_to(end)
+
+    def close(self):
+        self.server.shutdown()
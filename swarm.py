@@ -0,0 +1,274 @@
+"""
+Description:
+    Runs a swarm of automated clients as coroutines on one event loop, to put
+    realistic concurrent load on a server from a single box. Bots can be
+    sharded across a pool of processes, each running its own event loop.
+
+Usage:
+    python3 swarm.py <args>
+
+Command line arguments:
+    -h, --help      Print this help.
+
+    -s, --host      Host name of server to connect to.
+
+    -p, --port      Port to connect to.
+
+    -n, --bots      Number of bots to run (default 100).
+
+    -j, --procs     Number of processes to shard the bots across (default 1).
+
+    -u, --duration  Seconds to run the swarm for (default 60).
+
+    -t, --think     Think time distribution, seconds a bot waits before
+                    playing:
+                        const:SECS, uniform:LOW:HIGH or exp:MEAN
+                    (default uniform:0.5:2).
+
+    -y, --strategy  Strategy bots play with: lowest, passive or random
+                    (default lowest).
+
+    -c, --churn     Mean seconds a bot stays connected before leaving, 0 to
+                    never leave (default 0).
+
+    -r, --rejoin    Mean seconds a bot waits before joining again after
+                    leaving or being turned away (default 1).
+
+    -e, --seed      Random seed, the same seed gives every bot the same think
+                    times, plays and churn.
+
+    -b, --binary    Bots ask the server for binary framing.
+
+    -d, --delta     Bots ask the server for table deltas.
+
+    -l, --lobbydelta    Bots ask the server for lobby deltas.
+"""
+
+import sys
+import common
+import client
+import logging
+import getopt
+import random
+import asyncio
+import resource
+import collections
+import concurrent.futures
+
+CONNECT_TIMEOUT = 5
+
+def passive_strategy(hand, last_play):
+    """Only play when leading, pass otherwise."""
+    if last_play:
+        return []
+    return common.lowest_card_strategy(hand, last_play)
+
+def random_strategy(rng):
+    """Return strategy playing a random single card that beats the last play,
+    sometimes passing even when it could play.
+    """
+    def strategy(hand, last_play):
+        if not last_play or (len(last_play) == 1 and last_play[0] // 4 == 12):
+            # leading, must play something
+            if 0 in hand:
+                # the 3 of clubs opens the starting round
+                return [0]
+            return [rng.choice(hand)]
+        elif len(last_play) == 1:
+            cards = [card for card in hand if card >= last_play[0]]
+            if cards and rng.random() > 0.2:
+                return [rng.choice(cards)]
+        return []
+    return strategy
+
+# strategy name -> function of a Random object returning the strategy
+STRATEGIES = {
+    'lowest': lambda rng: common.lowest_card_strategy,
+    'passive': lambda rng: passive_strategy,
+    'random': random_strategy,
+    }
+
+def parse_think(spec):
+    """Parse think time spec, return function of a Random object returning
+    seconds to think for.
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        args = [float(arg) for arg in args.split(':')] if args else []
+    except ValueError:
+        raise ValueError('invalid think time: {}'.format(spec))
+    if any(arg < 0 for arg in args):
+        raise ValueError('invalid think time: {}'.format(spec))
+    if kind == 'const' and len(args) == 1:
+        return lambda rng: args[0]
+    elif kind == 'uniform' and len(args) == 2 and args[0] <= args[1]:
+        return lambda rng: rng.uniform(args[0], args[1])
+    elif kind == 'exp' and len(args) == 1:
+        if args[0] == 0:
+            return lambda rng: 0
+        return lambda rng: rng.expovariate(1 / args[0])
+    raise ValueError('invalid think time: {}'.format(spec))
+
+def bot_name(i):
+    return 'b{:07d}'.format(i)
+
+async def run_bot(i, opts, stats, deadline, latencies=None):
+    """Keep bot i connected to the server until the deadline, leaving and
+    joining again when churn is on or the server turns it away. Seconds from
+    each play to the next table update are added to latencies if given.
+    """
+    loop = asyncio.get_running_loop()
+    rng = random.Random('{}/{}'.format(opts['seed'], i))
+    think = parse_think(opts['think'])
+    strategy = STRATEGIES[opts['strategy']](rng)
+
+    while loop.time() < deadline:
+        bot = client.Client(bot_name(i), binary=opts['binary'],
+            delta=opts['delta'], lobby_delta=opts['lobby_delta'],
+            think=lambda: think(rng), strategy=strategy)
+        try:
+            await asyncio.wait_for(bot.connect(opts['host'], opts['port']),
+                CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as ex:
+            logging.info('Bot %s failed to connect: %s', bot.name, ex)
+            stats['connect_errors'] += 1
+        else:
+            stats['connects'] += 1
+            lifetime = deadline - loop.time()
+            if opts['churn']:
+                lifetime = min(lifetime, rng.expovariate(1 / opts['churn']))
+            try:
+                await asyncio.wait_for(asyncio.shield(bot.closed),
+                    max(lifetime, 0))
+                stats['dropped'] += 1
+            except asyncio.TimeoutError:
+                if loop.time() < deadline:
+                    stats['left'] += 1
+                bot.disconnect()
+                await bot.closed
+            if bot.player:
+                stats['joined'] += 1
+            stats['msgs_sent'] += bot.msgs_sent
+            stats['msgs_received'] += bot.msgs_received
+            stats['games'] += bot.games_lost
+            if latencies is not None:
+                latencies.extend(bot.play_latencies)
+        rejoin = rng.expovariate(1 / opts['rejoin']) if opts['rejoin'] else 0
+        await asyncio.sleep(min(rejoin, max(deadline - loop.time(), 0)))
+
+async def run_swarm(opts, bots, latencies=None):
+    """Run the given bot numbers on the running event loop, returns stats."""
+    stats = collections.Counter()
+    deadline = asyncio.get_running_loop().time() + opts['duration']
+    await asyncio.gather(*[run_bot(i, opts, stats, deadline, latencies)
+        for i in bots])
+    return stats
+
+def run_shard(opts, bots):
+    """Entry point of a swarm process."""
+    logging.basicConfig(level=logging.WARNING)
+    raise_fd_limit()
+    return asyncio.run(run_swarm(opts, bots))
+
+def raise_fd_limit():
+    """Every bot needs a socket, so allow as many as the hard limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as ex:
+        logging.warning('Could not raise open file limit from %s: %s', soft,
+            ex)
+
+def swarm(opts):
+    """Run the swarm described by opts, returns the merged stats of every
+    process.
+    """
+    shards = [range(i, opts['bots'], opts['procs'])
+        for i in range(opts['procs'])]
+    if opts['procs'] == 1:
+        return run_shard(opts, shards[0])
+    stats = collections.Counter()
+    with concurrent.futures.ProcessPoolExecutor(opts['procs']) as pool:
+        for shard_stats in pool.map(run_shard, [opts] * opts['procs'], shards):
+            stats.update(shard_stats)
+    return stats
+
+def usage():
+    print(__doc__)
+
+def parse_cmd_args(argv):
+    opts = {    # defaults
+        'host': common.HOST,
+        'port': common.PORT,
+        'bots': 100,
+        'procs': 1,
+        'duration': 60,
+        'think': 'uniform:0.5:2',
+        'strategy': 'lowest',
+        'churn': 0,
+        'rejoin': 1,
+        'seed': 0,
+        'binary': False,
+        'delta': False,
+        'lobby_delta': False,
+        }
+
+    try:
+        opt_list, args = getopt.getopt(argv, 'hs:p:n:j:u:t:y:c:r:e:bdl', ['help', 'host=', 'port=', 'bots=', 'procs=', 'duration=', 'think=', 'strategy=', 'churn=', 'rejoin=', 'seed=', 'binary', 'delta', 'lobbydelta'])
+
+        for opt, arg in opt_list:
+            if opt in ('-h', '--help'):
+                usage()
+                sys.exit()
+            elif opt in ('-s', '--host'):
+                opts['host'] = arg
+            elif opt in ('-p', '--port'):
+                opts['port'] = int(arg)
+            elif opt in ('-n', '--bots'):
+                opts['bots'] = max(int(arg), 1)
+            elif opt in ('-j', '--procs'):
+                opts['procs'] = max(int(arg), 1)
+            elif opt in ('-u', '--duration'):
+                opts['duration'] = max(float(arg), 0)
+            elif opt in ('-t', '--think'):
+                parse_think(arg)
+                opts['think'] = arg
+            elif opt in ('-y', '--strategy'):
+                if arg not in STRATEGIES:
+                    raise getopt.GetoptError(msg='Unknown strategy: ' + arg)
+                opts['strategy'] = arg
+            elif opt in ('-c', '--churn'):
+                opts['churn'] = max(float(arg), 0)
+            elif opt in ('-r', '--rejoin'):
+                opts['rejoin'] = max(float(arg), 0)
+            elif opt in ('-e', '--seed'):
+                opts['seed'] = int(arg)
+            elif opt in ('-b', '--binary'):
+                opts['binary'] = True
+            elif opt in ('-d', '--delta'):
+                opts['delta'] = True
+            elif opt in ('-l', '--lobbydelta'):
+                opts['lobby_delta'] = True
+            else:
+                raise getopt.GetoptError(msg='Invalid command line option')
+
+    except (getopt.GetoptError, ValueError) as ex:
+        print(ex.msg if isinstance(ex, getopt.GetoptError) else ex)
+        usage()
+        sys.exit()
+    else:
+        opts['procs'] = min(opts['procs'], opts['bots'])
+        return opts
+
+def main(argv):
+    opts = parse_cmd_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    print('Running {} bots in {} processes for {} sec'.format(opts['bots'],
+        opts['procs'], opts['duration']))
+    stats = swarm(opts)
+    for key in sorted(stats):
+        print('{:>16}: {}'.format(key, stats[key]))
+    return stats
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,10 +5,39 @@ import common
 import server
 import client
 import message
+import binmessage
+import pubsub
+import swarm
+import bench
+import clock
+import simulation
+import capture
+import replay
+import eventlog
+import handoff
+import metrics
+import admin
+import logpipe
+import profiler
+import tracing
+import memprofile
+import ratelimit
+import clientgui
+import tempfile
+import subprocess
+import sys
+import shutil
+import os
 import socket
 import logging
 import time
 import threading
+import asyncio
+import random
+import json
+import tracemalloc
+import collections
+import gc
 
 
 class TestDeck(unittest.TestCase):
@@ -74,7 +103,8 @@ valid_cjoins = [
     '[cjoin|BillyBo ]',
     '[cjoin|bonnyho ]',
     '[cjoin|Tman    ]',
-    '[cjoin|chipdrip]'
+    '[cjoin|chipdrip]',
+    '[cjoin|chipjack|binary]'
     ]
 
 valid_sjoins = [
@@ -162,6 +192,1388 @@ class TestMessageHandling(unittest.TestCase):
         new_lobby = message.slobb_to_lobby(slobb)
         self.assertEqual([p.name for p in lobby], new_lobby)
 
+    def test_stime(self):
+        stime = message.timing_to_stime('cplay', 0.000012, 2.5)
+        self.assertEqual(stime, '[stime|cplay|000012|999999]')
+        self.assertTrue(message.is_valid(stime))
+        self.assertEqual(message.stime_to_timing(stime),
+            ('cplay', 0.000012, 0.999999))
+        self.assertTrue(message.is_valid('[cping|00001]'))
+        self.assertFalse(message.is_valid('[cping|1]'))
+
+class TestBinaryMessages(unittest.TestCase):
+    def setUp(self):
+        self.table = common.Table()
+        for i, name in enumerate(['chipjack', 'bob', 'a_1']):
+            player = common.Player(name)
+            player.status = 'wap'[i]
+            player.pickup_hand([i, i + 10, i + 20])
+            self.table.add_player(player)
+        self.table.played_cards = [[4, 5]]
+
+    def test_hand_frame(self):
+        hand = [0, 7, 33, 51]
+        frame = binmessage.hand_to_frame(hand)
+        self.assertEqual(len(frame), 11)
+        self.assertLess(len(frame), len(message.hand_to_msg(hand)))
+        frame, rest = binmessage.retrieve_frame_from_buff(frame)
+        self.assertEqual(rest, b'')
+        self.assertEqual(binmessage.frame_to_msg(frame),
+            message.hand_to_msg(hand))
+
+    def test_table_frame_matches_stabl(self):
+        stabl = message.table_to_stabl(self.table)
+        self.assertTrue(message.is_valid(stabl))
+        frame = binmessage.table_to_frame(self.table)
+        self.assertLess(len(frame), len(stabl))
+        frame, rest = binmessage.retrieve_frame_from_buff(frame)
+        self.assertEqual(binmessage.frame_to_msg(frame), stabl)
+
+    def test_mixed_buffer(self):
+        buff = b'[sjoin|bob     |binary]' + binmessage.msg_to_frame('[slobb|00|]')
+        buff += binmessage.play_to_frame([8, 9])
+        msg, buff = binmessage.retrieve_frame_from_buff(buff)
+        self.assertEqual(msg, '[sjoin|bob     |binary]')
+        self.assertEqual(message.capabilities(msg), ['binary'])
+        frame, buff = binmessage.retrieve_frame_from_buff(buff)
+        self.assertEqual(binmessage.frame_to_msg(frame), '[slobb|00|]')
+        # incomplete frames stay in the buffer
+        frame, rest = binmessage.retrieve_frame_from_buff(buff[:-1])
+        self.assertIsNone(frame)
+        frame, buff = binmessage.retrieve_frame_from_buff(buff)
+        self.assertEqual(frame, (binmessage.BIN_CPLAY, bytes([8, 9])))
+
+    def test_encode_cmsg(self):
+        frame = binmessage.encode_cmsg('[cplay|08,09,52,52]')
+        self.assertEqual(frame, binmessage.play_to_frame([8, 9]))
+        frame = binmessage.encode_cmsg('[cswap|03]')
+        self.assertEqual(frame, binmessage.swap_to_frame(3))
+        self.assertRaises(binmessage.FrameError, binmessage.bytes_to_cards,
+            bytes([52]))
+
+class TestTableDeltas(unittest.TestCase):
+    def setUp(self):
+        self.table = common.Table()
+        for name in ['chipjack', 'bob', 'a_1']:
+            player = common.Player(name)
+            player.status = 'w'
+            player.pickup_hand([len(self.table.players)])
+            self.table.add_player(player)
+        self.table.players[0].status = 'a'
+
+    def play(self):
+        old = message.table_state(self.table)
+        self.table.players[0].status = 'w'
+        self.table.players[1].status = 'a'
+        self.table.players[0].clear_hand()
+        self.table.played_cards.append([0])
+        return old, message.table_state(self.table)
+
+    def test_apply_sdelt(self):
+        old, new = self.play()
+        changes = message.diff_table_state(old, new)
+        self.assertEqual([c[0] for c in changes], ['s', 's', 'p'])
+        sdelt = message.changes_to_sdelt(changes, 42)
+        self.assertTrue(message.is_valid(sdelt), sdelt)
+        self.assertEqual(message.sdelt_seq(sdelt), 42)
+        self.assertLess(len(sdelt), len(message.state_to_stabl(new)))
+        stabl = message.apply_sdelt(message.state_to_stabl(old), sdelt)
+        self.assertEqual(stabl, message.state_to_stabl(new))
+
+    def test_ssnap(self):
+        stabl = message.table_to_stabl(self.table)
+        ssnap = message.stabl_to_ssnap(stabl, 7)
+        self.assertTrue(message.is_valid(ssnap), ssnap)
+        self.assertEqual(message.sdelt_seq(ssnap), 7)
+        self.assertEqual(message.ssnap_to_stabl(ssnap), stabl)
+        frame = binmessage.table_to_snapshot_frame(self.table, 7)
+        frame, rest = binmessage.retrieve_frame_from_buff(frame)
+        self.assertEqual(binmessage.frame_to_msg(frame), ssnap)
+
+    def test_binary_delta_frame(self):
+        old, new = self.play()
+        self.table.players.pop()
+        new = message.table_state(self.table)
+        changes = message.diff_table_state(old, new)
+        frame = binmessage.changes_to_delta_frame(self.table, changes, 3)
+        frame, rest = binmessage.retrieve_frame_from_buff(frame)
+        self.assertEqual(binmessage.frame_to_msg(frame),
+            message.changes_to_sdelt(changes, 3))
+
+class FakeSubscriber():
+    def __init__(self, lobby_delta=False):
+        self.topics = set()
+        self.sent = []
+        self.lobby_delta = lobby_delta
+        self.lobby_synced = False
+
+    def add_to_buffer(self, msg):
+        self.sent.append(msg)
+
+class TestTopics(unittest.TestCase):
+    def setUp(self):
+        self.topics = pubsub.Topics()
+        self.lobby = [FakeSubscriber() for i in range(3)]
+        self.seated = [FakeSubscriber() for i in range(2)]
+        for sub in self.lobby + self.seated:
+            self.topics.subscribe(pubsub.LOBBY, sub)
+        for sub in self.seated:
+            self.topics.subscribe(pubsub.table_topic(0), sub)
+
+    def test_publish_only_to_subscribers(self):
+        self.assertEqual(self.topics.publish(pubsub.table_topic(0), 'x'), 2)
+        self.assertEqual(self.topics.publish(pubsub.table_topic(1), 'y'), 0)
+        self.assertEqual(self.topics.publish(pubsub.LOBBY, 'z'), 5)
+        for sub in self.seated:
+            self.assertEqual(sub.sent, ['x', 'z'])
+        for sub in self.lobby:
+            self.assertEqual(sub.sent, ['z'])
+
+    def test_unsubscribe_all(self):
+        sub = self.seated[0]
+        self.topics.unsubscribe(pubsub.table_topic(0), sub)
+        self.assertEqual(sub.topics, {pubsub.LOBBY})
+        self.topics.unsubscribe_all(sub)
+        self.assertEqual(sub.topics, set())
+        self.assertEqual(list(self.topics.subscribers_of(pubsub.table_topic(0))),
+            [self.seated[1]])
+        self.topics.publish(pubsub.LOBBY, 'z')
+        self.assertEqual(sub.sent, [])
+
+class TestLobbyUpdates(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.SimClock()
+        self.server = server.GameServer('localhost', 0,
+            clock.Scheduler(self.clock))
+        self.legacy = FakeSubscriber()
+        self.delta = FakeSubscriber(lobby_delta=True)
+        for sub in (self.legacy, self.delta):
+            self.server.topics.subscribe(pubsub.LOBBY, sub)
+        self.window = server.SLOBBWINDOW
+        server.SLOBBWINDOW = 0.05
+        server.lobby = []
+
+    def tearDown(self):
+        server.SLOBBWINDOW = self.window
+        server.lobby = []
+        self.server.shutdown()
+
+    def join(self, *names):
+        for name in names:
+            server.lobby.append(common.Player(name))
+            self.server.send_slobb()
+
+    def test_coalesced(self):
+        self.join('a', 'b', 'c')
+        self.server.scheduler.run_timers()
+        self.assertEqual(self.legacy.sent, [])
+        self.clock.advance_to(server.SLOBBWINDOW)
+        self.server.scheduler.run_timers()
+        self.assertEqual(self.legacy.sent, [message.lobby_to_slobb(server.lobby)])
+        self.assertEqual(self.delta.sent, self.legacy.sent)
+
+    def test_sldel(self):
+        self.join('a', 'b')
+        self.server.flush_slobb()
+        server.lobby.pop(0)
+        self.join('c')
+        self.server.flush_slobb()
+        sldel = self.delta.sent[-1]
+        self.assertEqual(sldel, '[sldel|c|a]')
+        self.assertTrue(message.is_valid(sldel))
+        self.assertEqual(message.apply_sldel(['a', 'b'], sldel), ['b', 'c'])
+        self.assertEqual(self.legacy.sent[-1],
+            message.lobby_to_slobb(server.lobby))
+        # nothing changed, nothing sent
+        self.server.flush_slobb()
+        self.assertEqual(len(self.delta.sent), 2)
+        self.assertEqual(len(self.legacy.sent), 2)
+
+    def test_reordered(self):
+        self.join('a', 'b', 'c')
+        self.server.flush_slobb()
+        # back from the table ahead of those waiting
+        server.lobby.insert(0, common.Player('d'))
+        self.server.flush_slobb()
+        self.assertEqual(self.delta.sent[-1],
+            message.lobby_to_slobb(server.lobby))
+        server.lobby.append(server.lobby.pop(0))
+        self.server.flush_slobb()
+        self.assertEqual(self.delta.sent[-1],
+            message.lobby_to_slobb(server.lobby))
+
+class TestLobbyStart(unittest.TestCase):
+    def setUp(self):
+        self.server = server.GameServer('localhost', 0)
+        server.lobby = []
+
+    def tearDown(self):
+        server.lobby = []
+        self.server.shutdown()
+
+    def test_lobby_timer(self):
+        server.lobby = [common.Player(str(i)) for i in range(server.MINPLAYERS)]
+        self.server.check_lobby()
+        self.assertTrue(self.server.lobby_timer)
+        self.assertFalse(self.server.start_timer)
+        timer = self.server.lobby_timer
+        self.server.check_lobby()
+        self.assertIs(self.server.lobby_timer, timer)
+        server.lobby.pop()
+        self.server.check_lobby()
+        self.assertTrue(timer.cancelled)
+        self.assertIsNone(self.server.lobby_timer)
+
+    def test_full_lobby_starts_now(self):
+        server.lobby = [common.Player(str(i)) for i in range(common.TABLESIZE)]
+        self.server.check_lobby()
+        self.assertIsNone(self.server.lobby_timer)
+        self.assertEqual(self.server.start_timer.deadline,
+            self.server.scheduler.next_deadline())
+        self.assertEqual(self.server.scheduler.timeout(None), 0)
+
+class TestRateLimits(unittest.TestCase):
+    """Test token buckets and deferring messages behind game messages."""
+
+    CHAT = '[cchat|{}]'.format('hi'.ljust(63)).encode('ascii')
+
+    def setUp(self):
+        self.sim = simulation.Simulation(seed=0)
+        for i in range(2):
+            self.sim.add_client('bot{}'.format(i))
+        self.sim.run(1)
+        self.chatter, self.player = [link[2] for link in self.sim.links]
+
+    def tearDown(self):
+        self.sim.close()
+
+    def test_bucket(self):
+        bucket = ratelimit.TokenBucket(1, 3, 0)
+        self.assertEqual([bucket.take(0) for i in range(4)],
+            [True, True, True, False])
+        self.assertEqual(bucket.drops, 1)
+        self.assertTrue(bucket.take(1))
+        self.assertFalse(bucket.take(1.5))
+        # never more than the burst
+        self.assertEqual([bucket.take(100) for i in range(4)],
+            [True, True, True, False])
+
+    def test_parse_limits(self):
+        self.assertEqual(ratelimit.parse_limits('chat=2/10, hand=0'),
+            {'chat': (2, 10), 'hand': None})
+        for spec in ('chat', 'chat=x/1', 'chat=1/0', 'talk=1/1'):
+            with self.assertRaises(ValueError):
+                ratelimit.parse_limits(spec)
+
+    def test_game_messages_first(self):
+        self.chatter.receive(self.CHAT * 3 + b'[cping|00001]')
+        self.player.receive(b'[cping|00002]')
+        # the ping of the chatter waits behind its chats
+        self.assertEqual(len(self.sim.server.backlog), 4)
+        self.assertEqual(self.player.out_buffer, b'[spong|00002]')
+        self.sim.server.run_backlog(2)
+        self.assertEqual(self.player.out_buffer.count(b'[schat|'), 2)
+        self.sim.server.run_backlog()
+        self.assertEqual(self.player.out_buffer.count(b'[schat|'), 3)
+        self.assertTrue(self.chatter.out_buffer.endswith(b'[spong|00001]'))
+        self.assertEqual(self.chatter.deferred, 0)
+
+    def test_flood(self):
+        burst = ratelimit.LIMITS['chat'][1]
+        self.chatter.receive(self.CHAT * 100)
+        # the burst got through, the rest of the flood went with the strike
+        self.assertEqual(len(self.sim.server.backlog), burst)
+        self.assertIn(b'[strik|33|1]', self.chatter.out_buffer)
+        self.sim.server.run_backlog()
+        self.assertEqual(self.player.out_buffer.count(b'[schat|'), burst)
+        # the bucket fills up again
+        self.sim.clock.advance_to(self.sim.clock.time() + 3)
+        self.chatter.receive(self.CHAT * 5)
+        self.assertEqual(len(self.sim.server.backlog), 3)
+
+class TestSpectators(unittest.TestCase):
+    """Test watching a table without a seat."""
+
+    def setUp(self):
+        self.sim = simulation.Simulation(seed=0)
+        self.updates = collections.Counter()
+        self.last = {}
+
+    def tearDown(self):
+        self.sim.close()
+
+    def count_updates(self, bot):
+        process_msg = bot.process_msg
+        def count_msg(msg):
+            if message.msg_type(msg) in ('stabl', 'ssnap', 'sdelt'):
+                self.updates[bot.name] += 1
+                self.last[bot.name] = msg
+            process_msg(msg)
+        bot.process_msg = count_msg
+
+    def test_watch_game(self):
+        watchers = [self.sim.add_client('watch{}'.format(i), spectate=True,
+            delta=i == 1) for i in range(2)]
+        bots = [self.sim.add_client('bot{}'.format(i), think=lambda: 0.05)
+            for i in range(3)]
+        for bot in watchers + bots:
+            self.count_updates(bot)
+        self.sim.run(60)
+        self.assertEqual([player.name for player in server.spectators],
+            ['watch0', 'watch1'])
+        self.assertEqual(self.sim.server.snapshot()['spectators'][0][0],
+            'watch0')
+        # games follow one another, send the update still batched up
+        self.sim.server.flush_spectators()
+        self.sim.deliver()
+        stabl = message.state_to_stabl(self.sim.server.table_state)
+        self.assertEqual(self.last[watchers[0].name], stabl)
+        self.assertEqual(watchers[1].stabl, stabl)
+        for watcher in watchers:
+            self.assertTrue(watcher.run)
+            self.assertFalse(watcher.in_game)
+            # batched, but kept up
+            self.assertGreater(self.updates[watcher.name], 10)
+            self.assertLess(self.updates[watcher.name],
+                self.updates['bot0'] / 2)
+        # back in the lobby to play
+        watchers[0].send_msg(message.spectate_msg(0, False))
+        self.sim.run(1)
+        self.assertIn('watch0', [player.name for player in
+            server.lobby + server.table.players])
+        self.assertNotIn('watch0', [player.name for player in
+            server.spectators])
+
+    def test_one_encode(self):
+        bots = [self.sim.add_client('bot{}'.format(i)) for i in range(3)]
+        self.sim.run(server.LOBBYTIMEOUT + 1)
+        watchers = []
+        for i in range(200):
+            handler = simulation.SimPlayerHandler(1000 + i)
+            handler.player = common.Player('w{}'.format(i))
+            handler.binary = i % 2 == 0
+            self.sim.server.subscribe_spectator(handler)
+            watchers.append(handler)
+        encodes = []
+        encode = self.sim.server.encode_table_update
+        def count_encode(kind, binary):
+            encodes.append((kind, binary))
+            return encode(kind, binary)
+        self.sim.server.encode_table_update = count_encode
+        self.sim.server.flush_spectators()
+        self.assertEqual(sorted(encodes), [('stabl', False), ('stabl', True)])
+        self.assertEqual(len({handler.out_buffer for handler in watchers}), 2)
+
+    def test_seated_cant_spectate(self):
+        bots = [self.sim.add_client('bot{}'.format(i)) for i in range(3)]
+        self.sim.run(server.LOBBYTIMEOUT + 1)
+        handler = self.sim.links[0][2]
+        handler.receive(message.spectate_msg(0, True).encode('ascii'))
+        self.sim.server.run_backlog()
+        self.assertIn(b'[strik|30|1]', handler.out_buffer)
+        self.assertEqual(server.spectators, [])
+
+class TestBots(unittest.TestCase):
+    """Test bots filling in seats at the table."""
+
+    def setUp(self):
+        self.bots = server.BOTS
+        server.BOTS = server.MINPLAYERS - 1
+        self.sim = simulation.Simulation(seed=0)
+
+    def tearDown(self):
+        self.sim.close()
+        server.BOTS = self.bots
+
+    def test_play_with_bots(self):
+        games = []
+        finish_game = self.sim.server.finish_game
+        def count_game():
+            finish_game()
+            # bots leave with the game
+            games.append(([bot.player.name for bot in self.sim.server.bots],
+                [player.name for player in server.lobby],
+                len(server.client_to_player)))
+        self.sim.server.finish_game = count_game
+        human = self.sim.add_client('human', think=lambda: 0.05)
+        self.sim.run(1)
+        names = [player.name for player in server.table.players]
+        self.assertEqual(len(names), server.MINPLAYERS)
+        self.assertIn('human', names)
+        self.assertIn('bot1', names)
+        self.assertIn('bot1', message.state_to_stabl(
+            self.sim.server.table_state))
+        self.assertTrue(human.in_game)
+        self.sim.run(120)
+        self.assertTrue(human.run)
+        self.assertGreater(human.msgs_sent, 10)
+        self.assertGreater(len(games), 1)
+        self.assertEqual(set(map(str, games)), {str(([], ['human'], 1))})
+
+    def test_no_table_of_bots(self):
+        self.sim.run(server.LOBBYTIMEOUT + 1)
+        self.assertEqual(server.table.players, [])
+        server.BOTS = 1
+        self.sim.add_client('human')
+        self.sim.run(server.LOBBYTIMEOUT + 1)
+        # more bots needed than allowed
+        self.assertEqual(server.table.players, [])
+
+    def test_recover(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.sim.server.start_event_log(path)
+        self.sim.add_client('human')
+        self.sim.run(30)
+        before = self.sim.server.snapshot()
+        self.assertEqual(len(before['bots']), server.MINPLAYERS - 1)
+        self.sim.server.snapshot_timer.cancel()
+        self.sim.server.eventlog.close()
+        self.sim.server.eventlog = None
+        self.sim.close()
+        self.sim = simulation.Simulation(seed=2)
+        self.sim.server.start_event_log(path)
+        self.assertEqual(self.sim.server.snapshot(), before)
+        for bot in self.sim.server.bots:
+            self.assertIs(player_to_client_of(bot.player.name), bot)
+        human = self.sim.add_client('human')
+        self.sim.run(120)
+        self.assertGreater(human.msgs_sent, 5)
+
+    def test_bot_name_not_reclaimed(self):
+        self.sim.add_client('human')
+        self.sim.run(1)
+        other = self.sim.add_client('bot1')
+        self.sim.deliver()
+        self.assertNotEqual(other.player.name, 'bot1')
+        self.assertIsInstance(player_to_client_of('bot1'), server.BotHandler)
+
+class TestSimulatedGame(unittest.TestCase):
+    """Whole games on simulated time, timeouts cost no wall time."""
+
+    def setUp(self):
+        self.sim = simulation.Simulation(seed=0)
+        self.received = []
+
+    def tearDown(self):
+        self.sim.close()
+
+    def add_clients(self, num, **kwargs):
+        """Add clients using every mix of capabilities."""
+        flags = [{}, {'binary': True}, {'delta': True, 'lobby_delta': True},
+            {'binary': True, 'delta': True, 'lobby_delta': True}]
+        bots = []
+        for i in range(num):
+            bot = self.sim.add_client('bot{}'.format(i), **flags[i % 4],
+                **kwargs)
+            bots.append(bot)
+        return bots
+
+    def record(self, bot, ignore=()):
+        """Keep messages the bot receives, dropping the ignored types."""
+        process_msg = bot.process_msg
+        def record_msg(msg):
+            self.received.append(msg)
+            if message.msg_type(msg) not in ignore:
+                process_msg(msg)
+        bot.process_msg = record_msg
+
+    def test_games(self):
+        bots = self.add_clients(9)
+        self.sim.run(3600)
+        self.assertGreater(sum(bot.games_lost for bot in bots), 10)
+        self.assertTrue(all(bot.run for bot in bots))
+        # delta clients rebuilt the same table the server has
+        stabl = message.state_to_stabl(self.sim.server.table_state)
+        for bot in bots:
+            if bot.want_delta and bot.in_game:
+                self.assertEqual(bot.stabl, stabl)
+
+    def test_lobby_deltas_across_games(self):
+        rosters = set()
+        flush_slobb, finish_game = (self.sim.server.flush_slobb,
+            self.sim.server.finish_game)
+        def record_flush():
+            flush_slobb()
+            rosters.add(tuple(player.name for player in server.lobby))
+        def flush_finish():
+            finish_game()
+            # send the lobby as the game left it, winners first
+            self.sim.server.flush_slobb()
+        self.sim.server.flush_slobb = record_flush
+        self.sim.server.finish_game = flush_finish
+        bots = self.add_clients(common.TABLESIZE + 3, think=lambda: 0.05)
+        seen = []
+        for bot in bots:
+            if bot.want_lobby_delta:
+                self.record_lobby(bot, seen)
+        self.sim.run(300)
+        self.assertGreater(len(seen), common.TABLESIZE)
+        for names in seen:
+            self.assertIn(names, rosters)
+
+    def record_lobby(self, bot, seen):
+        process_msg = bot.process_msg
+        def record_msg(msg):
+            process_msg(msg)
+            if message.msg_type(msg) in ('slobb', 'sldel'):
+                seen.append(tuple(name for name in bot.lobby if name))
+        bot.process_msg = record_msg
+
+    def test_lobby_wait(self):
+        self.add_clients(server.MINPLAYERS)
+        self.sim.run(server.LOBBYTIMEOUT - 1)
+        self.assertEqual(server.table.players, [])
+        self.sim.run(1)
+        self.assertEqual(len(server.table.players), server.MINPLAYERS)
+
+    def test_next_game_starts_now(self):
+        starts, ends = [], []
+        start_table, finish_game = (self.sim.server.start_table,
+            self.sim.server.finish_game)
+        def record_start(seed=None):
+            starts.append(self.sim.clock.time())
+            start_table(seed)
+        def record_end():
+            ends.append(self.sim.clock.time())
+            finish_game()
+        self.sim.server.start_table = record_start
+        self.sim.server.finish_game = record_end
+        self.add_clients(4, think=lambda: 0.05)
+        self.sim.run(server.LOBBYTIMEOUT * 4)
+        self.assertGreater(len(ends), 2)
+        # only the first game waited for late comers
+        self.assertEqual(starts[0], server.LOBBYTIMEOUT)
+        self.assertEqual(starts[1:len(ends) + 1], ends)
+
+    def test_play_from_lobby(self):
+        bot = self.add_clients(1)[0]
+        self.sim.deliver()
+        bot.send_msg('[cplay|00,52,52,52]')
+        self.sim.run(server.TURNTIMEOUT + 1)
+        # no turn timer armed, the first game is still to come
+        self.assertIsNone(self.sim.server.turn_timer)
+        self.assertTrue(server.table.starting_round)
+        self.assertEqual(server.table.players, [])
+
+    def test_turn_timeout(self):
+        stalled = self.sim.add_client('stalled', think=lambda: 1e9)
+        bots = self.add_clients(3, think=lambda: 1)
+        self.sim.run(server.LOBBYTIMEOUT + 100 * server.TURNTIMEOUT)
+        # passed for until struck out
+        self.assertFalse(stalled.run)
+        self.assertTrue(all(bot.run for bot in bots))
+        self.assertGreater(sum(bot.games_lost for bot in bots), 0)
+
+    def test_swap_timeout(self):
+        bots = self.add_clients(3, think=lambda: 1)
+        for bot in bots:
+            self.record(bot, ignore=('swapw',))
+        self.sim.run(600)
+        self.assertIn('[swaps|52|52]', self.received)
+        self.assertNotIn('[swaps|', [msg[:7] for msg in self.received
+            if msg != '[swaps|52|52]'])
+        self.assertGreater(sum(bot.games_lost for bot in bots), 1)
+
+    def test_timing(self):
+        bots = self.add_clients(4, timing=True)
+        legacy = self.add_clients(1)[0]
+        self.record(legacy)
+        # inside the first window of timings
+        self.sim.run(client.TIMING_WINDOW - 1)
+        self.assertTrue(all(bot.run for bot in bots + [legacy]))
+        for bot in bots:
+            self.assertTrue(bot.timing)
+            self.assertGreater(bot.rtts.count(), 0)
+            self.assertGreater(bot.server_times.count('processing'), 0)
+            self.assertIn('rtt p50', bot.timings())
+        handler = self.sim.server.clients[1]
+        self.assertIsNotNone(handler.rtt)
+        # clients that didn't ask never see the new messages
+        self.assertFalse(legacy.timing)
+        self.assertEqual([msg for msg in self.received
+            if message.msg_type(msg) in ('sping', 'spong', 'stime')], [])
+
+class TestCapture(unittest.TestCase):
+    """Test recording traffic and the replay comparisons."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_record_simulated_game(self):
+        sim = simulation.Simulation(seed=0)
+        sim.server.recorder = capture.Recorder(self.path, sim.scheduler)
+        bots = [sim.add_client('bot{}'.format(i), binary=bool(i % 2))
+            for i in range(4)]
+        sim.run(120)
+        sim.server.recorder.flush()
+        records = list(capture.read(self.path))
+        sim.close()
+        times = [record[0] for record in records]
+        self.assertEqual(times, sorted(times))
+        conns = replay.group(records)
+        self.assertEqual(len(conns), len(bots))
+        for bot, conn_records in zip(bots, conns.values()):
+            self.assertEqual(conn_records[0][1], capture.OPEN)
+            sends, arrivals, out = replay.recorded(conn_records)
+            msgs = replay.split_msgs(out)
+            self.assertEqual(message.msg_type(msgs[0]), 'sjoin')
+            self.assertEqual(len(msgs), bot.msgs_received)
+
+    def test_truncated(self):
+        with open(self.path, 'wb') as f:
+            f.write(capture.MAGIC + capture.RECORD.pack(0, 1, capture.IN, 5))
+            f.write(b'[cjo')
+        with self.assertRaises(capture.CaptureError):
+            list(capture.read(self.path))
+
+    def test_response_times(self):
+        self.assertEqual(replay.response_times([1, 2, 5], [1.5, 1.6, 6]),
+            [0.5, None, 1])
+
+class TestEventLog(unittest.TestCase):
+    """Test recovering game state from snapshots and the event log."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def crash(self, sim):
+        """Stop logging without a final snapshot, like a crash would."""
+        sim.server.snapshot_timer.cancel()
+        sim.server.eventlog.close()
+        sim.server.eventlog = None
+        sim.close()
+
+    def test_recover(self):
+        for seconds in (5, 100, 1000):
+            sim = simulation.Simulation(seed=1)
+            sim.server.start_event_log(self.path)
+            for i in range(9):
+                sim.add_client('bot{}'.format(i))
+            sim.add_client('watcher', spectate=True)
+            sim.run(seconds)
+            before = sim.server.snapshot()
+            self.assertEqual(len(before['spectators']), 1)
+            self.crash(sim)
+            sim = simulation.Simulation(seed=2)
+            sim.server.start_event_log(self.path)
+            self.assertEqual(sim.server.snapshot(), before)
+            self.crash(sim)
+
+    def test_reclaim_seat(self):
+        sim = simulation.Simulation(seed=1)
+        sim.server.start_event_log(self.path)
+        for i in range(4):
+            sim.add_client('bot{}'.format(i))
+        sim.run(server.LOBBYTIMEOUT + 1)
+        hand = server.table.players[0].hand
+        self.crash(sim)
+        sim = simulation.Simulation(seed=2)
+        sim.server.start_event_log(self.path)
+        self.assertIsInstance(player_to_client_of('bot0'), server.OrphanHandler)
+        bot = sim.add_client('bot0')
+        sim.deliver()
+        self.assertEqual(bot.name, 'bot0')
+        self.assertEqual(sorted(bot.player.hand), sorted(hand))
+        self.assertIs(player_to_client_of('bot0'), sim.links[0][2])
+        sim.run(1000)
+        self.assertGreater(bot.msgs_sent, 1)
+        self.crash(sim)
+
+    def test_play_before_join(self):
+        sim = simulation.Simulation(seed=1)
+        sim.server.start_event_log(self.path)
+        handler = simulation.SimPlayerHandler(1)
+        sim.server.clients[1] = handler
+        handler.receive(b'[cplay|00,52,52,52]')
+        self.assertIn(b'[strik|30|1]', handler.out_buffer)
+        self.crash(sim)
+        state, events = eventlog.recover(self.path)
+        self.assertEqual([event for event in events if event[1] == 'play'], [])
+
+    def test_bad_play_logged_as_strike(self):
+        sim = simulation.Simulation(seed=1)
+        sim.server.start_event_log(self.path)
+        bot = sim.add_client('bot0')
+        sim.deliver()
+        bot.send_msg('[cplay|00,52,52,52]')
+        sim.deliver()
+        self.crash(sim)
+        state, events = eventlog.recover(self.path)
+        self.assertEqual([event[1:] for event in events],
+            [['join', 'bot0'], ['strike', 'bot0', '31']])
+
+    def test_torn_write(self):
+        with open(os.path.join(self.path, eventlog.EVENTS), 'w') as f:
+            f.write('[1,"join","bot0"]\n[2,"join","bo')
+        state, events = eventlog.recover(self.path)
+        self.assertIsNone(state)
+        self.assertEqual(events, [[1, 'join', 'bot0']])
+
+def player_to_client_of(name):
+    return server.player_to_client[server.server.find_player(name)]
+
+class TestHandoff(unittest.TestCase):
+    """Test handing sockets and state to a new server process."""
+
+    def test_send_recv(self):
+        old, new = socket.socketpair()
+        rfd, wfd = os.pipe()
+        state = {'clients': [{'buff': '\xff['}]}
+        sender = threading.Thread(target=handoff.send, args=(old, state, [rfd]))
+        sender.start()
+        received, fds = handoff.recv(new)
+        sender.join()
+        self.assertEqual(received, state)
+        os.write(wfd, b'x')
+        self.assertEqual(os.read(fds[0], 1), b'x')
+        for fd in (rfd, wfd, fds[0]):
+            os.close(fd)
+        old.close()
+        new.close()
+
+    def test_upgrade(self):
+        path = os.path.join(tempfile.mkdtemp(), 'upgrade.sock')
+        port = bench.free_port()
+        cmd = [sys.executable, bench.SERVER, '-s', 'localhost', '-p',
+            str(port), '-u', path, '-q']
+        old, new = subprocess.Popen(cmd), None
+        try:
+            bench.wait_for_server(port, old)
+            socks = []
+            for name in ('alice', 'bob'):
+                sock = socket.create_connection(('localhost', port), timeout=5)
+                sock.sendall('[cjoin|{:8}]'.format(name).encode('ascii'))
+                self.assertTrue(sock.recv(4096).startswith(b'[sjoin|'))
+                socks.append(sock)
+            new = subprocess.Popen(cmd + ['-k'])
+            self.assertEqual(old.wait(timeout=10), 0)
+            socks[0].sendall('[cchat|{:63}]'.format('hi').encode('ascii'))
+            for sock in socks:
+                data = b''
+                while b'[schat|alice' not in data:
+                    chunk = sock.recv(4096)
+                    self.assertTrue(chunk)
+                    data += chunk
+                sock.close()
+            new.terminate()
+            self.assertEqual(new.wait(timeout=10), 0)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            for proc in (old, new):
+                if proc and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            shutil.rmtree(os.path.dirname(path))
+
+class TestMetrics(unittest.TestCase):
+    """Test metric types, rendering and the admin socket."""
+
+    def test_counter(self):
+        counter = metrics.Counter('msgs_total', 'Messages.', 'type')
+        counter.inc('cplay')
+        counter.inc('cplay')
+        counter.inc('cjoin', 3)
+        self.assertEqual(counter.get('cplay'), 2)
+        self.assertEqual(list(counter.samples()), [
+            ('msgs_total', [('type', 'cjoin')], 3),
+            ('msgs_total', [('type', 'cplay')], 2)])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('seconds', 'Seconds.')
+        values = [random.uniform(1e-6, 10) for i in range(1000)] + [0]
+        for value in values:
+            histogram.observe(value)
+        values.sort()
+        self.assertEqual(histogram.count(), len(values))
+        for p in (50, 95, 99):
+            exact = bench.percentile(values, p)
+            bound = histogram.percentile(p)
+            self.assertGreaterEqual(bound, exact)
+            self.assertLessEqual(bound, exact * (1 + 2 / metrics.SUBBUCKETS))
+        self.assertIsNone(metrics.Histogram('x', 'X.').percentile(50))
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.counter('errors_total', 'Errors.').inc()
+        registry.gauge('queue', 'Queue depth.', lambda: 5)
+        registry.histogram('size', 'Sizes.', 'kind').observe(3, 'a"b')
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP errors_total Errors.',
+            '# TYPE errors_total counter',
+            'errors_total 1',
+            '# HELP queue Queue depth.',
+            '# TYPE queue gauge',
+            'queue 5',
+            '# HELP size Sizes.',
+            '# TYPE size histogram',
+            'size_bucket{kind="a\\"b",le="3.25"} 1',
+            'size_bucket{kind="a\\"b",le="+Inf"} 1',
+            'size_sum{kind="a\\"b"} 3',
+            'size_count{kind="a\\"b"} 1'])
+
+    def test_admin_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'admin.sock')
+        port = bench.free_port()
+        proc = subprocess.Popen([sys.executable, bench.SERVER, '-s',
+            'localhost', '-p', str(port), '-a', path, '-q'])
+        try:
+            bench.wait_for_server(port, proc)
+            sock = socket.create_connection(('localhost', port), timeout=5)
+            sock.sendall(b'[cjoin|alice   |timing]')
+            self.assertIn(b'[sjoin|alice   |timing]', sock.recv(4096))
+            sock.sendall(b'[cping|00007]')
+            received = b''
+            while b'[spong|00007]' not in received:
+                received += sock.recv(4096)
+            self.assertIn('alice', admin.command(path, ['clients']))
+            answer = admin.command(path, ['metrics'])
+            self.assertIn('server_messages_received_total{type="cjoin"} 1',
+                answer)
+            self.assertIn('server_lobby_players 1', answer)
+            self.assertIn('Unknown command', admin.command(path, ['bogus']))
+            sock.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(os.path.dirname(path))
+
+class TestLogPipe(unittest.TestCase):
+    """Test lazy, sampled and background logging."""
+
+    def setUp(self):
+        self.logger = logging.getLogger('tests.logpipe')
+        self.logger.propagate = False
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = lambda record: self.records.append(
+            record.getMessage())
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.filters = []
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_lazy(self):
+        calls = []
+        def expensive():
+            calls.append(1)
+            return 'stabl'
+        self.logger.setLevel(logging.WARNING)
+        self.logger.info('%s', logpipe.Lazy(expensive))
+        self.assertEqual(calls, [])
+        self.logger.warning('%s', logpipe.Lazy(expensive))
+        self.assertEqual(self.records, ['stabl'])
+
+    def test_sample(self):
+        logpipe.sample(self.logger.name, 3)
+        for i in range(9):
+            self.logger.warning('%s', i)
+        self.assertEqual(self.records, ['2', '5', '8'])
+
+    def test_levels(self):
+        self.assertEqual(logpipe.parse_levels('server.msgs=warning,root=info'),
+            {'server.msgs': logging.WARNING, 'root': logging.INFO})
+        with self.assertRaises(ValueError):
+            logpipe.parse_levels('server.msgs=loud')
+        with self.assertRaises(ValueError):
+            logpipe.parse_levels('server.msgs')
+
+    def test_background(self):
+        root = logging.getLogger()
+        handlers = root.handlers
+        root.handlers = [self.handler]
+        self.logger.propagate = True
+        self.logger.removeHandler(self.handler)
+        try:
+            listener = logpipe.start()
+            self.assertIsInstance(root.handlers[0],
+                logpipe.DeferredQueueHandler)
+            self.logger.warning('played %s', [0])
+            logpipe.stop(listener)
+            self.assertEqual(root.handlers, [self.handler])
+            self.assertEqual(self.records, ['played [0]'])
+        finally:
+            root.handlers = handlers
+
+    def test_player_error(self):
+        player = common.Player('bob')
+        player.hand = [1, 2]
+        ex = common.PlayerError(player, 'no card: %s, %r', '14', 3,
+            tuple(player.hand))
+        self.assertEqual(str(ex), 'Player bob: no card: 3, (1, 2)')
+        self.assertEqual(str(common.PlayerError(player, '100%')),
+            'Player bob: 100%')
+
+class TestProfiler(unittest.TestCase):
+    """Test profiling sessions and the server's timers."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def busy(self, seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            sorted(range(100))
+
+    def test_cprofile(self):
+        session = profiler.session('cprofile', self.path)
+        session.start()
+        self.busy(0.05)
+        files = session.stop()
+        self.assertEqual(len(files), 2)
+        with open(files[1]) as f:
+            self.assertIn('busy', f.read())
+
+    def test_sample(self):
+        session = profiler.session('sample', self.path)
+        session.start()
+        self.busy(0.2)
+        files = session.stop()
+        with open(files[0]) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('busy (tests.py:', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            profiler.session('perf', self.path)
+
+    def test_admin_profile(self):
+        sim = simulation.Simulation(seed=0)
+        server.PROFILEDIR = self.path
+        try:
+            self.assertIn('Started', sim.server.handle_admin(['profile',
+                'sample', '5']))
+            self.assertIn('Already', sim.server.handle_admin(['profile',
+                'cprofile']))
+            sim.add_client('bot0')
+            sim.run(10)
+            self.assertIsNone(sim.server.profile)
+            self.assertIn('No profiling', sim.server.handle_admin(['profile',
+                'stop']))
+            self.assertIn('Unknown profile kind',
+                sim.server.handle_admin(['profile', 'perf']))
+        finally:
+            server.PROFILEDIR = '.'
+            sim.close()
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+    def test_signal_profile(self):
+        sim = simulation.Simulation(seed=0)
+        server.PROFILEDIR = self.path
+        try:
+            # as the SIGUSR2 handler does
+            sim.server.request_profile('sample')
+            self.assertIsNone(sim.server.profile)
+            server.poll(0)
+            self.assertEqual(sim.server.profile.kind, 'sample')
+            sim.server.request_profile('sample')
+            server.poll(0)
+            self.assertIsNone(sim.server.profile)
+        finally:
+            server.PROFILEDIR = '.'
+            sim.close()
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+class TestTracing(unittest.TestCase):
+    """Test traces of messages and their spans."""
+
+    def tearDown(self):
+        tracing.TRACER.sample = 0
+        tracing.TRACER.current = None
+
+    def test_sampling(self):
+        tracer = tracing.Tracer(sample=3, size=2)
+        self.assertIs(tracer.span('x'), tracing.NOSPAN)
+        traces = [tracer.begin('m') for i in range(9)]
+        self.assertEqual([bool(trace) for trace in traces],
+            [False, False, True] * 3)
+        for trace in filter(None, traces):
+            tracer.finish(trace)
+        # only the last ones are kept
+        self.assertEqual([trace.trace_id for trace in tracer.traces], [2, 3])
+        self.assertEqual(tracing.Tracer().begin('m'), None)
+
+    def test_spans(self):
+        tracer = tracing.Tracer(sample=1)
+        trace = tracer.begin('m', client=4)
+        trace.add('read', trace.start, trace.start + 0.001)
+        with tracer.span('handle', 'cplay'):
+            with tracer.span('play_cards'):
+                pass
+            flush = trace.add('flush', time.perf_counter(), label=2)
+        tracer.rename('cplay')
+        tracer.finish(trace)
+        self.assertIsNone(tracer.current)
+        exported = json.loads(tracer.export())
+        self.assertEqual((exported['name'], exported['client']), ('cplay', 4))
+        spans = exported['spans']
+        self.assertEqual([(span['id'], span['parent'], span['name'])
+            for span in spans], [(1, 0, 'read'), (2, 0, 'handle'),
+            (3, 2, 'play_cards'), (4, 2, 'flush')])
+        self.assertAlmostEqual(spans[0]['duration'], 0.001)
+        self.assertEqual(spans[1]['label'], 'cplay')
+        self.assertIsNone(spans[3]['duration'])
+        trace.close(flush)
+        self.assertIsNotNone(json.loads(tracer.export(1))['spans'][3][
+            'duration'])
+        self.assertEqual(tracer.export(0), '')
+
+    def test_server_traces(self):
+        tracing.TRACER.sample = 1
+        sim = simulation.Simulation(seed=0)
+        try:
+            for i in range(3):
+                sim.add_client('bot{}'.format(i), binary=i == 1)
+            sim.run(60)
+            answer = sim.server.handle_admin(['traces'])
+        finally:
+            sim.close()
+        traces = [json.loads(line) for line in answer.splitlines()]
+        plays = [trace for trace in traces if trace['name'] == 'cplay']
+        self.assertTrue(plays)
+        for trace in plays:
+            names = [span['name'] for span in trace['spans']]
+            for name in ('read', 'handle', 'play_cards', 'table_state',
+                'send_stabl', 'encode', 'flush'):
+                self.assertIn(name, names)
+            # the table update was flushed to every player
+            flushes = [span for span in trace['spans']
+                if span['name'] == 'flush']
+            self.assertEqual(len(flushes), 3)
+            self.assertTrue(all(span['duration'] is not None
+                for span in flushes))
+
+class TestMemory(unittest.TestCase):
+    """Test what idle connections and live tables cost, measured with
+    tracemalloc.
+    """
+
+    COUNT = 1000
+
+    def setUp(self):
+        tracemalloc.start()
+
+    def tearDown(self):
+        tracemalloc.stop()
+
+    def bytes_each(self, make):
+        """Bytes each of COUNT objects made by make() takes up."""
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [make(i) for i in range(self.COUNT)]
+        used = tracemalloc.get_traced_memory()[0] - before
+        self.assertEqual(len(objects), self.COUNT)
+        return used / self.COUNT
+
+    def test_idle_connection(self):
+        per_connection = self.bytes_each(server.PlayerHandler)
+        self.assertLess(per_connection, 400,
+            'bytes per idle connection: {:.0f}'.format(per_connection))
+
+    def test_live_table(self):
+        def live_table(i):
+            table = common.Table()
+            for j in range(common.TABLESIZE):
+                table.add_player(common.Player('p{}'.format(j)))
+            table.deal(random.Random(i))
+            return table
+        per_table = self.bytes_each(live_table)
+        self.assertLess(per_table, 2500,
+            'bytes per live table: {:.0f}'.format(per_table))
+
+    def test_leaks(self):
+        sim = simulation.Simulation(seed=0)
+        names = ('p{}'.format(i) for i in range(10 ** 6))
+        def cycles(count):
+            # join and leave the lobby, with a whole game every 200th time
+            for i in range(count):
+                bots = [sim.add_client(next(names))
+                    for j in range(3 if i % 200 == 0 else 1)]
+                sim.run(300 if len(bots) > 1 else 1)
+                for bot in bots:
+                    sim.remove_client(bot)
+        try:
+            # metric series and caches fill up first
+            tracemalloc.stop()
+            cycles(400)
+            tracemalloc.start()
+            gc.collect()
+            baseline = tracemalloc.get_traced_memory()[0]
+            cycles(2000)
+            gc.collect()
+            grown = tracemalloc.get_traced_memory()[0] - baseline
+            self.assertEqual(sim.server.clients, {})
+            self.assertEqual(server.client_to_player, {})
+            self.assertEqual(server.player_to_client, {})
+        finally:
+            sim.close()
+        self.assertLess(grown, 16384, 'bytes grown: {}'.format(grown))
+
+class TestMemProfile(unittest.TestCase):
+    """Test memory snapshots and their attribution to subsystems."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_attribution(self):
+        attribution = memprofile.Attribution()
+        def subsystem(func, offset=1):
+            return attribution.frame(func.__code__.co_filename,
+                func.__code__.co_firstlineno + offset)
+        self.assertEqual(subsystem(server.GameServer.register_player),
+            'registry maps')
+        self.assertEqual(subsystem(server.PlayerHandler.add_frame_to_buffer),
+            'network buffers')
+        self.assertEqual(subsystem(server.GameServer.send_slobb), 'lobby')
+        self.assertEqual(subsystem(common.Table.play_cards), 'tables')
+        self.assertEqual(subsystem(logging.Logger.info), 'logging')
+        self.assertIsNone(subsystem(common.Player.__init__))
+
+    def test_admin_memory(self):
+        sim = simulation.Simulation(seed=0)
+        server.PROFILEDIR = self.path
+        try:
+            self.assertIn('No memory', sim.server.handle_admin(['memory']))
+            self.assertIn('Started', sim.server.handle_admin(['memory',
+                'start', '60']))
+            self.assertIn('Already', sim.server.handle_admin(['memory',
+                'start']))
+            for i in range(3):
+                sim.add_client('bot{}'.format(i))
+            sim.run(150)
+            answer = sim.server.handle_admin(['memory', '5'])
+            self.assertIn('tables', answer)
+            self.assertEqual(len(answer.split('\n\n')[1].splitlines()), 6)
+            files = sim.server.handle_admin(['memory', 'stop'])
+            self.assertFalse(tracemalloc.is_tracing())
+        finally:
+            server.PROFILEDIR = '.'
+            sim.close()
+        self.assertIn('memory-', files)
+        [name] = os.listdir(self.path)
+        with open(os.path.join(self.path, name)) as f:
+            reports = [json.loads(line) for line in f]
+        # two on the timer and the last one when stopped
+        self.assertEqual(len(reports), 3)
+        self.assertIn('network buffers', reports[0]['subsystems'])
+        self.assertGreater(reports[0]['traced'], 0)
+        for place, subsystem, change, count in reports[0]['growers']:
+            self.assertGreater(change, 0)
+
+class TestClientGui(unittest.TestCase):
+    """Test the GUI's card glyphs and scrollback without a terminal."""
+
+    def setUp(self):
+        # skip __init__, it starts curses
+        self.gui = clientgui.ClientGui.__new__(clientgui.ClientGui)
+        self.gui.msgs = collections.deque(maxlen=5)
+        self.gui.scroll = 0
+        self.drawn = {}
+        self.gui.put = lambda win, y, text: self.drawn.__setitem__(y, text)
+
+    def test_card_glyphs(self):
+        self.assertEqual(len(clientgui.CARD_GLYPHS), 52)
+        self.assertEqual(self.gui.print_card(0), '3\u2663')
+        self.assertEqual(self.gui.print_card(31), '10\u2660')
+        self.assertEqual(self.gui.print_card(51), '2\u2660')
+
+    def test_scrollback(self):
+        self.gui.msgs.extend(str(i) for i in range(8))
+        self.assertEqual(list(self.gui.msgs), ['3', '4', '5', '6', '7'])
+        self.gui.draw_scrollback(None, self.gui.msgs, 4, 3)
+        self.assertEqual(self.drawn, {4: '7  ', 3: '6  ', 2: '5  '})
+        # scrolling stops at the oldest line kept
+        self.gui.scroll = 10
+        self.gui.draw_scrollback(None, self.gui.msgs, 4, 3)
+        self.assertEqual(self.drawn, {4: '5  ', 3: '4  ', 2: '3  '})
+
+class TestTableDiff(unittest.TestCase):
+    """Test what the client sees change between table status messages."""
+
+    def stabl(self, seats, last_play):
+        psl = []
+        for status, name, num_cards in seats:
+            ps = message.PlayerStatus()
+            ps.status, ps.strikes, ps.name, ps.num_cards = (status, 0, name,
+                num_cards)
+            psl.append(ps)
+        while len(psl) < 7:
+            psl.append(message.empty_player_stat())
+        return message.player_stat_list_to_stabl(psl, last_play, False)
+
+    def test_first(self):
+        diff = client.TableDiff(self.stabl([('a', 'bob', 2), ('w', 'jim', 2)],
+            []))
+        self.assertEqual(diff.seats, list(range(7)))
+        self.assertEqual((diff.prev_turn, diff.turn, diff.play), (None, 0, []))
+        self.assertTrue(diff.changed)
+
+    def test_play_and_skip(self):
+        first = client.TableDiff(self.stabl([('a', 'bob', 2), ('w', 'jim', 2),
+            ('w', 'tim', 2)], [4]))
+        diff = client.TableDiff(self.stabl([('w', 'bob', 1), ('w', 'jim', 2),
+            ('a', 'tim', 2)], [5]), first)
+        self.assertEqual(diff.seats, [0, 2])
+        self.assertEqual((diff.prev_turn, diff.turn), (0, 2))
+        self.assertEqual(diff.play, [5])
+        self.assertTrue(diff.skipped)
+        self.assertIsNone(diff.out)
+
+    def test_unchanged(self):
+        stabl = self.stabl([('a', 'bob', 2), ('w', 'jim', 2)], [4])
+        first = client.TableDiff(stabl)
+        diff = client.TableDiff(stabl, first)
+        self.assertFalse(diff.changed)
+        self.assertIs(diff.player_stat_list, first.player_stat_list)
+        # only the starting round flag changed
+        diff = client.TableDiff(stabl[:-2] + '1]', first)
+        self.assertFalse(diff.changed)
+
+    def test_hand_over(self):
+        first = client.TableDiff(self.stabl([('a', 'bob', 1), ('w', 'jim', 2)],
+            [4]))
+        diff = client.TableDiff(self.stabl([('w', 'bob', 0), ('a', 'jim', 2)],
+            [8]), first)
+        self.assertEqual(diff.out.name, 'bob')
+        self.assertTrue(diff.hand_over)
+        self.assertEqual(diff.scumbag.name, 'jim')
+
+class FakeTransport():
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data.decode('ascii'))
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return None
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.pause = client.AUTOPLAY_PAUSE
+        client.AUTOPLAY_PAUSE = 0
+        self.client = client.Client('bob')
+        self.client.loop = self.loop
+        self.transport = FakeTransport()
+        self.client.connection_made(self.transport)
+
+    def tearDown(self):
+        client.AUTOPLAY_PAUSE = self.pause
+        self.loop.close()
+
+    def run_loop(self):
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_partial_messages(self):
+        data = b'[sjoin|bob     ][shand|00,05,' + b'52,' * 15 + b'52]'
+        self.client.data_received(data[:10])
+        self.assertIsNone(self.client.player)
+        self.client.data_received(data[10:-3])
+        self.assertEqual(self.client.player.name, 'bob')
+        self.assertEqual(self.client.player.hand, [])
+        self.client.data_received(data[-3:])
+        self.assertEqual(self.client.player.hand, [0, 5])
+        self.assertEqual(len(self.client.msgs), 0)
+
+    def test_auto_play(self):
+        table = common.Table()
+        player = common.Player('bob')
+        player.status = 'a'
+        player.pickup_hand([0, 5])
+        table.add_player(player)
+        table.add_player(common.Player('jim'))
+        self.client.data_received(b'[sjoin|bob     ]' +
+            message.hand_to_msg(player.hand).encode('ascii'))
+        self.client.data_received(message.table_to_stabl(table).encode('ascii'))
+        self.assertEqual(self.transport.written, [])
+        self.run_loop()
+        self.assertEqual(self.transport.written, ['[cplay|00,52,52,52]'])
+        self.assertEqual(self.client.player.hand, [5])
+
+class TestSwarm(unittest.TestCase):
+    """Test bot swarm think times and strategies."""
+
+    def test_parse_think(self):
+        rng = random.Random(0)
+        self.assertEqual(swarm.parse_think('const:0.5')(rng), 0.5)
+        for i in range(20):
+            self.assertTrue(1 <= swarm.parse_think('uniform:1:2')(rng) <= 2)
+            self.assertTrue(swarm.parse_think('exp:1')(rng) >= 0)
+        for spec in ('const', 'uniform:2:1', 'exp:-1', 'gauss:1', 'const:x'):
+            with self.assertRaises(ValueError):
+                swarm.parse_think(spec)
+
+    def test_strategies(self):
+        hand = [3, 20, 40]
+        for name, make_strategy in swarm.STRATEGIES.items():
+            strategy = make_strategy(random.Random(0))
+            for i in range(20):
+                self.assertIn(strategy(list(hand), [])[0], hand)
+                self.assertIn(strategy(list(hand), [21]), ([], [40]))
+                self.assertEqual(strategy(list(hand), [41]), [])
+
+    def test_random_game(self):
+        sim = simulation.Simulation(seed=0)
+        self.addCleanup(sim.close)
+        games = []
+        finish_game = sim.server.finish_game
+        def count_game():
+            games.append(sim.clock.time())
+            finish_game()
+        sim.server.finish_game = count_game
+        strikes = sum(server.STRIKES.values.values())
+        bots = [sim.add_client('bot{}'.format(i), think=lambda: 0.05,
+            strategy=swarm.random_strategy(random.Random(i)))
+            for i in range(4)]
+        sim.run(server.LOBBYTIMEOUT + 60)
+        self.assertGreater(len(games), 0)
+        self.assertTrue(all(bot.run for bot in bots))
+        self.assertEqual(sum(server.STRIKES.values.values()), strikes)
+
+class TestBench(unittest.TestCase):
+    """Test benchmark percentiles and regression checks."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile([7], 95), 7)
+        self.assertIsNone(bench.percentile([], 50))
+
+    def test_compare(self):
+        baseline = {'games_per_sec': 10, 'play_latency_p99': 0.01}
+        self.assertEqual(bench.compare({'games_per_sec': 9,
+            'play_latency_p99': 0.011}, baseline, 0.2), [])
+        regressions = bench.compare({'games_per_sec': 7,
+            'play_latency_p99': 0.013}, baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(bench.compare({'games_per_sec': 7}, {}, 0.2), [])
+
 class TestNameMangling(unittest.TestCase):
     names = [
         'a',
@@ -0,0 +1,154 @@
+"""Per-message tracing. A sampled inbound message gets a trace with an id
+and spans timing the stages of handling it, down to the socket flushes of
+the answers it caused.
+
+One message is handled at a time, so only one trace is open and stages
+time themselves with:
+
+    with TRACER.span('play_cards'):
+        ...
+
+which costs a method call when the message isn't traced. Finished traces
+are kept in a ring buffer of the last RINGSIZE and exported as JSON lines,
+one trace a line, with span times in seconds from the start of the trace.
+Spans that never finished, like flushes to a client that went away, have
+a null duration.
+"""
+
+import json
+import time
+import itertools
+import collections
+
+RINGSIZE = 1000     # finished traces kept
+
+class Span:
+    """Context manager timing a span of the open trace."""
+
+    __slots__ = ('trace', 'name', 'label', 'span_id')
+
+    def __init__(self, trace, name, label):
+        self.trace = trace
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.span_id = self.trace.open(self.name, self.label)
+
+    def __exit__(self, *exc_info):
+        self.trace.close(self.span_id)
+
+class NoSpan:
+    """Stands in for Span when nothing is traced."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NOSPAN = NoSpan()
+
+class Trace:
+    """Spans of handling one message, kept as lists of
+    [id, parent id, name, label, start, end] with perf_counter() times.
+    Span ids start at 1, parent id 0 is the trace itself.
+    """
+
+    def __init__(self, trace_id, name, start=None, **attrs):
+        self.trace_id = trace_id
+        self.name = name
+        self.attrs = attrs
+        self.start = start or time.perf_counter()
+        self.wall = time.time() - (time.perf_counter() - self.start)
+        self.end = None
+        self.spans = []
+        self.stack = []     # ids of open spans, innermost last
+
+    def add(self, name, start, end=None, label=None):
+        """Add a span timed elsewhere as a child of the innermost open span,
+        returns its id. Spans without an end are closed later with close.
+        """
+        span_id = len(self.spans) + 1
+        self.spans.append([span_id, self.stack[-1] if self.stack else 0,
+            name, label, start, end])
+        return span_id
+
+    def open(self, name, label=None):
+        """Start a span, spans started until it closes are its children."""
+        span_id = self.add(name, time.perf_counter(), None, label)
+        self.stack.append(span_id)
+        return span_id
+
+    def close(self, span_id):
+        self.spans[span_id - 1][5] = time.perf_counter()
+        if self.stack and self.stack[-1] == span_id:
+            self.stack.pop()
+
+    def to_dict(self):
+        spans = []
+        for span_id, parent, name, label, start, end in self.spans:
+            span = {'id': span_id, 'parent': parent, 'name': name,
+                'start': start - self.start,
+                'duration': end - start if end is not None else None}
+            if label is not None:
+                span['label'] = label
+            spans.append(span)
+        trace = {'id': self.trace_id, 'name': self.name, 'time': self.wall,
+            'duration': self.end - self.start if self.end else None}
+        trace.update(self.attrs)
+        trace['spans'] = spans
+        return trace
+
+class Tracer:
+    """Samples messages to trace and keeps the finished traces."""
+
+    def __init__(self, sample=0, size=RINGSIZE):
+        self.sample = sample    # trace one in this many messages, 0 for none
+        self.count = 0
+        self.ids = itertools.count(1)
+        self.traces = collections.deque(maxlen=size)
+        self.current = None     # trace of the message being handled
+
+    def begin(self, name, start=None, **attrs):
+        """Return a new trace if this message is sampled, otherwise None."""
+        if not self.sample:
+            return None
+        self.count += 1
+        if self.count < self.sample:
+            return None
+        self.count = 0
+        self.current = Trace(next(self.ids), name, start, **attrs)
+        return self.current
+
+    def finish(self, trace):
+        """Done handling the message of trace, keep it. Flush spans may
+        still finish later.
+        """
+        trace.end = time.perf_counter()
+        self.traces.append(trace)
+        self.current = None
+
+    def rename(self, name):
+        if self.current:
+            self.current.name = name
+
+    def span(self, name, label=None):
+        """Return context manager timing a span of the open trace."""
+        if self.current is None:
+            return NOSPAN
+        return Span(self.current, name, label)
+
+    def export(self, limit=None):
+        """Return the last limit finished traces, all by default, as JSON
+        lines.
+        """
+        traces = list(self.traces)
+        if limit is not None:
+            traces = traces[-limit:] if limit > 0 else []
+        return ''.join(json.dumps(trace.to_dict(), separators=(',', ':')) +
+            '\n' for trace in traces)
+
+TRACER = Tracer()